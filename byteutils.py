@@ -12,47 +12,154 @@ __status__ = "Prototype"
 
 
 # TODO: eliminate this seriuos mess with bytedata/bytes types
-# TODO: profile lru_caches for MTProto library and possibly disable them here
 # TODO: remove the Bytedata.cororead method, its wierd
 # TODO: (probably?!) move ALL from_bytes/to_bytes calls from the library here
 # TODO: assert number_of_tests > 9000
 # TODO: unpack_binary_string is duplicated here for no reason
 
 import base64
+import collections
 import hashlib
 import functools
+import struct
+import threading
+
+
+# LRU caches limited by the size of cached data, unlike functools.lru_cache they don't keep large messages alive
+# and they count hits, misses and memory, see get_cache_stats()
+
+_caches = dict()  # function name -> BoundedCache
+_caching_enabled = True
+
+
+def _argument_size(argument) -> int:
+    if isinstance(argument, (bytes, str)):
+        return len(argument)
+    if isinstance(argument, int):
+        return argument.bit_length() >> 3
+    return 0
+
+
+class BoundedCache:
+    def __init__(self, function, max_bytes: int, max_item_size: int):
+        functools.update_wrapper(self, function)
+        self.uncached = function  # for hot paths where hits are impossible
+        self.enabled = True
+        self.max_bytes = max_bytes
+        self.max_item_size = max_item_size  # larger arguments and results are never cached
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.memory = 0
+        self._entries = collections.OrderedDict()  # arguments -> (result, size)
+        self._lock = threading.Lock()  # cached functions are called from executor threads
+        _caches[function.__name__] = self
+
+    def __call__(self, *args, **kwargs):
+        if not (self.enabled and _caching_enabled):
+            return self.uncached(*args, **kwargs)
+        size = sum(map(_argument_size, args)) + sum(map(_argument_size, kwargs.values()))
+        if size > self.max_item_size or not all(map(_is_hashable, args)) or not all(map(_is_hashable, kwargs.values())):
+            return self.uncached(*args, **kwargs)
+        key = (args, tuple(kwargs.items())) if kwargs else args
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        result = self.uncached(*args, **kwargs)
+        size += _argument_size(result)
+        if size <= self.max_item_size:
+            with self._lock:
+                if key not in self._entries:
+                    self._entries[key] = result, size
+                    self.memory += size
+                    while self.memory > self.max_bytes:
+                        self.memory -= self._entries.popitem(last=False)[1][1]
+                        self.evictions += 1
+        return result
+
+    def cache_clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.memory = 0
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(
+                enabled=self.enabled and _caching_enabled,
+                entries=len(self._entries),
+                memory=self.memory,
+                max_bytes=self.max_bytes,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+            )
+
+
+def _is_hashable(argument) -> bool:
+    # a memoryview as a key would keep the whole buffer alive
+    if isinstance(argument, memoryview):
+        return False
+    try:
+        hash(argument)
+    except TypeError:  # lists, dicts, bytearray
+        return False
+    return True
+
+
+def bounded_cache(max_bytes: int = 2 ** 16, max_item_size: int = 512):
+    def decorator(function):
+        return BoundedCache(function, max_bytes, max_item_size)
+    return decorator
+
+
+# turns all the caches on or off, caches are cleared when turned off
+def set_caching(enabled: bool) -> None:
+    global _caching_enabled
+    _caching_enabled = enabled
+    if not enabled:
+        for cache in _caches.values():
+            cache.cache_clear()
+
+
+def get_cache_stats() -> dict:
+    return {name: cache.get_stats() for name, cache in _caches.items()}
 
 
 def xor(a: bytes, b: bytes) -> bytes:
-    return bytes(ca ^ cb for ca, cb in zip(a, b))
+    length = min(len(a), len(b))
+    return (int.from_bytes(a[:length], 'big') ^ int.from_bytes(b[:length], 'big')).to_bytes(length, 'big')
 
 
-@functools.lru_cache()
+@bounded_cache()
 def base64encode(b: bytes) -> str:
     return base64.b64encode(b).decode('ascii')
 
 
-@functools.lru_cache()
+@bounded_cache()
 def base64decode(s: str) -> bytes:
     return base64.b64decode(s)
 
 
-@functools.lru_cache()
+@bounded_cache(max_item_size=256)
 def sha1(b: bytes) -> bytes:
     return bytes(hashlib.sha1(b).digest())
 
 
-@functools.lru_cache()
+@bounded_cache(max_item_size=256)
 def sha256(b: bytes) -> bytes:
     return bytes(hashlib.sha256(b).digest())
 
 
-@functools.lru_cache()
+@bounded_cache()
 def to_bytes(x: int, byte_order='big', signed=False) -> bytes:
     return x.to_bytes(((x.bit_length() - 1) // 8) + 1, byte_order, signed=signed)
 
 
-@functools.lru_cache()
+@bounded_cache()
 def pack_binary_string(data: bytes) -> bytes:
     length = len(data)
     if length < 254:
@@ -65,8 +172,40 @@ def pack_binary_string(data: bytes) -> bytes:
         raise OverflowError('String too long')
 
 
+def binary_string_size(length: int) -> int:
+    if length < 254:
+        return length + 1 + (3 - length) % 4
+    elif length <= 0xffffff:
+        return length + 4 + (-length) % 4
+    else:
+        raise OverflowError('String too long')
+
+
+_pack_uint_into = struct.Struct('<I').pack_into
+_zero_padding = bytes(4)
+
+
+# the same as pack_binary_string but writes into a preallocated buffer, returns the offset after the string
+def pack_binary_string_into(buffer, offset: int, data) -> int:
+    length = len(data)
+    if length < 254:
+        buffer[offset] = length
+        offset += 1
+        padding = (3 - length) % 4
+    elif length <= 0xffffff:
+        _pack_uint_into(buffer, offset, 0xfe | length << 8)
+        offset += 4
+        padding = (-length) % 4
+    else:
+        raise OverflowError('String too long')
+    buffer[offset:offset + length] = data
+    offset += length
+    buffer[offset:offset + padding] = _zero_padding[:padding]
+    return offset + padding
+
+
 async def unpack_binary_string(bytereader) -> bytes:
-    strlen = ord(await bytereader(1))
+    strlen = (await bytereader(1))[0]
     if strlen > 0xfe:
         raise RuntimeError("Length equal to 255 in string")
     elif strlen == 0xfe:
@@ -76,7 +215,8 @@ async def unpack_binary_string(bytereader) -> bytes:
         padding_bytes = (3 - strlen) % 4
     s = await bytereader(strlen)
     await bytereader(padding_bytes)
-    return s
+    # bytereader may return memoryview slices of its buffer
+    return bytes(s)
 
 
 def pack_long_binary_string(data: bytes) -> bytes:
@@ -85,12 +225,12 @@ def pack_long_binary_string(data: bytes) -> bytes:
 
 async def unpack_long_binary_string(bytereader) -> bytes:
     strlen = int.from_bytes(await bytereader(4), 'little', signed=False)
-    return await bytereader(strlen)
+    return bytes(await bytereader(strlen))
 
 
 # Output formatting
 
-@functools.lru_cache()
+@bounded_cache(max_item_size=4096)
 def long_hex(data: bytes, word_size: int = 4, chunk_size: int = 4) -> str:
     length = len(data)
     if length == 0:
@@ -108,12 +248,12 @@ def long_hex(data: bytes, word_size: int = 4, chunk_size: int = 4) -> str:
     return '\n'.join(output)
 
 
-@functools.lru_cache()
+@bounded_cache()
 def short_hex(data: bytes) -> str:
     return ':'.join('%02X' % b for b in data)
 
 
-@functools.lru_cache()
+@bounded_cache()
 def short_hex_int(x: int, byte_order='big', signed=False) -> str:
     data = to_bytes(x, byte_order=byte_order, signed=signed)
     return ':'.join('%02X' % b for b in data)
@@ -178,3 +318,21 @@ if __name__ == '__main__':
     b = Bytedata(b'hello1234')
     while b:
         print(b.read(3))
+
+    # caches are bounded by memory and skip large or unhashable arguments
+    for i in range(10000):
+        sha1(i.to_bytes(32, 'little'))
+        sha1(i.to_bytes(32, 'little'))
+    sha1(bytes(1024))
+    sha1(bytearray(16))
+    sha1(b=bytearray(16))
+    if any(map(_is_hashable, ([], dict(), bytearray(16), memoryview(b'')))) or not _is_hashable((1, b'')):
+        raise RuntimeError("unhashable arguments must skip the caches")
+    stats = sha1.get_stats()
+    if stats['memory'] > stats['max_bytes'] or stats['hits'] != 10000 or stats['misses'] != 10000:
+        raise RuntimeError("sha1 cache is not bounded: %r" % stats)
+    set_caching(False)
+    if sha1(b'abc') != hashlib.sha1(b'abc').digest() or sha1.get_stats()['entries']:
+        raise RuntimeError("disabled caches are still used")
+    set_caching(True)
+    print(get_cache_stats())
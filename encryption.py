@@ -4,6 +4,9 @@
 RSA public keys
 AES keys, AES-IGE mode
 
+AES-IGE is done by the fastest available backend: tgcrypto (native IGE), cryptography or pycryptodome
+(native AES-ECB with IGE chaining on 128-bit integers), pyaes is the pure Python fallback.
+
 """
 
 __author__ = "Nikita Miropolskiy"
@@ -22,7 +25,22 @@ import secrets
 
 import pyaes
 
-from byteutils import xor, long_hex, to_bytes, short_hex_int, pack_binary_string, short_hex, sha1, Bytedata
+try:
+    import tgcrypto
+except ImportError:
+    tgcrypto = None
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+try:
+    from Crypto.Cipher import AES as pycryptodome_AES
+except ImportError:
+    pycryptodome_AES = None
+
+from byteutils import long_hex, to_bytes, short_hex_int, pack_binary_string, short_hex, sha1, Bytedata
 
 _rsa_public_key_RE = re.compile(r'-----BEGIN RSA PUBLIC KEY-----(?P<key>.*)-----END RSA PUBLIC KEY-----', re.S)
 
@@ -62,55 +80,157 @@ class PublicRSA:
         return to_bytes(x)
 
     def encrypt_with_hash(self, plain: bytes) -> bytes:
-        return self.encrypt(sha1(plain) + plain)
+        return self.encrypt(sha1.uncached(plain) + plain)
+
+# IGE chaining over any AES-ECB block function, blocks are xored as 128-bit integers
+def _ige_encrypt(data, iv: bytes, encrypt_block) -> bytearray:
+    data = memoryview(data)
+    from_bytes = int.from_bytes
+    cipher_previous = from_bytes(iv[:16], 'big')
+    plain_previous = from_bytes(iv[16:32], 'big')
+    result = bytearray(len(data))
+    for offset in range(0, len(data), 16):
+        plain_block = from_bytes(data[offset:offset + 16], 'big')
+        cipher_block = from_bytes(encrypt_block((plain_block ^ cipher_previous).to_bytes(16, 'big')), 'big') ^ plain_previous
+        result[offset:offset + 16] = cipher_block.to_bytes(16, 'big')
+        cipher_previous, plain_previous = cipher_block, plain_block
+    return result
+
+
+def _ige_decrypt(data, iv: bytes, decrypt_block) -> bytearray:
+    data = memoryview(data)
+    from_bytes = int.from_bytes
+    cipher_previous = from_bytes(iv[:16], 'big')
+    plain_previous = from_bytes(iv[16:32], 'big')
+    result = bytearray(len(data))
+    for offset in range(0, len(data), 16):
+        cipher_block = from_bytes(data[offset:offset + 16], 'big')
+        plain_block = from_bytes(decrypt_block((cipher_block ^ plain_previous).to_bytes(16, 'big')), 'big') ^ cipher_previous
+        result[offset:offset + 16] = plain_block.to_bytes(16, 'big')
+        cipher_previous, plain_previous = cipher_block, plain_block
+    return result
+
+
+# makes (ige256_encrypt, ige256_decrypt) out of a factory of (encrypt_block, decrypt_block) for a key
+def _ecb_backend(block_functions):
+    def ige256_encrypt(data, key: bytes, iv: bytes):
+        return _ige_encrypt(data, iv, block_functions(key)[0])
+
+    def ige256_decrypt(data, key: bytes, iv: bytes):
+        return _ige_decrypt(data, iv, block_functions(key)[1])
+    return ige256_encrypt, ige256_decrypt
+
+
+def _pyaes_block_functions(key: bytes):
+    aes = pyaes.AES(key)
+    return (lambda block: bytes(aes.encrypt(block))), (lambda block: bytes(aes.decrypt(block)))
+
+
+def _cryptography_block_functions(key: bytes):
+    cipher = Cipher(algorithms.AES(key), modes.ECB())
+    return cipher.encryptor().update, cipher.decryptor().update
+
+
+def _pycryptodome_block_functions(key: bytes):
+    aes = pycryptodome_AES.new(key, pycryptodome_AES.MODE_ECB)
+    return aes.encrypt, aes.decrypt
+
+
+def _tgcrypto_ige256_encrypt(data, key: bytes, iv: bytes):
+    return tgcrypto.ige256_encrypt(bytes(data), key, iv)
+
+
+def _tgcrypto_ige256_decrypt(data, key: bytes, iv: bytes):
+    return tgcrypto.ige256_decrypt(bytes(data), key, iv)
+
+
+# backend name -> (ige256_encrypt, ige256_decrypt), the fastest one goes first
+_aes_backends = dict()
+if tgcrypto is not None:
+    _aes_backends['tgcrypto'] = (_tgcrypto_ige256_encrypt, _tgcrypto_ige256_decrypt)
+if Cipher is not None:
+    _aes_backends['cryptography'] = _ecb_backend(_cryptography_block_functions)
+if pycryptodome_AES is not None:
+    _aes_backends['pycryptodome'] = _ecb_backend(_pycryptodome_block_functions)
+_aes_backends['pyaes'] = _ecb_backend(_pyaes_block_functions)
+
+aes_backend = next(iter(_aes_backends))
+
+
+def get_aes_backends() -> list:
+    return list(_aes_backends)
+
+
+def set_aes_backend(name: str) -> None:
+    global aes_backend
+    if name not in _aes_backends:
+        raise ValueError("Unknown AES backend `%s`, available backends: %s" % (name, ', '.join(_aes_backends)))
+    aes_backend = name
+
 
 # AES encryption in IGE mode
 class AesIge:
-    def __init__(self, key: bytes, iv: bytes):
+    def __init__(self, key: bytes, iv: bytes, backend: str = None):
         if len(key) != 32:
             raise ValueError("AES key length must be 32 bytes, got %d bytes: %s" %(len(key), short_hex(key)))
         if len(iv) != 32:
             raise ValueError("AES init vector length must be 32 bytes, got %d bytes: %s" %(len(iv), short_hex(key)))
+        self.key = key
         self.iv1, self.iv2 = iv[:16], iv[16:]
-        self.aes = pyaes.AES(key)
-        self.plain_buffer = b''
+        self.backend = backend if backend is not None else aes_backend
+        self._ige256_encrypt, self._ige256_decrypt = _aes_backends[self.backend]
 
     def decrypt_block(self, cipher_block: bytes) -> bytes:
-        plain_block = xor(self.iv1, self.aes.decrypt(xor(self.iv2, cipher_block)))
-        self.iv1, self.iv2 = cipher_block, plain_block
-        return plain_block
-
-    def decrypt_async_stream(self, loop, executor, reader):
-        async def decryptor(n: int) -> bytes:
-            while len(self.plain_buffer) < n:
-                self.plain_buffer += await loop.run_in_executor(executor, self.decrypt_block, await reader(16))
-            plain = self.plain_buffer[:n]
-            self.plain_buffer = self.plain_buffer[n:]
-            return plain
-        return decryptor
+        return self.decrypt(cipher_block)
+
+    # plain is any writable buffer, a whole frame is decrypted in one call
+    def decrypt_into(self, cipher, plain, offset: int = 0) -> None:
+        cipher = memoryview(cipher)
+        if len(cipher) % 16:
+            raise ValueError("cipher length must be divisible by 16 bytes, got %d bytes" % len(cipher))
+        if not cipher:
+            return
+        result = self._ige256_decrypt(cipher, self.key, self.iv1 + self.iv2)
+        # cipher and plain may be the same buffer
+        self.iv1, self.iv2 = bytes(cipher[-16:]), bytes(result[-16:])
+        plain[offset:offset + len(cipher)] = result
 
     def decrypt(self, cipher: bytes) -> bytes:
         if len(cipher) % 16:
             raise ValueError("cipher length must be divisible by 16 bytes\n%s" % long_hex(cipher))
-        return b''.join(self.decrypt_block(plain_block) for plain_block in Bytedata(cipher).blocks(16))
+        plain = bytearray(len(cipher))
+        self.decrypt_into(cipher, plain)
+        return bytes(plain)
 
     def encrypt_block(self, plain_block: bytes) -> bytes:
         if len(plain_block) != 16:
             raise RuntimeError("plain block is wrong")
-        if len(self.iv1) != 16:
-            raise RuntimeError("iv1 block is wrong")
-        if len(self.iv2) != 16:
-            raise RuntimeError("iv2 block is wrong")
-        cipher_block = xor(self.iv2, self.aes.encrypt(xor(self.iv1, plain_block)))
-        self.iv1, self.iv2 = cipher_block, plain_block
-        return cipher_block
+        cipher_block = bytearray(16)
+        self.encrypt_into(plain_block, cipher_block)
+        return bytes(cipher_block)
+
+    # plain must be already padded to 16 bytes, cipher is any writable buffer
+    def encrypt_into(self, plain, cipher, offset: int = 0) -> None:
+        plain = memoryview(plain)
+        if len(plain) % 16:
+            raise ValueError("plain length must be divisible by 16 bytes, got %d bytes" % len(plain))
+        if not plain:
+            return
+        result = self._ige256_encrypt(plain, self.key, self.iv1 + self.iv2)
+        # plain and cipher may be the same buffer
+        self.iv1, self.iv2 = bytes(result[-16:]), bytes(plain[-16:])
+        cipher[offset:offset + len(plain)] = result
 
     def encrypt(self, plain: bytes) -> bytes:
         padding = secrets.token_bytes((-len(plain)) % 16)
-        return b''.join(self.encrypt_block(plain_block) for plain_block in Bytedata(plain + padding).blocks(16))
+        if padding:
+            plain = bytes(plain) + padding
+        cipher = bytearray(len(plain))
+        self.encrypt_into(plain, cipher)
+        return bytes(cipher)
 
     def encrypt_with_hash(self, plain: bytes) -> bytes:
-        return self.encrypt(sha1(plain) + plain)
+        return self.encrypt(sha1.uncached(plain) + plain)
 
     def decrypt_with_hash(self, cipher: bytes) -> bytes:
         plain_with_hash = self.decrypt(cipher)
@@ -122,30 +242,34 @@ class AesIge:
 
 
 # https://core.telegram.org/mtproto/description#defining-aes-key-and-initialization-vector
-def prepare_key_to_write(auth_key: bytes, msg_key: bytes):
-    sha1_a = sha1(msg_key + auth_key[:32])
-    sha1_b = sha1(auth_key[32:48] + msg_key + auth_key[48:64])
-    sha1_c = sha1(auth_key[64:96] + msg_key)
-    sha1_d = sha1(msg_key + auth_key[96:128])
+# msg_key is unique for every message, there's no point in caching these hashes
+def prepare_key_to_write(auth_key: bytes, msg_key: bytes, backend: str = None):
+    sha1_a = sha1.uncached(msg_key + auth_key[:32])
+    sha1_b = sha1.uncached(auth_key[32:48] + msg_key + auth_key[48:64])
+    sha1_c = sha1.uncached(auth_key[64:96] + msg_key)
+    sha1_d = sha1.uncached(msg_key + auth_key[96:128])
     aes_key = sha1_a[:8] + sha1_b[8:20] + sha1_c[4:16]
     aes_iv = sha1_a[8:20] + sha1_b[:8] + sha1_c[16:20] + sha1_d[:8]
-    aes = AesIge(aes_key, aes_iv)
+    aes = AesIge(aes_key, aes_iv, backend)
     return aes
 
 
 # https://core.telegram.org/mtproto/description#defining-aes-key-and-initialization-vector
-def prepare_key_to_read(auth_key: bytes, msg_key: bytes):
-    sha1_a = sha1(msg_key + auth_key[8:40])
-    sha1_b = sha1(auth_key[40:56] + msg_key + auth_key[56:72])
-    sha1_c = sha1(auth_key[72:104] + msg_key)
-    sha1_d = sha1(msg_key + auth_key[104:136])
+def prepare_key_to_read(auth_key: bytes, msg_key: bytes, backend: str = None):
+    sha1_a = sha1.uncached(msg_key + auth_key[8:40])
+    sha1_b = sha1.uncached(auth_key[40:56] + msg_key + auth_key[56:72])
+    sha1_c = sha1.uncached(auth_key[72:104] + msg_key)
+    sha1_d = sha1.uncached(msg_key + auth_key[104:136])
     aes_key = sha1_a[:8] + sha1_b[8:20] + sha1_c[4:16]
     aes_iv = sha1_a[8:20] + sha1_b[:8] + sha1_c[16:20] + sha1_d[:8]
-    aes = AesIge(aes_key, aes_iv)
+    aes = AesIge(aes_key, aes_iv, backend)
     return aes
 
 #tests
 if __name__ == "__main__":
+    import time
+    from byteutils import xor
+
     server_public_key_file = open('telegram.rsa.pub', 'r').read()
     k = PublicRSA(server_public_key_file)
     print("E = ", short_hex_int(k.e))
@@ -153,4 +277,41 @@ if __name__ == "__main__":
     print(long_hex(to_bytes(k.n)))
     print("Fingerprint = ", k.fingerprint)
 
+    # block by block reference implementation of IGE with pyaes
+    def reference_ige_encrypt(plain, key, iv):
+        aes, iv1, iv2 = pyaes.AES(key), iv[:16], iv[16:]
+        cipher = b''
+        for i in range(0, len(plain), 16):
+            cipher_block = xor(iv2, bytes(aes.encrypt(xor(iv1, plain[i:i + 16]))))
+            iv1, iv2 = cipher_block, plain[i:i + 16]
+            cipher += cipher_block
+        return cipher
+
+    # all backends must produce the same bytes, in one call and in chunks
+    for size in (16, 32, 1024, 4096 + 16):
+        key, iv, plain = secrets.token_bytes(32), secrets.token_bytes(32), secrets.token_bytes(size)
+        reference = reference_ige_encrypt(plain, key, iv)
+        for backend_name in get_aes_backends():
+            if AesIge(key, iv, backend_name).encrypt(plain) != reference:
+                raise RuntimeError("%s backend encrypts %d bytes differently" % (backend_name, size))
+            if AesIge(key, iv, backend_name).decrypt(reference) != plain:
+                raise RuntimeError("%s backend decrypts %d bytes differently" % (backend_name, size))
+            aes = AesIge(key, iv, backend_name)
+            if b''.join(aes.encrypt(plain[i:i + 32]) for i in range(0, size, 32)) != reference:
+                raise RuntimeError("%s backend doesn't chain IV between calls" % backend_name)
+    print("AES backends match the reference:", ', '.join(get_aes_backends()))
+
+    # throughput of every backend
+    for backend_name in get_aes_backends():
+        size = 2 ** 20 if backend_name != 'pyaes' else 2 ** 16
+        key, iv, plain = secrets.token_bytes(32), secrets.token_bytes(32), secrets.token_bytes(size)
+        started = time.perf_counter()
+        cipher = AesIge(key, iv, backend_name).encrypt(plain)
+        encrypt_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        AesIge(key, iv, backend_name).decrypt(cipher)
+        decrypt_seconds = time.perf_counter() - started
+        print("%-14s encrypt %8.2f MB/s, decrypt %8.2f MB/s" % (
+            backend_name, size / encrypt_seconds / 2 ** 20, size / decrypt_seconds / 2 ** 20))
+
 
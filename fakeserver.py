@@ -0,0 +1,820 @@
+#!/usr/bin/env python3.6
+"""This is a prototype module
+
+This module implements a local stand-in for Telegram server:
+creation of authorization key with req_pq, req_DH_params and set_client_DH_params
+ https://core.telegram.org/mtproto/auth_key
+and encrypted messages with a handful of service methods, every other method gets rpc_error.
+Several servers sharing a dict of DCs export and import authorizations to each other.
+
+It's used for benchmarking the handshake, run it to measure handshakes per second:
+ python3 fakeserver.py --handshakes 100 --concurrency 4
+and for checking how streamjson sessions handle what the server does:
+ python3 fakeserver.py --check routing
+
+"""
+
+__author__ = "Nikita Miropolskiy"
+__email__ = "nikita@miropolskiy.com"
+__license__ = "https://creativecommons.org/licenses/by-nc-nd/4.0/legalcode"
+__status__ = "Prototype"
+
+
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import secrets
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import encryption
+import mtproto
+import primes
+import tcp
+from byteutils import to_bytes, sha1, xor, base64encode
+
+
+# a throwaway RSA key pair, the public key is exported as PEM for encryption.PublicRSA
+class TestRSA:
+    def __init__(self, bits: int = 2048):
+        self.e = 65537
+        while True:
+            p, q = primes.generate_prime(bits // 2), primes.generate_prime(bits // 2)
+            self.n = p * q
+            phi = (p - 1) * (q - 1)
+            if p != q and self.n.bit_length() == bits and phi % self.e != 0:
+                break
+        self.d = pow(self.e, -1, phi)
+        # CRT parameters, decryption is about 3 times faster with them
+        self._p, self._q = p, q
+        self._dp, self._dq, self._q_inv = self.d % (p - 1), self.d % (q - 1), pow(q, -1, p)
+        self.fingerprint = encryption.PublicRSA(self.get_pem()).fingerprint
+
+    @staticmethod
+    def _asn1(field_type: int, data: bytes) -> bytes:
+        if len(data) < 0x80:
+            return bytes((field_type, len(data))) + data
+        length = to_bytes(len(data))
+        return bytes((field_type, 0x80 | len(length))) + length + data
+
+    def get_pem(self) -> str:
+        # RSAPublicKey ::= SEQUENCE { modulus INTEGER, publicExponent INTEGER }, integers are signed
+        asn1 = self._asn1(0x30, b''.join(
+            self._asn1(0x02, b'\x00' + to_bytes(number)) for number in (self.n, self.e)
+        ))
+        return "-----BEGIN RSA PUBLIC KEY-----\n%s\n-----END RSA PUBLIC KEY-----\n" % \
+               base64.encodebytes(asn1).decode()
+
+    # returns sha1 + data + padding, as encrypted by PublicRSA.encrypt_with_hash
+    def decrypt(self, cipher: bytes) -> bytes:
+        c = int.from_bytes(cipher, 'big')
+        m_p, m_q = pow(c, self._dp, self._p), pow(c, self._dq, self._q)
+        m = m_q + (self._q_inv * (m_p - m_q) % self._p) * self._q
+        return m.to_bytes(255, 'big')
+
+
+class FakeServer:
+    def __init__(self, loop, host: str = '127.0.0.1', port: int = 0, rsa: TestRSA = None,
+                 g: int = 3, dh_prime: int = primes._C7_prime, executor=None, salt_lifetime: int = 3600,
+                 dc_id: int = 2, dcs: dict = None):
+        self._loop = loop
+        self._executor = executor
+        self._host = host
+        self._port = port
+        self._rsa = rsa if rsa is not None else TestRSA()
+        self._g = g
+        self._dh_prime = dh_prime
+        self._scheme = mtproto.preload_scheme(loop)
+        self._server = None
+        self.auth_keys = dict()  # auth_key_id -> auth_key
+        self.sessions = dict()  # session_id -> auth_key_id
+        self.received = []  # (session_id, message) of every encrypted message, containers are unpacked
+        self.containers = []  # (session_id, container message)
+        self.rpc_delay = 0.0  # seconds before every rpc_result
+        # a new salt every salt_lifetime seconds, each one is accepted half as long again, so that they overlap
+        self.salt_lifetime = salt_lifetime
+        self.salts = dict()  # auth_key_id -> [(valid_since, valid_until, salt)], the oldest first
+        self.bad_server_salts = 0  # messages rejected with bad_server_salt
+        self.time_offset = 0.0  # seconds the server clock is ahead of the local one
+        self.bad_msg_ids = 0  # messages rejected with bad_msg_notification 16 or 17
+        self.dc_id = dc_id
+        self.dcs = dcs if dcs is not None else dict()  # dc_id -> FakeServer, shared by the servers of one network
+        self.dcs[dc_id] = self
+        self.migrate_errors = dict()  # method -> error like FILE_MIGRATE_4, the method is answered with it
+        self.exported_authorizations = dict()  # id -> bytes, exported by other DCs for this one
+        self.authorized = set()  # auth_key_ids with an imported authorization
+
+    def get_pem(self) -> str:
+        return self._rsa.get_pem()
+
+    def _now(self) -> float:
+        return time.time() + self.time_offset
+
+    def get_port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self._host, self._port)
+        return self.get_port()
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _in_thread(self, *args):
+        return await self._loop.run_in_executor(self._executor, *args)
+
+    @staticmethod
+    async def _read_abridged_packet(reader) -> bytes:
+        packet_data_length = ord(await reader.readexactly(1))
+        if packet_data_length == 0x7f:
+            packet_data_length = int.from_bytes(await reader.readexactly(3), 'little', signed=False)
+        return await reader.readexactly(packet_data_length * 4)
+
+    @staticmethod
+    def _write_abridged_packet(writer, data: bytes) -> None:
+        packet_data_length = len(data) >> 2
+        if packet_data_length < 0x7f:
+            writer.write(packet_data_length.to_bytes(1, 'little'))
+        else:
+            writer.write(b'\x7f' + packet_data_length.to_bytes(3, 'little'))
+        writer.write(data)
+
+    async def _handle(self, reader, writer):
+        state = dict()
+        try:
+            if await reader.readexactly(1) != b'\xef':
+                return
+            while True:
+                frame = await self._read_abridged_packet(reader)
+                if frame[:8] != bytes(8):
+                    if not await self._handle_encrypted(frame, writer):
+                        writer.write(b'\x01' + (-404).to_bytes(4, 'little', signed=True))
+                        break
+                    continue
+                message = self._scheme.unpack(frame, is_boxed=False, parameter_type='unencrypted_message')
+                answer = await self._answer(state, message.body)
+                if answer is None:
+                    # transport error, like the real server does for messages it can't handle
+                    writer.write(b'\x01' + (-404).to_bytes(4, 'little', signed=True))
+                    break
+                self._write_abridged_packet(writer, self._scheme.bare(
+                    _cons='unencrypted_message',
+                    auth_key_id=0,
+                    message_id=(int(self._now() * 2 ** 30) * 4) | 1,
+                    body=answer
+                ).get_flat_bytes())
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    # encrypted part, server side of https://core.telegram.org/mtproto/description
+
+    def _write_encrypted(self, writer, auth_key: bytes, session: dict, body, content_related: bool = True) -> int:
+        message_id = max(session['last_message_id'] + 4, (int(self._now() * 2 ** 32) & ~3) | 1)
+        session['last_message_id'] = message_id
+        seqno = session['seqno'] * 2 + (1 if content_related else 0)
+        if content_related:
+            session['seqno'] += 1
+        plain = self._scheme.bare(
+            _cons='message_inner_data',
+            salt=session['salt'],
+            session_id=session['session_id'],
+            message=self._scheme.bare(_cons='message', msg_id=message_id, seqno=seqno, body=body)
+        ).get_flat_bytes()
+        msg_key = sha1.uncached(plain)[4:20]
+        plain += secrets.token_bytes(-len(plain) % 16)
+        # server to client messages use the key derivation the client reads with
+        encrypted_data = encryption.prepare_key_to_read(auth_key, msg_key).encrypt(plain)
+        self._write_abridged_packet(writer, sha1.uncached(auth_key)[-8:] + msg_key + encrypted_data)
+        return message_id
+
+    def _add_salt(self, auth_key_id: bytes, valid_since: int, salt: int) -> None:
+        self.salts.setdefault(auth_key_id, []).append(
+            (valid_since, valid_since + self.salt_lifetime + self.salt_lifetime // 2, salt)
+        )
+
+    # salts that aren't expired yet, at least num of them
+    def _get_salts(self, auth_key_id: bytes, num: int = 1) -> list:
+        now = int(self._now())
+        salts = self.salts[auth_key_id] = [salt for salt in self.salts.get(auth_key_id, []) if salt[1] > now]
+        while len(salts) < num:
+            valid_since = salts[-1][0] + self.salt_lifetime if salts else now
+            self._add_salt(auth_key_id, valid_since, int.from_bytes(secrets.token_bytes(8), 'little', signed=True))
+        return salts
+
+    def _check_salt(self, auth_key_id: bytes, salt: int) -> bool:
+        now = self._now()
+        return any(valid_since <= now < valid_until and salt == valid_salt
+                   for valid_since, valid_until, valid_salt in self._get_salts(auth_key_id))
+
+    async def _handle_encrypted(self, frame: bytes, writer) -> bool:
+        auth_key = self.auth_keys.get(frame[:8])
+        if auth_key is None:
+            return False
+        msg_key = frame[8:24]
+        plain = encryption.prepare_key_to_write(auth_key, msg_key).decrypt(frame[24:])
+        inner = self._scheme.unpack(plain, is_boxed=False, parameter_type='message_inner_data')
+        if inner.session_id not in self.sessions:
+            self.sessions[inner.session_id] = dict(
+                auth_key_id=frame[:8], session_id=inner.session_id, salt=inner.salt, seqno=0, last_message_id=0
+            )
+        session = self.sessions[inner.session_id]
+        messages = [inner.message]
+        if inner.message.body == 'msg_container':
+            self.containers.append((inner.session_id, inner.message))
+            messages = inner.message.body.messages
+        # https://core.telegram.org/mtproto/service_messages_about_messages#notice-of-ignored-error-message
+        # message ids more than 300 seconds behind or 30 seconds ahead of the server time are rejected
+        message_time = inner.message.msg_id / 2 ** 32
+        if not self._now() - 300 < message_time < self._now() + 30:
+            self.bad_msg_ids += 1
+            self._write_encrypted(writer, auth_key, session, self._scheme.boxed(
+                _cons='bad_msg_notification', bad_msg_id=inner.message.msg_id, bad_msg_seqno=inner.message.seqno,
+                error_code=16 if message_time < self._now() else 17
+            ), content_related=False)
+            return True
+        if not self._check_salt(frame[:8], inner.salt):
+            # the newest salt that is valid already
+            now = self._now()
+            new_server_salt = [salt for valid_since, _, salt in self._get_salts(frame[:8]) if valid_since <= now][-1]
+            for message in messages:
+                self.bad_server_salts += 1
+                self._write_encrypted(writer, auth_key, session, self._scheme.boxed(
+                    _cons='bad_server_salt', bad_msg_id=message.msg_id, bad_msg_seqno=message.seqno,
+                    error_code=48, new_server_salt=new_server_salt
+                ), content_related=False)
+            return True
+        for message in messages:
+            self.received.append((inner.session_id, message))
+            self._loop.create_task(self._answer_encrypted(writer, auth_key, session, message))
+        return True
+
+    async def _answer_encrypted(self, writer, auth_key: bytes, session: dict, message):
+        query = message.body
+        while query in ('invokeWithoutUpdates', 'invokeWithLayer', 'initConnection'):
+            query = query._wrapped
+        if query == 'msgs_ack':
+            return
+        if query == 'ping':
+            self._write_encrypted(writer, auth_key, session, self._scheme.boxed(
+                _cons='pong', msg_id=message.msg_id, ping_id=query.ping_id
+            ))
+            return
+        if query == 'get_future_salts':
+            # the answer isn't wrapped in rpc_result, it has req_msg_id of its own
+            salts = self._get_salts(session['auth_key_id'], min(64, max(1, query.num)))
+            self._write_encrypted(writer, auth_key, session, self._scheme.boxed(
+                _cons='future_salts', req_msg_id=message.msg_id, now=int(self._now()), salts=[
+                    dict(_cons='future_salt', valid_since=valid_since, valid_until=valid_until, salt=salt)
+                    for valid_since, valid_until, salt in salts
+                ]
+            ))
+            return
+        result = self._answer_rpc(session, query)
+        if self.rpc_delay:
+            await asyncio.sleep(self.rpc_delay)
+        if writer.is_closing():
+            return
+        self._write_encrypted(writer, auth_key, session, self._scheme.boxed(
+            _cons='rpc_result', req_msg_id=message.msg_id, result=result
+        ))
+
+    def _get_config(self):
+        numbers = (
+            'date', 'expires', 'chat_size_max', 'megagroup_size_max', 'forwarded_count_max', 'online_update_period_ms',
+            'offline_blur_timeout_ms', 'offline_idle_timeout_ms', 'online_cloud_timeout_ms', 'notify_cloud_delay_ms',
+            'notify_default_delay_ms', 'chat_big_size', 'push_chat_period_ms', 'push_chat_limit', 'saved_gifs_limit',
+            'edit_time_limit', 'rating_e_decay', 'stickers_recent_limit', 'stickers_faved_limit',
+            'channels_read_media_period', 'pinned_dialogs_count_max', 'call_receive_timeout_ms', 'call_ring_timeout_ms',
+            'call_connect_timeout_ms', 'call_packet_timeout_ms'
+        )
+        return dict(
+            dict.fromkeys(numbers, 0),
+            _cons='config',
+            test_mode=dict(_cons='boolTrue'),
+            this_dc=self.dc_id,
+            dc_options=[
+                dict(_cons='dcOption', id=dc_id, ip_address=server._host, port=server.get_port())
+                for dc_id, server in sorted(self.dcs.items()) if server._server is not None
+            ],
+            me_url_prefix='',
+            disabled_features=[]
+        )
+
+    def _answer_rpc(self, session: dict, query) -> dict:
+        for method, error_message in self.migrate_errors.items():
+            if query == method:
+                return dict(_cons='rpc_error', error_code=303, error_message=error_message)
+        if query == 'help.getConfig':
+            return self._get_config()
+        if query == 'auth.exportAuthorization':
+            if query.dc_id not in self.dcs or query.dc_id == self.dc_id:
+                return dict(_cons='rpc_error', error_code=400, error_message='DC_ID_INVALID')
+            exported_id, exported_bytes = secrets.randbits(31), base64encode(secrets.token_bytes(32))
+            self.dcs[query.dc_id].exported_authorizations[exported_id] = exported_bytes
+            return dict(_cons='auth.exportedAuthorization', id=exported_id, bytes=exported_bytes)
+        if query == 'auth.importAuthorization':
+            if self.exported_authorizations.pop(query.id, None) != query.bytes:
+                return dict(_cons='rpc_error', error_code=400, error_message='AUTH_BYTES_INVALID')
+            self.authorized.add(session['auth_key_id'])
+            return dict(_cons='auth.authorization', user=dict(_cons='userEmpty', id=1))
+        if query == 'upload.getFile':
+            return dict(
+                _cons='upload.file', type=dict(_cons='storage.filePartial'), mtime=0,
+                bytes=base64encode(bytes(min(query.limit, 2 ** 20)))
+            )
+        if query in ('upload.saveFilePart', 'upload.saveBigFilePart'):
+            return dict(_cons='boolTrue')
+        return dict(_cons='rpc_error', error_code=400, error_message='METHOD_NOT_IMPLEMENTED')
+
+    async def _answer(self, state: dict, request):
+        if request == 'req_pq':
+            p, q = await asyncio.gather(self._in_thread(primes.generate_prime, 31), self._in_thread(primes.generate_prime, 32))
+            state.update(nonce=request.nonce, server_nonce=secrets.token_bytes(16), pq=to_bytes(p * q))
+            return self._scheme.boxed(
+                _cons='resPQ',
+                nonce=state['nonce'],
+                server_nonce=state['server_nonce'],
+                pq=state['pq'],
+                server_public_key_fingerprints=[self._rsa.fingerprint]
+            )
+
+        if request == 'req_DH_params':
+            if request.public_key_fingerprint != self._rsa.fingerprint or request.server_nonce != state.get('server_nonce'):
+                return None
+            decrypted = await self._in_thread(self._rsa.decrypt, request.encrypted_data)
+            p_q_inner_data = await self._scheme.read_from_string(decrypted[20:])
+            if (p_q_inner_data != 'p_q_inner_data'
+                    or p_q_inner_data.pq != state['pq']
+                    or p_q_inner_data.nonce != state['nonce']):
+                return None
+            new_nonce = p_q_inner_data.new_nonce
+            server_nonce = state['server_nonce']
+            state.update(
+                new_nonce=new_nonce,
+                a=secrets.randbits(2048),
+                tmp_aes_key=sha1.uncached(new_nonce + server_nonce) + sha1.uncached(server_nonce + new_nonce)[:12],
+                tmp_aes_iv=sha1.uncached(server_nonce + new_nonce)[12:] + sha1.uncached(new_nonce + new_nonce) + new_nonce[:4]
+            )
+            g_a = await self._in_thread(pow, self._g, state['a'], self._dh_prime)
+            server_DH_inner_data = self._scheme.boxed(
+                _cons='server_DH_inner_data',
+                nonce=state['nonce'],
+                server_nonce=server_nonce,
+                g=self._g,
+                dh_prime=to_bytes(self._dh_prime),
+                g_a=to_bytes(g_a),
+                server_time=int(self._now())
+            ).get_flat_bytes()
+            # the answer is padded to a multiple of 16 bytes together with its hash
+            padding = secrets.token_bytes(-(20 + len(server_DH_inner_data)) % 16)
+            tmp_aes = encryption.AesIge(state['tmp_aes_key'], state['tmp_aes_iv'])
+            return self._scheme.boxed(
+                _cons='server_DH_params_ok',
+                nonce=state['nonce'],
+                server_nonce=server_nonce,
+                encrypted_answer=await self._in_thread(tmp_aes.encrypt_with_hash, server_DH_inner_data + padding)
+            )
+
+        if request == 'set_client_DH_params':
+            if 'a' not in state or request.server_nonce != state['server_nonce']:
+                return None
+            tmp_aes = encryption.AesIge(state['tmp_aes_key'], state['tmp_aes_iv'])
+            client_DH_inner_data = await self._scheme.read_from_string(
+                await self._in_thread(tmp_aes.decrypt_with_hash, request.encrypted_data)
+            )
+            if client_DH_inner_data != 'client_DH_inner_data' or client_DH_inner_data.nonce != state['nonce']:
+                return None
+            g_b = int.from_bytes(client_DH_inner_data.g_b, 'big')
+            if not primes.is_good_dh_value(g_b, self._dh_prime):
+                return None
+            # secrets are kept out of the shared caches, like in mtproto.py
+            auth_key = to_bytes.uncached(await self._in_thread(pow, g_b, state['a'], self._dh_prime))
+            auth_key_id = sha1.uncached(auth_key)[-8:]
+            self.auth_keys[auth_key_id] = auth_key
+            # the first salt comes from the nonces
+            self._add_salt(auth_key_id, int(self._now()), int.from_bytes(
+                xor(state['new_nonce'][:8], state['server_nonce'][:8]), 'little', signed=True
+            ))
+            return self._scheme.boxed(
+                _cons='dh_gen_ok',
+                nonce=state['nonce'],
+                server_nonce=state['server_nonce'],
+                new_nonce_hash1=sha1.uncached(state['new_nonce'] + b'\x01' + sha1.uncached(auth_key)[:8])[4:20]
+            )
+
+        return None
+
+
+# the server runs in its own processes, so that its CPU time isn't counted as the client's
+def _serve(pem_queue, stop_event, workers: int):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    executor = None
+    if workers is not None:
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    server = FakeServer(loop, executor=executor)
+    port = loop.run_until_complete(server.start())
+    pem_queue.put((port, server.get_pem()))
+    loop.run_until_complete(loop.run_in_executor(None, stop_event.wait))
+    loop.run_until_complete(server.stop())
+    if executor is not None:
+        executor.shutdown()
+
+
+async def benchmark(loop, host: str, port: int, pem: str, handshakes: int, concurrency: int,
+                    transport: str = 'streams') -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def handshake():
+        async with semaphore:
+            connection = mtproto.MTProto(loop, host, port, pem, transport=transport)
+            try:
+                await connection._create_auth_key()
+            finally:
+                await connection.stop()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(handshake() for _ in range(handshakes)))
+    return handshakes / (time.perf_counter() - started)
+
+
+# checks: streamjson sessions talk to fake servers, a check raises RuntimeError when a session misbehaves
+_CHECK_TIMEOUT = 10  # seconds for a request to be answered
+_INTERACTIVE = dict(_cons='help.getNearestDc')  # the fake server answers it with rpc_error
+
+
+class _CheckClient:
+    """A client of a streamjson session connected to a fake server, requests get ids in order
+    and are passed to the session as JSON lines, like the proxy reads them
+    """
+    def __init__(self, loop, server: FakeServer, *options):
+        import streamjson  # it reads the Telegram settings, the benchmark doesn't need them
+        self._responses = dict()
+        self._last_id = 0
+        # options are streamjson command line arguments, the session writes its responses to the client
+        self.session = streamjson.Session(None, self, 'check', loop, streamjson.parse_command_line_args(list(options)))
+        self.session._host, self.session._port, self.session._rsa = server._host, server.get_port(), server.get_pem()
+
+    def write(self, data: bytes) -> None:
+        response = json.loads(data)
+        self._responses[response['id']] = response
+
+    async def request(self, **request) -> dict:
+        self._last_id += 1
+        request['id'] = self._last_id
+        await asyncio.wait_for(self.session.receive_line(json.dumps(request).encode() + b'\n'), _CHECK_TIMEOUT)
+        response = self._responses.pop(request['id'])
+        if 'error' in response:
+            raise RuntimeError("error response: %r" % response)
+        return response
+
+    # the messages are sent concurrently, their answers come in the same order
+    async def call(self, *messages) -> list:
+        responses = await asyncio.gather(*(self.request(message=message) for message in messages))
+        return [response['message'] for response in responses]
+
+    async def close(self) -> None:
+        self.session.disconnect()
+        # the connections send what is left and close
+        await asyncio.sleep(0.1)
+
+
+def _expect(responses: list, *constructors) -> None:
+    if [response['_cons'] for response in responses] != list(constructors):
+        raise RuntimeError("wrong responses: %r" % responses)
+
+
+def _upload(part: int) -> dict:
+    return dict(_cons='upload.saveFilePart', file_id=1, file_part=part, bytes='AAAA')
+
+
+def _method(message) -> str:
+    query = message.body
+    while query in ('invokeWithoutUpdates', 'invokeWithLayer', 'initConnection'):
+        query = query._wrapped
+    return query.get_dict()['_cons']
+
+
+# upload.* requests go to media connections, everything else to the interactive one in order,
+# all of them share the auth key
+async def check_routing(loop):
+    server = FakeServer(loop)
+    await server.start()
+    server.rpc_delay = 0.05  # the requests overlap, so that the uploads are spread
+    client = _CheckClient(loop, server, '--connections', '3')
+    uploads = [*map(_upload, range(5)), _wrap_init_connection(_upload(5))]
+    _expect(await client.call(*uploads, *[_INTERACTIVE] * 3), *['boolTrue'] * 6, *['rpc_error'] * 3)
+    connections = (await client.request(stats=dict()))['stats']['connections']
+    kinds = {connection['session_id']: connection['kind'] for connection in connections}
+    media_sessions = set()
+    interactive_ids = []
+    for session_id, message in server.received:
+        method = _method(message)
+        if method in ('get_future_salts', 'msgs_ack'):
+            continue
+        kind = 'media' if method.startswith('upload.') else 'interactive'
+        if kinds[session_id] != kind:
+            raise RuntimeError("%s was sent over %s connection" % (method, kinds[session_id]))
+        if (kind == 'media') != (message.body == 'invokeWithoutUpdates'):
+            raise RuntimeError("only media connections send invokeWithoutUpdates: %r" % message)
+        if kind == 'media':
+            media_sessions.add(session_id)
+        else:
+            interactive_ids.append(message.msg_id)
+    # a message id is the time it was sent, the next request waits for the answer
+    if any(later - earlier < server.rpc_delay * 2 ** 32 for earlier, later in zip(interactive_ids, interactive_ids[1:])):
+        raise RuntimeError("interactive requests must be sent one after another")
+    if len(media_sessions) != 2:
+        raise RuntimeError("uploads went over %d media connections of 2" % len(media_sessions))
+    if len(server.auth_keys) != 1:
+        raise RuntimeError("connections of a session made %d auth keys" % len(server.auth_keys))
+    await client.close()
+    await server.stop()
+
+
+# concurrent requests go in msg_container, a rejected container stands for the requests in it
+async def check_containers(loop):
+    server = FakeServer(loop)
+    await server.start()
+    client = _CheckClient(loop, server, '--batch-window', '0.05')
+    _expect(await client.call(*map(_upload, range(5))), *['boolTrue'] * 5)
+    # the server clock jumps, the next container is rejected as a whole with bad_msg_notification
+    server.time_offset = 1000.0
+    _expect(await client.call(*map(_upload, range(5))), *['boolTrue'] * 5)
+    if not server.containers or server.bad_msg_ids != 1:
+        raise RuntimeError("%d containers, %d rejected" % (len(server.containers), server.bad_msg_ids))
+    for _, container in server.containers:
+        seqnos = [message.seqno for message in container.body.messages]
+        if container.seqno % 2 or container.seqno < max(seqnos):
+            raise RuntimeError("container seqno %d with messages %r" % (container.seqno, seqnos))
+        if any(message.msg_id >= container.msg_id for message in container.body.messages):
+            raise RuntimeError("container msg_id must be greater than msg_id of its messages")
+    await client.close()
+    await server.stop()
+
+
+# the salt of the handshake is used until the salts fetched ahead of time, they are saved with the session
+async def check_salts(loop):
+    server = FakeServer(loop)
+    await server.start()
+    client = _CheckClient(loop, server, '--connections', '2')
+    for attempt in range(3):
+        if attempt == 2:
+            # the server changes its salts, the request is rejected and sent again with the new one
+            server.salts.clear()
+        _expect(await client.call(_INTERACTIVE), 'rpc_error')
+        if (server.bad_server_salts > 0) != (attempt == 2):
+            raise RuntimeError("%d messages were rejected with bad_server_salt" % server.bad_server_salts)
+    if [_method(message) for _, message in server.received].count('get_future_salts') != 2:
+        raise RuntimeError("future salts must be fetched again after the salts change")
+    bad_server_salts = server.bad_server_salts
+    saved = (await client.request(session=dict()))['session']
+    await client.close()
+    if not saved['future_salts']:
+        raise RuntimeError("future salts aren't saved with the session")
+    client = _CheckClient(loop, server, '--connections', '2')
+    await client.request(session=saved)
+    _expect(await client.call(_INTERACTIVE), 'rpc_error')
+    if server.bad_server_salts != bad_server_salts:
+        raise RuntimeError("a restored session sent a message with a wrong salt")
+    await client.close()
+    await server.stop()
+
+
+# message ids follow the server clock: it's learnt with the auth key or from a rejection and saved with the session
+async def check_clock_skew(loop):
+    for time_offset in (1000.0, -1000.0):
+        server = FakeServer(loop)
+        server.time_offset = time_offset
+        await server.start()
+        saved = None
+        for restored_offset in (None, 0.0, time_offset):
+            client = _CheckClient(loop, server, '--connections', '2')
+            if saved is not None:
+                # a session saved without the offset, its salts don't match the server clock either
+                saved.update(time_offset=restored_offset, server_salt=0, future_salts=[])
+                await client.request(session=saved)
+            bad_msg_ids = server.bad_msg_ids
+            _expect(await client.call(*map(_upload, range(4)), _INTERACTIVE), *['boolTrue'] * 4, 'rpc_error')
+            # one rejection per connection at most, when the clock is unknown
+            rejected = server.bad_msg_ids - bad_msg_ids
+            if rejected > (2 if restored_offset == 0.0 else 0):
+                raise RuntimeError("%d messages were rejected, server clock %+g, restored offset %r" % (
+                    rejected, time_offset, restored_offset
+                ))
+            saved = (await client.request(session=dict()))['session']
+            if abs(saved['time_offset'] - time_offset) > 5:
+                raise RuntimeError("saved time offset %g, the server clock is %+g" % (saved['time_offset'], time_offset))
+            await client.close()
+        # an offset too high by less than message ids may be ahead of the server clock isn't rejected, it's corrected
+        client = _CheckClient(loop, server, '--connections', '2')
+        await client.request(session=dict(saved, time_offset=time_offset + 20))
+        _expect(await client.call(_INTERACTIVE), 'rpc_error')
+        saved = (await client.request(session=dict()))['session']
+        if abs(saved['time_offset'] - time_offset) > 5:
+            raise RuntimeError("saved time offset %g, the server clock is %+g" % (saved['time_offset'], time_offset))
+        await client.close()
+        await server.stop()
+
+
+# fake DCs share the RSA key and know each other for exporting authorizations
+async def _start_fake_dcs(loop, *dc_ids) -> list:
+    dcs = dict()
+    servers = [FakeServer(loop, dc_id=dc_ids[0], dcs=dcs)]
+    servers += [FakeServer(loop, rsa=servers[0]._rsa, dc_id=dc_id, dcs=dcs) for dc_id in dc_ids[1:]]
+    for server in servers:
+        await server.start()
+    return servers
+
+
+def _wrap_init_connection(query: dict) -> dict:
+    return dict(_cons='invokeWithLayer', layer=mtproto.get_layers()['layer'], _wrapped=dict(
+        _cons='initConnection', api_id=1, device_model='check', system_version='check', app_version='check',
+        system_lang_code='en', lang_pack='', lang_code='en', _wrapped=query
+    ))
+
+
+def _is_wrapped_in_layer(message) -> bool:
+    query = message.body
+    while query == 'invokeWithoutUpdates':
+        query = query._wrapped
+    return query == 'invokeWithLayer'
+
+
+# FILE_MIGRATE_X: file requests go to the other DC with the imported authorization, the DC is remembered,
+# PHONE_MIGRATE_X: the session moves to the other DC, the requests waiting for answers go along
+async def check_migrate(loop):
+    home, files_dc, phone_dc = await _start_fake_dcs(loop, 2, 4, 5)
+    home.migrate_errors['upload.getFile'] = 'FILE_MIGRATE_4'
+    location = dict(_cons='inputDocumentFileLocation', id=1, access_hash=2, version=0)
+    get_file = dict(_cons='upload.getFile', location=location, offset=0, limit=1024)
+
+    def count(server, method):
+        return [_method(message) for _, message in server.received].count(method)
+
+    client = _CheckClient(loop, home, '--connections', '2')
+    await client.call(_wrap_init_connection(dict(_cons='help.getConfig')))
+    _expect(await client.call(*[get_file] * 4), *['upload.file'] * 4)
+    if count(home, 'auth.exportAuthorization') != 1 or len(files_dc.authorized) != 1:
+        raise RuntimeError("concurrent requests must share one imported authorization")
+    await client.call(get_file)
+    if count(home, 'upload.getFile') != 4:
+        raise RuntimeError("requests for a file with a known DC must go there right away")
+    # the DC is remembered for a request wrapped in initConnection as well
+    other_file = dict(get_file, location=dict(location, id=2))
+    _expect(await client.call(_wrap_init_connection(other_file)), 'upload.file')
+    _expect(await client.call(other_file), 'upload.file')
+    if count(home, 'upload.getFile') != 5:
+        raise RuntimeError("the DC of a file requested with initConnection must be remembered")
+    saved = (await client.request(session=dict()))['session']
+    await client.close()
+
+    # the authorization in the other DC is saved with the session
+    client = _CheckClient(loop, home, '--connections', '2')
+    await client.request(session=saved)
+    auth_keys = len(files_dc.auth_keys)
+    _expect(await client.call(get_file), 'upload.file')
+    if len(files_dc.auth_keys) != auth_keys or count(home, 'auth.exportAuthorization') != 1:
+        raise RuntimeError("a restored session must use the saved authorization")
+    await client.close()
+
+    home.migrate_errors['auth.sendCode'] = 'PHONE_MIGRATE_5'
+    home.rpc_delay = 0.5  # the upload is waiting for an answer when the session moves
+    client = _CheckClient(loop, home, '--connections', '2')
+    await client.call(_wrap_init_connection(dict(_cons='help.getConfig')))
+
+    async def upload():
+        await asyncio.sleep(0.2)
+        return (await client.call(_upload(0)))[0]
+
+    send_code = _wrap_init_connection(dict(_cons='auth.sendCode', phone_number='1', api_id=1, api_hash='check'))
+    responses = await asyncio.gather(client.call(send_code), upload())
+    # the fake server doesn't implement auth.sendCode
+    if responses[0][0].get('error_message') != 'METHOD_NOT_IMPLEMENTED' or responses[1]['_cons'] != 'boolTrue':
+        raise RuntimeError("wrong responses: %r" % responses)
+    requests = [message for _, message in phone_dc.received if _method(message) != 'get_future_salts']
+    if len(requests) != 2 or not all(map(_is_wrapped_in_layer, requests)):
+        raise RuntimeError("both requests must be sent to the new DC with initConnection: %r" % requests)
+    saved = (await client.request(session=dict()))['session']
+    if saved['dc_id'] != 5:
+        raise RuntimeError("the session must stay in DC5, not in DC%d" % saved['dc_id'])
+    await client.close()
+    for server in (home, files_dc, phone_dc):
+        await server.stop()
+
+
+# streamjson.py as it's run: a process listening for JSON lines over TCP, with the buffered protocol transport
+async def check_proxy(loop):
+    server = FakeServer(loop)
+    await server.start()
+    options = ['--transport', 'protocol', '--connections', '2']
+    try:
+        import uvloop  # optional, like for the proxy itself
+        options.append('--uvloop')
+    except ImportError:
+        pass
+    directory = os.path.dirname(os.path.abspath(__file__))
+    proxy = await asyncio.create_subprocess_exec(
+        sys.executable, '-u', os.path.join(directory, 'streamjson.py'), '--host', '127.0.0.1', '--port', '0', *options,
+        cwd=directory, stdout=asyncio.subprocess.PIPE
+    )
+    try:
+        line = b''
+        while not line.startswith(b'Started listening on'):
+            line = await asyncio.wait_for(proxy.stdout.readline(), _CHECK_TIMEOUT)
+            if not line:
+                raise RuntimeError("streamjson.py exited with %r" % await proxy.wait())
+        # the proxy logs to stdout, it must not block on a full pipe
+        output = loop.create_task(proxy.stdout.read())
+        reader, writer = await asyncio.open_connection('127.0.0.1', int(line.split(b':')[-1]))
+        requests = [dict(id=1, server=dict(host=server._host, port=server.get_port(), rsa=server.get_pem()))]
+        requests += [dict(id=request_id, message=message) for request_id, message in enumerate(
+            [_upload(0), _upload(1), _INTERACTIVE], 2
+        )]
+        writer.write(b''.join(json.dumps(request).encode() + b'\n' for request in requests))
+        responses = dict()
+        while len(responses) < len(requests):
+            line = await asyncio.wait_for(reader.readline(), _CHECK_TIMEOUT)
+            if not line:
+                raise RuntimeError("streamjson.py closed the connection")
+            response = json.loads(line)
+            if response['id'] != 0:
+                responses[response['id']] = response
+        if responses[1].get('server', {}).get('port') != server.get_port():
+            raise RuntimeError("wrong response: %r" % responses[1])
+        _expect([responses[request_id].get('message', responses[request_id]) for request_id in range(2, 5)],
+                'boolTrue', 'boolTrue', 'rpc_error')
+        if [_method(message) for _, message in server.received].count('upload.saveFilePart') != 2:
+            raise RuntimeError("the uploads didn't reach the server")
+        writer.close()
+    finally:
+        if proxy.returncode is None:
+            proxy.terminate()
+        await proxy.wait()
+    await output
+    await server.stop()
+
+
+checks = dict(
+    routing=check_routing,
+    containers=check_containers,
+    salts=check_salts,
+    clock_skew=check_clock_skew,
+    migrate=check_migrate,
+    proxy=check_proxy,
+)
+
+
+# tests
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Handshakes per second against a local fake DH server, or checks of streamjson sessions')
+    parser.add_argument('--handshakes', type=int, default=50, help='number of auth keys to create')
+    parser.add_argument('--concurrency', type=int, default=1, help='number of simultaneous handshakes')
+    parser.add_argument('--crypto-processes', type=int, default=None, metavar='N',
+                        help='factorize and exponentiate in N worker processes')
+    parser.add_argument('--transport', default='streams', choices=sorted(tcp.transports),
+                        help='connect with asyncio streams or with a buffered protocol')
+    parser.add_argument('--server-processes', type=int, default=None, metavar='N',
+                        help='the fake server exponentiates in N worker processes')
+    parser.add_argument('--check', dest='checks', action='append', choices=sorted(checks), metavar='NAME',
+                        help='run check NAME instead of the benchmark, one of: %s' % ', '.join(sorted(checks)))
+    args = parser.parse_args()
+
+    if args.checks:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        for name in args.checks:
+            loop.run_until_complete(checks[name](loop))
+            print('check %s passed' % name)
+        loop.close()
+    else:
+        context = multiprocessing.get_context('spawn')
+        pem_queue, stop_event = context.Queue(), context.Event()
+        # not a daemon, daemonic processes can't have worker processes
+        server_process = context.Process(target=_serve, args=(pem_queue, stop_event, args.server_processes))
+        server_process.start()
+        port, pem = pem_queue.get()
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        mtproto.preload_scheme(loop)
+        if args.crypto_processes is not None:
+            mtproto.enable_process_pool(args.crypto_processes)
+        try:
+            # the first handshake warms up the scheme codecs and the process pool
+            loop.run_until_complete(benchmark(loop, '127.0.0.1', port, pem, 1, 1))
+            rate = loop.run_until_complete(
+                benchmark(loop, '127.0.0.1', port, pem, args.handshakes, args.concurrency, args.transport)
+            )
+            print('%d handshakes, concurrency %d: %.1f handshakes/sec' % (args.handshakes, args.concurrency, rate))
+        finally:
+            stop_event.set()
+            server_process.join()
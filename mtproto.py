@@ -14,20 +14,55 @@ __status__ = "Prototype"
 
 
 import asyncio
+import multiprocessing
 import secrets
 import time
-from concurrent.futures import ThreadPoolExecutor
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 
 import encryption
 import primes
 import tl
 from byteutils import to_bytes, sha1, xor, base64decode, base64encode
-from tcp import AbridgedTCP
+import tcp
+from tcp import WRITE_HIGH_WATER, WRITE_LOW_WATER
 
 
 _singleton_executor = None
-_singleton_scheme = None
+_process_executor = None  # optional, for CPU bound crypto
+_current_scheme = None  # new connections use the most recently loaded scheme
+_schemes = weakref.WeakValueDictionary()  # layer -> scheme, older layers live while connections use them
+
+# outgoing message bodies of this size and larger are sent as gzip_packed, like official clients do,
+# only requests are compressed: service messages are small and the server handles them right away
+GZIP_THRESHOLD = 512
+_SERVICE_CONSTRUCTORS = frozenset((
+    'msgs_ack', 'get_future_salts', 'ping', 'ping_delay_disconnect', 'destroy_session', 'http_wait',
+    'msgs_state_req', 'msg_resend_req', 'rpc_drop_answer'
+))
+
+# messages written within BATCH_WINDOW seconds are sent in one msg_container, 0 batches messages of one loop iteration,
+# a container is sent right away when it reaches BATCH_MAX_SIZE bytes or BATCH_MAX_MESSAGES messages
+BATCH_WINDOW = 0.0
+BATCH_MAX_SIZE = 32 * 1024
+BATCH_MAX_MESSAGES = 1020  # the server doesn't accept more
+SENT_CONTAINERS_KEPT = 64  # rejected containers are resolved to their messages
+
+# https://core.telegram.org/mtproto/service_messages#request-for-several-future-salts
+# salts are requested FUTURE_SALTS_NUMBER at a time when less than FUTURE_SALTS_MIN are left,
+# a new salt is taken SALT_SWITCH_MARGIN seconds after it becomes valid or the old one expires, whichever comes first
+FUTURE_SALTS_NUMBER = 32
+FUTURE_SALTS_MIN = 2
+SALT_SWITCH_MARGIN = 60
+
+# smaller batches with nothing to compress are sealed right in the loop, scheduling a thread takes longer
+INLINE_SEND_MAX_SIZE = 2048
+_inline_send_max_size = INLINE_SEND_MAX_SIZE
+
+# smaller messages are encrypted in threads, passing them to a process costs more than encryption itself
+PROCESS_POOL_MIN_SIZE = 16 * 1024
+_process_pool_min_size = PROCESS_POOL_MIN_SIZE
 
 def _get_executor():
     global _singleton_executor
@@ -35,35 +70,229 @@ def _get_executor():
         _singleton_executor = ThreadPoolExecutor(max_workers=3)
     return _singleton_executor
 
-def _get_scheme(in_thread):
-    global _singleton_scheme
-    if _singleton_scheme is None:
-        _singleton_scheme = tl.Scheme(in_thread, open('scheme.tl', 'r').read() + "\n" + open('service.tl', 'r').read())
-    return _singleton_scheme
+
+# encryption of large messages, DH exponentiation and pq factorization are done by worker processes,
+# they aren't limited by GIL
+def enable_process_pool(max_workers: int = None, min_size: int = PROCESS_POOL_MIN_SIZE):
+    global _process_executor, _process_pool_min_size
+    # large buffers are passed to workers in shared memory, it's new in Python 3.8
+    import multiprocessing.shared_memory
+    if _process_executor is None:
+        # workers are spawned, forking a process with running threads and an event loop is unsafe
+        _process_executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+    _process_pool_min_size = min_size
+    return _process_executor
+
+def _load_scheme(loop):
+    async def in_thread(*args):
+        return await loop.run_in_executor(_get_executor(), *args)
+    return tl.Scheme(
+        in_thread,
+        open('scheme.tl', 'r').read() + "\n" + open('service.tl', 'r').read(),
+        cache_filename='scheme.tl.cache',
+        lazy=True
+    )
+
+
+def _set_current_scheme(scheme):
+    global _current_scheme
+    _current_scheme = _schemes[scheme.layer] = scheme
+    return scheme
+
+
+def _get_scheme(loop):
+    if _current_scheme is None:
+        _set_current_scheme(_load_scheme(loop))
+    return _current_scheme
+
+
+# parses the scheme before the first connection is made
+def preload_scheme(loop):
+    return _get_scheme(loop)
+
+
+# loads scheme.tl again without blocking the loop, new connections use the new scheme,
+# established connections keep their scheme and layer
+async def reload_scheme(loop):
+    return _set_current_scheme(await loop.run_in_executor(_get_executor(), _load_scheme, loop))
+
+
+def get_layers():
+    return dict(
+        layer=_current_scheme.layer if _current_scheme is not None else None,
+        loaded_layers=sorted(layer for layer in _schemes.keys() if layer is not None)
+    )
+
+
+# key derivation and encryption of a message are done in a single executor call
+def _decrypt_message_into(auth_key: bytes, msg_key: bytes, encrypted_data, plain, offset: int = 0) -> None:
+    encryption.prepare_key_to_read(auth_key, msg_key).decrypt_into(encrypted_data, plain, offset)
+
+
+def _encrypt_message_into(auth_key: bytes, msg_key: bytes, plain, encrypted_data, offset: int = 0) -> None:
+    encryption.prepare_key_to_write(auth_key, msg_key).encrypt_into(plain, encrypted_data, offset)
+
+
+# encrypted_message: auth_key_id:ulong msg_key:int128 encrypted_data:encrypted
+def _new_encrypted_message(auth_key_id: bytes, msg_key: bytes, length: int) -> bytearray:
+    full_message = bytearray(24 + length)
+    full_message[:8] = auth_key_id
+    full_message[8:24] = msg_key
+    return full_message
+
+
+# messages are (message_id, seq_no, body, compress), several of them are put into a container with container_id,
+# returns the padded message_inner_data and its msg_key
+def _serialize_messages(scheme, messages: list, container_id, salt: int, session_id: int):
+    bare_messages = []
+    for message_id, seq_no, body, compress in messages:
+        # large bodies are compressed: fewer bytes to send and fewer blocks to encrypt
+        if compress:
+            body = scheme.gzip_packed(body)
+        bare_messages.append(scheme.bare(_cons='message', msg_id=message_id, seqno=seq_no, body=body))
+    if container_id is None:
+        message = bare_messages[0]
+    else:
+        # https://core.telegram.org/mtproto/service_messages#containers
+        # a container is not content related, its seqno is the even one following the contained messages
+        message = scheme.bare(
+            _cons='message',
+            msg_id=container_id,
+            seqno=max(seq_no + (seq_no & 1) for _, seq_no, _, _ in messages),
+            body=scheme.boxed(_cons='msg_container', messages=bare_messages)
+        )
+    message_inner_data = scheme.bare(_cons='message_inner_data', salt=salt, session_id=session_id, message=message)
+    # serialized once into a buffer with room for random padding
+    plain_length = message_inner_data.get_size()
+    plain = message_inner_data.get_buffer(block_size=16)
+    plain[plain_length:] = secrets.token_bytes(len(plain) - plain_length)
+    # messages never repeat, there's no point in caching their hashes
+    msg_key = sha1.uncached(memoryview(plain)[:plain_length])[4:20]
+    return plain, msg_key
+
+
+# received messages are decoded off the event loop, gzip_packed data included
+def _unpack_message(scheme, plain):
+    message = scheme.unpack(plain, is_boxed=False, parameter_type='message_inner_data', lazy=scheme.lazy).message
+    if scheme.lazy:
+        _unpack_gzip_packed(message)
+    return message
+
+
+# lazy fields are unpacked upon access and kept, so gzip_packed data is decompressed here and not when it's read
+def _unpack_gzip_packed(message) -> None:
+    body = message.body.packed_data if message.body == 'gzip_packed' else message.body
+    if body == 'msg_container':
+        for contained in body.messages:
+            _unpack_gzip_packed(contained)
+    elif body == 'rpc_result' and body.result == 'gzip_packed':
+        body.result.packed_data
+
+
+# the whole receive path in a single executor call
+def _open_message(auth_key: bytes, msg_key: bytes, encrypted_data, plain, scheme):
+    _decrypt_message_into(auth_key, msg_key, encrypted_data, plain)
+    return _unpack_message(scheme, plain)
+
+
+# the whole send path in a single call: one executor hop per batch, or none for small ones
+def _seal_messages(auth_key: bytes, auth_key_id: bytes, *serialize_args) -> bytearray:
+    plain, msg_key = _serialize_messages(*serialize_args)
+    full_message = _new_encrypted_message(auth_key_id, msg_key, len(plain))
+    _encrypt_message_into(auth_key, msg_key, plain, full_message, 24)
+    return full_message
+
+
+# runs in a worker process, the data in shared memory is replaced with the result
+def _crypt_shared_memory(crypt_into, name: str, length: int, auth_key: bytes, msg_key: bytes) -> None:
+    from multiprocessing.shared_memory import SharedMemory
+    shared_memory = SharedMemory(name=name)
+    try:
+        data = shared_memory.buf[:length]
+        crypt_into(auth_key, msg_key, data, data)
+        data.release()
+    finally:
+        shared_memory.close()
 
 
 class MTProto:
-    def __init__(self, loop, host: str, port: int, public_rsa_key: str):
+    def __init__(self, loop, host: str, port: int, public_rsa_key: str,
+                 gzip_threshold: int = GZIP_THRESHOLD, gzip_max_size: int = None, scheme=None,
+                 write_high_water: int = WRITE_HIGH_WATER, write_low_water: int = WRITE_LOW_WATER,
+                 transport: str = 'streams', batch_window: float = BATCH_WINDOW, batch_max_size: int = BATCH_MAX_SIZE,
+                 log=print):
         self._loop = loop
-        self._link = AbridgedTCP(loop, host, port)
+        self._log = log
+        self._host = host
+        self._port = port
+        self._link = tcp.transports[transport](loop, host, port, high_water=write_high_water, low_water=write_low_water)
+        self._link_settings = dict(
+            write_high_water=write_high_water, write_low_water=write_low_water, transport=transport,
+            batch_window=batch_window, batch_max_size=batch_max_size
+        )
+        self._public_rsa_key_data = public_rsa_key
         self._public_rsa_key = encryption.PublicRSA(public_rsa_key)
         self._auth_key = None
         self._auth_key_id = None
         self._auth_key_lock = asyncio.Lock()
+        self._auth_key_source = None  # a connection of the same session that provides the auth key
         self._read_message_lock = asyncio.Lock()
         self._session_id = secrets.randbits(64)
         self._client_salt = int.from_bytes(secrets.token_bytes(4), 'little', signed=True)
         self._server_salt = 0
+        self._future_salts = []  # (valid_since, valid_until, salt) sorted by valid_since, shared by the connections
         self._last_message_id = 0
+        self._time_offset = 0.0  # server time minus local time in seconds, message ids and salts use server time
+        self._sent_containers = dict()  # msg_id of a recent container -> msg_ids of its messages
         self._executor = _get_executor()
-        self._scheme = _get_scheme(self._in_thread)
+        # a connection may be given the scheme of a previous one to stay on its layer
+        self._scheme = scheme if scheme is not None else _get_scheme(loop)
+        self._gzip_threshold = gzip_threshold
+        self._batch_window = batch_window
+        self._batch_max_size = batch_max_size
+        self._outbox = []  # (message_id, seq_no, body, compress) waiting to be sent
+        self._outbox_size = 0
+        self._outbox_compress = False  # some body in the outbox is to be compressed
+        self._outbox_flush = None  # a scheduled flush of the outbox
+        self._last_write = None  # the next batch is sent after this one
+        self._write_tasks = set()
+        self._batch_counters = dict(containers=0, contained_messages=0)
+        if gzip_max_size is not None:
+            # the scheme is shared, so is the limit
+            self._scheme.gzip_max_size = gzip_max_size
 
 
     async def _in_thread(self, *args, **kwargs):
         return await self._loop.run_in_executor(self._executor, *args, **kwargs)
 
+    # CPU bound functions with small arguments go to the process pool when it's enabled
+    async def _in_process(self, *args):
+        if _process_executor is None:
+            return await self._in_thread(*args)
+        return await self._loop.run_in_executor(_process_executor, *args)
+
+    # encrypts or decrypts data into out[offset:], large buffers are passed to a worker process via shared memory
+    async def _crypt(self, crypt_into, auth_key: bytes, msg_key: bytes, data, out, offset: int = 0):
+        length = len(data)
+        if _process_executor is None or length < _process_pool_min_size:
+            return await self._in_thread(crypt_into, auth_key, msg_key, data, out, offset)
+        from multiprocessing.shared_memory import SharedMemory  # Python 3.8+, checked by enable_process_pool
+        shared_memory = SharedMemory(create=True, size=length)
+        try:
+            shared_memory.buf[:length] = data
+            await self._loop.run_in_executor(
+                _process_executor, _crypt_shared_memory, crypt_into, shared_memory.name, length, auth_key, msg_key
+            )
+            out[offset:offset + length] = shared_memory.buf[:length]
+        finally:
+            shared_memory.close()
+            shared_memory.unlink()
+
+    def _get_server_time(self):
+        return time.time() + self._time_offset
+
     def _get_message_id(self):
-        message_id = (int(time.time() * 2 ** 30) | secrets.randbits(12)) * 4
+        message_id = (int(self._get_server_time() * 2 ** 30) | secrets.randbits(12)) * 4
         if message_id <= self._last_message_id:
             message_id = self._last_message_id + 4
         self._last_message_id = message_id
@@ -90,10 +319,32 @@ class MTProto:
 
     async def _get_auth_key(self):
         async with self._auth_key_lock:
-            if self._auth_key is None:
-                await self._create_auth_key()
+            if self._auth_key is None and self._auth_key_source is not None:
+                # the salt is valid for the auth key, every connection keeps updating its own copy
+                self._auth_key, self._auth_key_id = await self._auth_key_source._get_auth_key()
+                self._server_salt = self._auth_key_source.get_server_salt()
+                self._time_offset = self._auth_key_source.get_time_offset()
+            elif self._auth_key is None:
+                pooled_auth_key = _pop_pooled_auth_key(self._loop, self._host, self._port, self._public_rsa_key_data)
+                if pooled_auth_key is not None:
+                    self._auth_key, self._server_salt, self._time_offset = pooled_auth_key
+                    self._set_auth_key_id()
+                else:
+                    await self._create_auth_key()
         return self._auth_key, self._auth_key_id
 
+    # primality of a new DH prime is checked by a worker process, primes that passed are remembered by this one
+    async def _is_safe_dh_prime(self, g: int, dh_prime: int) -> bool:
+        if not primes.is_dh_generator(g, dh_prime):
+            return False
+        if primes.is_known_safe_dh_prime(dh_prime):
+            return True
+        if not await self._in_process(primes.is_safe_prime, dh_prime):
+            return False
+        self._log('the server has changed the DH prime, the new one %X is a safe prime' % dh_prime)
+        primes.remember_safe_dh_prime(dh_prime)
+        return True
+
     async def _create_auth_key(self):
         generate_b = self._loop.create_task(self._in_thread(secrets.randbits, 2048))
         nonce = await self._in_thread(secrets.token_bytes, 16)
@@ -111,7 +362,7 @@ class MTProto:
 
         new_nonce, (p, q) = await asyncio.gather(
             self._in_thread(secrets.token_bytes, 32),
-            self._in_thread(primes.factorize, pq)
+            self._in_process(primes.factorize, pq)
         )
 
         p_string = to_bytes(p)
@@ -143,8 +394,9 @@ class MTProto:
             raise RuntimeError("Diffie–Hellman exchange failed: `%r`", params)
 
         # https://core.telegram.org/mtproto/auth_key#presenting-proof-of-work-server-authentication
-        tmp_aes_key = sha1(new_nonce + server_nonce) + sha1(server_nonce + new_nonce)[:12]
-        tmp_aes_iv = sha1(server_nonce + new_nonce)[12:] + sha1(new_nonce + new_nonce) + new_nonce[:4]
+        # everything derived from new_nonce and the auth key is secret, it's kept out of the shared caches
+        tmp_aes_key = sha1.uncached(new_nonce + server_nonce) + sha1.uncached(server_nonce + new_nonce)[:12]
+        tmp_aes_iv = sha1.uncached(server_nonce + new_nonce)[12:] + sha1.uncached(new_nonce + new_nonce) + new_nonce[:4]
 
         tmp_aes = encryption.AesIge(tmp_aes_key, tmp_aes_iv)
         answer, b = await asyncio.gather(
@@ -154,25 +406,29 @@ class MTProto:
 
         params2 = await self._scheme.read_from_string(answer)
 
-        # FIXME! save server_time
-        # print(params2.server_time)
-        # print(time.time())
-
         if params2 != 'server_DH_inner_data':
             raise RuntimeError("Diffie–Hellman exchange failed: `%r`", params2)
 
+        # the first estimate, it's refined with ids of incoming messages
+        self._time_offset = params2.server_time - time.time()
+
         dh_prime = int.from_bytes(params2.dh_prime, 'big')
         g = params2.g
         g_a = int.from_bytes(params2.g_a, 'big')
         if (params2.nonce != nonce
             or params2.server_nonce != server_nonce
-            or not primes.is_safe_dh_prime(g, dh_prime)):
+            or not await self._is_safe_dh_prime(g, dh_prime)
+            or not primes.is_good_dh_value(g_a, dh_prime)):
             raise RuntimeError("Diffie–Hellman exchange failed: `%r`", params2)
 
-        g_b, self._auth_key = map(to_bytes, await asyncio.gather(
-            self._in_thread(pow, g, b, dh_prime),
-            self._in_thread(pow, g_a, b, dh_prime)
-        ))
+        g_b, auth_key = await asyncio.gather(
+            self._in_process(pow, g, b, dh_prime),
+            self._in_process(pow, g_a, b, dh_prime)
+        )
+        # happens with probability around 2 ** -63, a new handshake is cheaper than a second code path
+        if not primes.is_good_dh_value(g_b, dh_prime):
+            raise RuntimeError("Diffie–Hellman exchange failed: g_b is out of the safe range")
+        g_b, self._auth_key = to_bytes.uncached(g_b), to_bytes.uncached(auth_key)
         self._set_auth_key_id()
         self._server_salt = int.from_bytes(xor(new_nonce[:8], server_nonce[:8]), 'little', signed=True)
 
@@ -198,65 +454,283 @@ class MTProto:
             raise RuntimeError("Diffie–Hellman exchange failed: `%r`", params3)
 
     def _set_auth_key_id(self):
-        self._auth_key_id = sha1(self._auth_key)[-8:]
+        self._auth_key_id = sha1.uncached(self._auth_key)[-8:]
 
     async def read(self):
         auth_key, auth_key_id = await self._get_auth_key()
         async with self._read_message_lock:
-            server_auth_key_id = await self._link.read(8)
-            if server_auth_key_id != auth_key_id:
-                raise RuntimeError("Received a message with unknown auth_key!", server_auth_key_id)
-            msg_key = await self._link.read(16)
-            aes = await self._in_thread(encryption.prepare_key_to_read, auth_key, msg_key)
-            decryptor = aes.decrypt_async_stream(self._loop, self._executor, self._link.read)
-            message = await self._scheme.read(decryptor, is_boxed=False, parameter_type='message_inner_data')
-            #FIXME check session_id and salt
-            return message.message
+            # encrypted_message: auth_key_id:ulong msg_key:int128 encrypted_data:encrypted
+            frame = await self._link.read_frame()
+        if len(frame) == 4:
+            raise RuntimeError("Received transport error %d" % int.from_bytes(frame, 'little', signed=True))
+        # the frame is a memoryview of the receive buffer
+        server_auth_key_id = bytes(frame[:8])
+        if server_auth_key_id != auth_key_id:
+            raise RuntimeError("Received a message with unknown auth_key!", server_auth_key_id)
+        msg_key = bytes(frame[8:24])
+        encrypted_data = frame[24:]
+        plain = bytearray(len(encrypted_data))
+        if _process_executor is None or len(encrypted_data) < _process_pool_min_size:
+            message = await self._in_thread(_open_message, auth_key, msg_key, encrypted_data, plain, self._scheme)
+        else:
+            await self._crypt(_decrypt_message_into, auth_key, msg_key, encrypted_data, plain)
+            message = await self._in_thread(_unpack_message, self._scheme, plain)
+        #FIXME check session_id and salt
+        # a server message id is the time it was made by the server clock, the latest one gives the offset
+        # even when it's lower than before, bad_msg_notification 16 and 17 set it with correct_time()
+        self._time_offset = message.msg_id / 2 ** 32 - time.time()
+        return message
 
     def set_session(self, auth_key: str, session_id: int):
-        self._auth_key = base64decode(auth_key)
+        self._auth_key = base64decode.uncached(auth_key)
         self._session_id = session_id
         self._set_auth_key_id()
 
     def get_session(self):
-        return base64encode(self._auth_key), self._session_id
+        return base64encode.uncached(self._auth_key), self._session_id
+
+    def get_session_id(self):
+        return self._session_id
+
+    # another TCP connection with the same auth key and a session of its own: session_id, message ids and salt
+    def connect_another(self):
+        other = MTProto(
+            self._loop, self._host, self._port, self._public_rsa_key_data,
+            gzip_threshold=self._gzip_threshold, scheme=self._scheme, log=self._log, **self._link_settings
+        )
+        other._auth_key_source = self
+        other._future_salts = self._future_salts
+        return other
+
+    def get_time_offset(self) -> float:
+        return self._time_offset
+
+    def set_time_offset(self, time_offset: float):
+        self._time_offset = time_offset
+
+    # https://core.telegram.org/mtproto/service_messages_about_messages#notice-of-ignored-error-message
+    # after bad_msg_notification 16 or 17 the clock is set by the id of the notification
+    def correct_time(self, server_msg_id: int):
+        self._time_offset = server_msg_id / 2 ** 32 - time.time()
+        # the next ids follow the corrected clock, even when it's behind the last one
+        self._last_message_id = 0
+
+    # a rejected container stands for the messages in it
+    def get_contained_message_ids(self, msg_id: int) -> list:
+        return self._sent_containers.get(msg_id, [msg_id])
 
+    # the salt from bad_server_salt or new_session_created, the schedule is wrong then and gets fetched again
     def set_server_salt(self, salt: int):
         self._server_salt = salt
+        self._future_salts.clear()
 
     def get_server_salt(self):
-        return self._server_salt
+        now = self._get_server_time()
+        salts = [salt for salt in self._future_salts if salt[0] <= now < salt[1]]
+        if not salts:
+            return self._server_salt
+        # the newest salt once it's valid for a while, or any other rather than an expiring one
+        for valid_since, valid_until, salt in reversed(salts):
+            if valid_since + SALT_SWITCH_MARGIN <= now and now < valid_until - SALT_SWITCH_MARGIN:
+                return salt
+        return salts[-1][2]
+
+    # salts is a list of (valid_since, valid_until, salt) from future_salts
+    def set_future_salts(self, salts: list):
+        now = self._get_server_time()
+        # the list is updated in place, it's shared with the other connections
+        self._future_salts[:] = sorted(salt for salt in map(tuple, salts) if salt[1] > now)
+
+    def get_future_salts(self) -> list:
+        return list(self._future_salts)
+
+    def needs_future_salts(self) -> bool:
+        now = self._get_server_time()
+        return sum(1 for _, valid_until, _ in self._future_salts if valid_until - SALT_SWITCH_MARGIN > now) < FUTURE_SALTS_MIN
+
+    def get_scheme(self):
+        return self._scheme
+
+    def get_gzip_counters(self) -> dict:
+        return self._scheme.gzip_counters.get_dict()
 
     def write(self, seq_no: int, **kwargs):
         message_id = self._get_message_id()
-        message = self._scheme.bare(
-            _cons='message',
-            msg_id=message_id,
-            seqno=seq_no,
-            body=self._scheme.boxed(**kwargs)
+        body = self._scheme.boxed(**kwargs)
+        size = body.get_size()
+        # content-related messages have odd seqno
+        compress = (
+            self._gzip_threshold is not None and size >= self._gzip_threshold
+            and seq_no & 1 == 1 and kwargs['_cons'] not in _SERVICE_CONSTRUCTORS
         )
-        self._loop.create_task(self._write(message))
+        self._outbox.append((message_id, seq_no, body, compress))
+        self._outbox_size += size
+        self._outbox_compress = self._outbox_compress or compress
+        if self._outbox_size >= self._batch_max_size or len(self._outbox) >= BATCH_MAX_MESSAGES:
+            self._flush_outbox()
+        elif self._outbox_flush is None:
+            if self._batch_window > 0:
+                self._outbox_flush = self._loop.call_later(self._batch_window, self._flush_outbox)
+            else:
+                self._outbox_flush = self._loop.call_soon(self._flush_outbox)
         return message_id
 
-    async def _write(self, message):
+    def _flush_outbox(self):
+        if self._outbox_flush is not None:
+            self._outbox_flush.cancel()
+            self._outbox_flush = None
+        if self._outbox:
+            messages, size, compress = self._outbox, self._outbox_size, self._outbox_compress
+            self._outbox, self._outbox_size, self._outbox_compress = [], 0, False
+            task = self._loop.create_task(self._write(messages, size, compress, self._last_write))
+            self._last_write = task
+            self._write_tasks.add(task)
+            task.add_done_callback(self._write_tasks.discard)
+
+    # waits for the auth key, message ids follow the server clock learnt with it,
+    # and while the connection is paused by a backlog of unsent data
+    async def wait_writable(self):
+        await self._get_auth_key()
+        await self._link.wait_writable()
+
+    def get_link_counters(self):
+        return dict(self._link.get_counters(), **self._batch_counters)
+
+    async def _write(self, messages: list, size: int, compress: bool, previous_write):
+        # nothing is compressed, serialized or encrypted while the connection is paused
+        await self._link.wait_writable()
         auth_key, auth_key_id = await self._get_auth_key()
-        message_inner_data = self._scheme.bare(
-            _cons='message_inner_data',
-            salt=self._server_salt,
-            session_id=self._session_id,
-            message=message
-        ).get_flat_bytes()
-        msg_key = (await self._in_thread(sha1, message_inner_data))[4:20]
-        aes = await self._in_thread(encryption.prepare_key_to_write, auth_key, msg_key)
-        encrypted_message = await self._in_thread(aes.encrypt, message_inner_data)
-        full_message = self._scheme.bare(
-            _cons='encrypted_message',
-            auth_key_id=int.from_bytes(auth_key_id, 'little', signed=False),
-            msg_key=msg_key,
-            encrypted_data=encrypted_message
-        ).get_flat_bytes()
+        container_id = None
+        if len(messages) > 1:
+            container_id = self._get_message_id()
+            self._sent_containers[container_id] = [message_id for message_id, _, _, _ in messages]
+            if len(self._sent_containers) > SENT_CONTAINERS_KEPT:
+                del self._sent_containers[next(iter(self._sent_containers))]
+            self._batch_counters['containers'] += 1
+            self._batch_counters['contained_messages'] += len(messages)
+        serialize_args = (self._scheme, messages, container_id, self.get_server_salt(), self._session_id)
+        if size < _inline_send_max_size and not compress:
+            # a hop to the executor costs more than the whole job, gzip doesn't run in the loop though
+            full_message = _seal_messages(auth_key, auth_key_id, *serialize_args)
+        elif _process_executor is None or size < _process_pool_min_size:
+            full_message = await self._in_thread(_seal_messages, auth_key, auth_key_id, *serialize_args)
+        else:
+            plain, msg_key = await self._in_thread(_serialize_messages, *serialize_args)
+            full_message = _new_encrypted_message(auth_key_id, msg_key, len(plain))
+            await self._crypt(_encrypt_message_into, auth_key, msg_key, plain, full_message, 24)
+        # batches are sealed concurrently, but sent in the order they were flushed
+        if previous_write is not None:
+            await asyncio.wait((previous_write,))
         await self._link.write(full_message)
 
     async def stop(self):
+        # messages written before stop are sent
+        self._flush_outbox()
+        await asyncio.gather(*self._write_tasks, return_exceptions=True)
         await self._link.stop()
-        pass
+
+
+# the refill interval doubles with every handshake failed in a row, up to this many seconds
+AUTH_KEY_POOL_MAX_RETRY = 300.0
+
+
+# auth keys are created in the background, so that new sessions don't wait for Diffie–Hellman exchange
+class AuthKeyPool:
+    def __init__(self, loop, host: str, port: int, public_rsa_key: str,
+                 size: int, refill_interval: float, lifetime: float, log=print):
+        self._loop = loop
+        self._host = host
+        self._port = port
+        self._public_rsa_key = public_rsa_key
+        self._size = size
+        self._refill_interval = refill_interval  # seconds between handshakes
+        self._lifetime = lifetime  # unused keys are dropped after this many seconds
+        self._log = log
+        self._auth_keys = []  # (created_at, auth_key, server_salt, time_offset), the oldest first
+        self._refill_task = None
+        self._refill_timer = None  # the next refill, when a key expires or after failed handshakes
+        self._failures = 0  # handshakes failed in a row
+
+    def __len__(self):
+        self._drop_expired()
+        return len(self._auth_keys)
+
+    def _drop_expired(self):
+        expire_before = time.time() - self._lifetime
+        while self._auth_keys and self._auth_keys[0][0] < expire_before:
+            self._auth_keys.pop(0)
+
+    def start(self):
+        self._cancel_refill_timer()
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = self._loop.create_task(self._refill())
+
+    def stop(self):
+        self._cancel_refill_timer()
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+
+    def _cancel_refill_timer(self):
+        if self._refill_timer is not None:
+            self._refill_timer.cancel()
+            self._refill_timer = None
+
+    # a DC that keeps failing is tried less and less often
+    def _get_retry_delay(self) -> float:
+        delay = self._refill_interval * 2 ** min(self._failures, 16)
+        return max(self._refill_interval, min(delay, AUTH_KEY_POOL_MAX_RETRY))
+
+    # returns (auth_key, server_salt, time_offset) or None when the pool is empty
+    def pop(self):
+        self._drop_expired()
+        self.start()
+        if not self._auth_keys:
+            return None
+        _, auth_key, server_salt, time_offset = self._auth_keys.pop()
+        return auth_key, server_salt, time_offset
+
+    async def _refill(self):
+        while len(self) < self._size:
+            mtproto = MTProto(self._loop, self._host, self._port, self._public_rsa_key, log=self._log)
+            try:
+                await mtproto._create_auth_key()
+                self._auth_keys.append((time.time(), mtproto._auth_key, mtproto._server_salt, mtproto._time_offset))
+                self._failures = 0
+            except Exception as error:
+                # a broken handshake must not stop the refill, the next one is tried after a growing delay
+                self._failures += 1
+                self._log("could not create a pooled auth key for %s:%d, retrying in %g seconds: %r" % (
+                    self._host, self._port, self._get_retry_delay(), error
+                ))
+            finally:
+                await mtproto.stop()
+            await asyncio.sleep(self._get_retry_delay())
+        # expired keys are replaced as well
+        if self._auth_keys:
+            self._refill_timer = self._loop.call_later(
+                max(0.0, self._auth_keys[0][0] + self._lifetime - time.time()), self.start
+            )
+
+
+_auth_key_pool_settings = None
+_auth_key_pools = dict()  # (host, port) -> AuthKeyPool
+
+
+# pools are created for every DC upon the first connection to it
+def enable_auth_key_pools(size: int, refill_interval: float = 1.0, lifetime: float = 3600.0, log=print):
+    global _auth_key_pool_settings
+    _auth_key_pool_settings = dict(size=size, refill_interval=refill_interval, lifetime=lifetime, log=log)
+
+
+def get_auth_key_pool(loop, host: str, port: int, public_rsa_key: str):
+    if _auth_key_pool_settings is None:
+        return None
+    if (host, port) not in _auth_key_pools:
+        pool = _auth_key_pools[host, port] = AuthKeyPool(loop, host, port, public_rsa_key, **_auth_key_pool_settings)
+        pool.start()
+    return _auth_key_pools[host, port]
+
+
+def _pop_pooled_auth_key(loop, host: str, port: int, public_rsa_key: str):
+    pool = get_auth_key_pool(loop, host, port, public_rsa_key)
+    return pool.pop() if pool is not None else None
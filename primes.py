@@ -8,8 +8,6 @@ __email__ = "nikita@miropolskiy.com"
 __license__ = "https://creativecommons.org/licenses/by-nc-nd/4.0/legalcode"
 
 
-# TODO: implement is_safe_dh_prime as described here:
-# https://core.telegram.org/mtproto/auth_key#presenting-proof-of-work-server-authentication
 # TODO: tests
 
 import random
@@ -20,39 +18,81 @@ from byteutils import sha256
 
 # Pollard-Rho-Brent integer factorization
 # https://comeoncodeon.wordpress.com/2010/09/18/pollard-rho-brent-integer-factorization/
+# differences are multiplied in batches of _brent_batch_size and gcd is taken once per batch,
+# a batch that overshoots the factor is repeated step by step from its start
+_brent_batch_size = 128
+
+
 def _brent(N):
     if N % 2 == 0:
         return 2
-    y, c, m = random.randint(1, N - 1), random.randint(1, N - 1), random.randint(1, N - 1)
+    gcd = math.gcd
+    y, c = random.randint(1, N - 1), random.randint(1, N - 1)
+    m = _brent_batch_size
     g, r, q = 1, 1, 1
     while g == 1:
         x = y
-        for i in range(r):
-            y = ((y * y) % N + c) % N
+        for _ in range(r):
+            y = (y * y + c) % N
         k = 0
         while k < r and g == 1:
             ys = y
-            for i in range(min(m, r - k)):
-                y = ((y * y) % N + c) % N
-                q = q * (abs(x - y)) % N
-            g = math.gcd(q, N)
-            k = k + m
-        r = r * 2
+            for _ in range(min(m, r - k)):
+                y = (y * y + c) % N
+                q = q * (x - y) % N
+            g = gcd(q, N)
+            k += m
+        r <<= 1
     if g == N:
         while True:
-            ys = ((ys * ys) % N + c) % N
-            g = math.gcd(abs(x - ys), N)
+            ys = (ys * ys + c) % N
+            g = gcd(x - ys, N)
             if g > 1:
                 break
-
     return g
 
 
 def factorize(pq: int):
     p = _brent(pq)
+    while p == pq:  # unlucky random constants, retry
+        p = _brent(pq)
     q = pq//p
     return min(p, q), max(p, q)
 
+
+_small_primes = (3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67, 71, 73, 79, 83, 89, 97)
+
+
+# Miller-Rabin probabilistic primality test
+def is_probable_prime(n: int, rounds: int = 32) -> bool:
+    if n < 2:
+        return False
+    if n in (2,) + _small_primes:
+        return True
+    if n % 2 == 0 or any(n % p == 0 for p in _small_primes):
+        return False
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d, s = d >> 1, s + 1
+    for _ in range(rounds):
+        x = pow(random.randint(2, n - 2), d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def generate_prime(bits: int) -> int:
+    while True:
+        n = random.getrandbits(bits) | 1 << (bits - 1) | 1
+        if is_probable_prime(n):
+            return n
+
 _C7_prime = int('C71CAEB9C6B1C9048E6C522F70F13F73980D40238E3E21C14934D037563D930F'
                 '48198A0AA7C14058229493D22530F4DBFA336F6E0AC925139543AED44CCE7C37'
                 '20FD51F69458705AC68CD4FE6B6B13ABDC9746512969328454F18FAF8C595F64'
@@ -63,16 +103,76 @@ _C7_prime = int('C71CAEB9C6B1C9048E6C522F70F13F73980D40238E3E21C14934D037563D930
                 '0D8115F635B105EE2E4E15D04B2454BF6F4FADF034B10403119CD8E3B92FCC5B', 16)
 
 
+# g generates a cyclic subgroup of prime order (p - 1) / 2 when p satisfies these conditions
+_dh_generator_conditions = {
+    2: lambda p: p % 8 == 7,
+    3: lambda p: p % 3 == 2,
+    4: lambda p: True,
+    5: lambda p: p % 5 in (1, 4),
+    6: lambda p: p % 24 in (19, 23),
+    7: lambda p: p % 7 in (3, 5, 6),
+}
+
+# checking primality of a 2048-bit number takes a while, primes that passed the checks are remembered
+_safe_dh_primes = {_C7_prime}
+
+
+# https://core.telegram.org/mtproto/auth_key#presenting-proof-of-work-server-authentication
+def is_dh_generator(g, n):
+    return g in _dh_generator_conditions and _dh_generator_conditions[g](n)
+
+
+def is_known_safe_dh_prime(n):
+    return n in _safe_dh_primes
+
+
+def remember_safe_dh_prime(n):
+    _safe_dh_primes.add(n)
+
+
+# the slow part, it keeps no state so that it can run in a worker process
+def is_safe_prime(n):
+    return 2 ** 2047 < n < 2 ** 2048 and is_probable_prime(n) and is_probable_prime((n - 1) // 2)
+
+
 def is_safe_dh_prime(g, n):
-    if g != 3:
+    if not is_dh_generator(g, n):
         return False
-    if n == _C7_prime:
+    if is_known_safe_dh_prime(n):
         return True
-    print('The server has changed the DH_prime number. This is suspicious. '
-          'Lets stop now and check this manually, later. New DH_prime = %X' % n)
-    return False
+    if not is_safe_prime(n):
+        return False
+    remember_safe_dh_prime(n)
+    return True
+
+
+# g_a and g_b must stay 2 ** (2048 - 64) away from both ends, as the spec recommends
+_dh_value_margin = 2 ** (2048 - 64)
+
+
+# https://core.telegram.org/mtproto/auth_key#dh-key-exchange-complete
+def is_good_dh_value(value, n):
+    return 1 < value < n - 1 and _dh_value_margin <= value <= n - _dh_value_margin
 
 
 # tests
 if __name__ == '__main__':
-    pass
+    import time
+
+    if not is_safe_dh_prime(3, _C7_prime) or is_safe_dh_prime(3, _C7_prime + 2) or is_safe_dh_prime(2, _C7_prime):
+        raise RuntimeError("is_safe_dh_prime is wrong")
+
+    if (not is_good_dh_value(pow(3, random.getrandbits(2048), _C7_prime), _C7_prime)
+            or any(is_good_dh_value(v, _C7_prime) for v in (1, 2 ** 1983, _C7_prime - 1, _C7_prime - 2 ** 1983))):
+        raise RuntimeError("is_good_dh_value is wrong")
+
+    # pq is a product of two distinct primes less than 2 ** 32, as in req_pq
+    pqs = []
+    for _ in range(50):
+        p, q = generate_prime(31), generate_prime(32)
+        pqs.append((p * q, min(p, q), max(p, q)))
+    started = time.perf_counter()
+    for pq, p, q in pqs:
+        if factorize(pq) != (p, q):
+            raise RuntimeError("factorize(%d) is wrong" % pq)
+    print('factorize: %.2f ms per pq' % ((time.perf_counter() - started) / len(pqs) * 1000))
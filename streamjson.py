@@ -20,44 +20,86 @@ More info: https://bitbucket.org/mtproto2json/mtproto2json/overview
 '''
 
 
+import functools
 import json
 import sys
 import argparse
 import asyncio
+import re
+import secrets
+import signal
 import traceback
 
 
+import byteutils
 import mtproto
+import tcp
+import tl
 
 from localsettings import TELEGRAM_HOST, TELEGRAM_PORT, TELEGRAM_RSA
 
+def log(source, message):
+    print(str(datetime.datetime.now()), source, message, file=sys.stdout)
+
+
 class PendingRequest():
     def __init__(self, loop, message):
         self.request = message
         self.response = loop.create_future()
 
-class Session:
-    def __init__(self, reader, writer, peername, loop, args):
-        self._peername = peername
-        self._mtproto = None
-        self._json_in = reader
-        self._json_out = writer
-        self._loop = loop
-        self._print_objects = args.print_objects
-        self._print_tracebacks = args.print_tracebacks
-        self._send_tracebacks = args.send_tracebacks
+# requests of these methods go to media connections, so that big files don't delay interactive requests
+MEDIA_METHOD_PREFIXES = ('upload.',)
+
+# https://core.telegram.org/api/errors#303-see-other
+# the account is in another DC: the session moves there, files and stats: the request goes to the other DC
+# TL strings are received as bytes
+_MIGRATE_ERROR = re.compile(rb'^(PHONE|NETWORK|USER|FILE|STATS)_MIGRATE_(\d+)$')
+_HOME_MIGRATE_ERRORS = (b'PHONE', b'NETWORK', b'USER')
+FILE_DCS_KEPT = 1024  # file locations with a known DC
+FUTURE_SALTS_TIMEOUT = 60  # seconds, get_future_salts without an answer is sent again with the next request
+
+
+# the query inside invokeWithLayer, initConnection, invokeWithoutUpdates and other wrappers
+def _unwrap_query(message: dict) -> dict:
+    while isinstance(message.get('_wrapped'), dict):
+        message = message['_wrapped']
+    return message
+
+
+class Connection:
+    """One MTProto connection of a session: session_id, salt, seqno, acknowledgements and pending requests are its own
+    """
+    def __init__(self, session, mtproto_connection, kind):
+        self._session = session
+        self._loop = session._loop
+        self.mtproto = mtproto_connection
+        self.kind = kind  # 'interactive', 'media', 'any' or 'foreign' for the one connection to another DC
         self._msgids_to_ack = []
         self._last_time_acks_flushed = time.time()
         self._last_seqno = 0
         self._stable_seqno = False
         self._seqno_increment = 1
-        self._mtproto_loop = None
-        self._mtproto_read_future = None
         self._pending_requests = dict()
-        self._future_flood_wait = None
-        self._host = TELEGRAM_HOST
-        self._port = TELEGRAM_PORT
-        self._rsa = TELEGRAM_RSA
+        self._waiting_requests = 0  # requests waiting for the auth key or a paused connection, they aren't sent yet
+        self._future_salts_msg_id = None  # get_future_salts waiting for an answer
+        self._future_salts_connects = 0  # the TCP connection it was sent over, the answer never comes over another one
+        self._mtproto_read_future = None
+        self._stopped = False
+        self._mtproto_loop = self._loop.create_task(self.mtproto_loop())
+
+    def get_load(self):
+        return len(self._pending_requests) + self._waiting_requests
+
+    def get_counters(self):
+        return dict(
+            kind=self.kind,
+            session_id=self.mtproto.get_session_id(),
+            pending_requests=len(self._pending_requests),
+            link=self.mtproto.get_link_counters()
+        )
+
+    def log(self, message):
+        self._session.log(message)
 
     def _get_next_odd_seqno(self):
         self._last_seqno = ((self._last_seqno + 1) // 2) * 2 + 1
@@ -67,88 +109,50 @@ class Session:
         self._last_seqno = (self._last_seqno//2 + 1) * 2
         return self._last_seqno
 
-    def log(self, message):
-        print(str(datetime.datetime.now()), self._peername, message, file=sys.stdout)
-
-    async def receive_line(self, line: bytes) -> bool:
-        if line in (b'\n', '\n'):
-            return True
-        try:
-            request = json.loads(line, encoding='utf-8')
-        except json.JSONDecodeError as exception:
-            self.write_json(id=-2, error='JSONDecodeError', msg=exception.msg, pos=exception.pos, doc=line.decode('utf-8'))
-            return False
-        if self._print_objects:
-            self.log('> %s' % line.decode('utf-8')[:-1])
-        try:
-            await self.receive_json(request)
-        except Exception:
-            etype, evalue, tb = sys.exc_info()
-            traceback.print_exception(etype, evalue, tb if self._print_tracebacks else None, file=sys.stderr)
-            response = dict(id=request.get('id', -3), error=etype.__name__, msg=' '.join(getattr(evalue, 'args', ())))
-            if self._send_tracebacks:
-                response['traceback'] = traceback.format_tb(tb)
-            self.write_json(**response)
-            return False
-        return True
-
-    def start_mtproto_loop(self):
-        self._seq_no = -1
-        if self._mtproto is not None:
-            self._mtproto_loop.cancel()
-            self._mtproto = None
-        self.log("connecting to Telegram at %s:%d" % (self._host, self._port))
-        self._mtproto_loop = self._loop.create_task(self.mtproto_loop())
-        self._mtproto = mtproto.MTProto(self._loop, self._host, self._port, self._rsa)
-
-    def _handle_json_server(self, rserver):
-        if 'host' in rserver:
-            self._host = rserver['host']
-            self._port = server['port']
-            self._rsa = server['rsa']
-        return dict(
-            host=self._host,
-            port=self._port,
-            rsa=self._rsa
-        )
-
-    def _handle_json_session(self, session):
-        if self._mtproto is None:
-            self.start_mtproto_loop()
-        if 'auth_key' in session:
-            auth_key = session['auth_key']
-            session_id = session['session_id']
-            self._mtproto.set_session(auth_key, session_id)
-            return dict(status="ok")
-        try:
-            auth_key, session_id = self._mtproto.get_session()
-        except TypeError:
-            return dict(error_message="no session found, please provide your session or send a message to create a new one")
-        return dict(
-            session_id=session_id,
-            auth_key=auth_key,
-        )
-
     def _delete_pending_request(self, msg_id):
         if msg_id in self._pending_requests:
             print("Timeout, no rpc_response, I am deleting this:", self._pending_requests[msg_id].request)
             self._pending_requests[msg_id].response.set_result(dict(_cons='rpc_timeout', error_message='no response from telegram'))
 
-    async def _handle_json_message(self, message):
-        if self._mtproto is None:
-            self.start_mtproto_loop()
-        if '_cons' not in message:
-            raise RuntimeError('`_cons` attribute is required in message object')
-        pending_request = PendingRequest(self._loop, message)
-        return await self._rpc_call(pending_request)
+    def _forget_future_salts_request(self, msg_id):
+        if self._future_salts_msg_id == msg_id:
+            self._future_salts_msg_id = None
 
-    async def _rpc_call(self, pending_request):
+    # salts are fetched ahead of time by the first connection of the auth key, the schedule is shared with the others
+    def _request_future_salts_if_needed(self):
+        connects = self.mtproto.get_link_counters()['connects']
+        if self._future_salts_msg_id is not None and self._future_salts_connects == connects:
+            return
+        if self.kind != 'foreign' and self._session._connections[:1] != [self]:
+            return
+        if self.mtproto.needs_future_salts():
+            seqno = self._get_next_odd_seqno()
+            self._future_salts_msg_id = self.mtproto.write(seqno, _cons='get_future_salts', num=mtproto.FUTURE_SALTS_NUMBER)
+            # a new link connects when the message is sent
+            self._future_salts_connects = max(connects, 1)
+            self._loop.call_later(FUTURE_SALTS_TIMEOUT, self._forget_future_salts_request, self._future_salts_msg_id)
+
+    async def rpc_call(self, pending_request):
+        self._waiting_requests += 1
+        try:
+            await self._session._flood_sleep()
+            await self.mtproto.wait_writable()
+        finally:
+            self._waiting_requests -= 1
+        if self._stopped:
+            # the session moved on while the request waited
+            self._session._resend_pending_requests([pending_request])
+            return await pending_request.response
         self._flush_msgids_to_ack()
+        self._request_future_salts_if_needed()
         seqno = self._get_next_odd_seqno()
-        if self._print_objects:
-            self.log("^ %r" % dict(_cons='message', seqno=seqno, body=pending_request.request))
-        await self._flood_sleep()
-        message_id = self._mtproto.write(seqno, **pending_request.request)
+        request = pending_request.request
+        if self.kind in ('media', 'foreign'):
+            # updates are delivered to the interactive connection only
+            request = dict(_cons='invokeWithoutUpdates', _wrapped=request)
+        if self._session._print_objects:
+            self.log("^ %r" % dict(_cons='message', seqno=seqno, body=request))
+        message_id = self.mtproto.write(seqno, **request)
         self._pending_requests[message_id] = pending_request
         self._loop.call_later(600, self._delete_pending_request, message_id)
         response = await pending_request.response
@@ -157,34 +161,11 @@ class Session:
             del self._pending_requests[message_id]
         return response
 
-    async def receive_json(self, request):
-        response = dict(id=request.get('id', 1))
-        if 'server' in request:
-            response['server'] = self._handle_json_server(request['server'])
-        if 'session' in request:
-            response['session'] = self._handle_json_session(request['session'])
-        if 'message' in request:
-            response['message'] = await self._handle_json_message(request['message'])
-        self.write_json(**response)
-
-    async def read_loop(self):
-        self.log('connected')
-        while True:
-            try:
-                line = await self._json_in.readline()
-            except ConnectionResetError:
-                self.disconnect()
-                return
-            if line is b'':
-                self.disconnect()
-                return
-            await self.receive_line(line)
-
     async def mtproto_loop(self):
         self.log("mtproto loop started")
         while True:
             try:
-                self._mtproto_read_future = self._loop.create_task(self._mtproto.read())
+                self._mtproto_read_future = self._loop.create_task(self.mtproto.read())
                 message_mtproto = await self._mtproto_read_future
                 self._process_telegram_message(message_mtproto)
                 if len(self._msgids_to_ack) >= 32 or (time.time() - self._last_time_acks_flushed) > 10:
@@ -194,27 +175,31 @@ class Session:
 
     def _process_telegram_message(self, message) -> None:
         self._update_last_seqno_from_incoming_message(message)
-        if self._print_objects:
+        if self._session._print_objects:
             self.log("v %r" % message)
         body = message.body.packed_data if message.body == 'gzip_packed' else message.body
         if body == 'msg_container':
             for m in body.messages:
                 self._process_telegram_message(m)
         else:
-            self._process_telegram_message_body(body)
+            self._process_telegram_message_body(body, message.msg_id)
             self._acknowledge_telegram_message(message)
 
-    def _process_telegram_message_body(self, body):
+    def _process_telegram_message_body(self, body, msg_id):
         if body == 'new_session_created':
             pass
         elif body == 'msgs_ack':
             pass
         elif body == 'bad_server_salt':
             self._process_bad_server_salt(body)
+        elif body == 'future_salts':
+            self._process_future_salts(body)
         elif body == 'bad_msg_notification' and body.error_code == 32 and not self._stable_seqno:  # msg_seqno too low
             self._process_bad_msg_notification_msg_seqno_too_low(body)
+        elif body == 'bad_msg_notification' and body.error_code in (16, 17):  # msg_id too low or too high
+            self._process_bad_msg_notification_msg_id(body, msg_id)
         elif body == 'rpc_result':
-            if body.result == 'rpc_error' and body.result.error_message[:11] == 'FLOOD_WAIT_':
+            if body.result == 'rpc_error' and body.result.error_message[:11] == b'FLOOD_WAIT_':
                 self._process_rpc_error_flood_wait(body)
             else:
                 self._process_rpc_result(body)
@@ -231,46 +216,62 @@ class Session:
         if not self._msgids_to_ack or not self._stable_seqno:
             return
         seqno = self._get_next_even_seqno()
-        if self._print_objects:
+        if self._session._print_objects:
             self.log("^ %r" % dict(_cons='message', seqno=seqno, body=dict(_cons='msgs_ack', msg_ids=self._msgids_to_ack)))
-        self._mtproto.write(seqno, _cons='msgs_ack', msg_ids=self._msgids_to_ack)
+        self.mtproto.write(seqno, _cons='msgs_ack', msg_ids=self._msgids_to_ack)
         self._msgids_to_ack = []
 
     def _process_any_other_telegram_message(self, body):
-        self.write_json(id=0, message=body.get_dict())
+        self._session.write_json(id=0, message=body)
 
     def _update_last_seqno_from_incoming_message(self, message):
         self._last_seqno = max(self._last_seqno, message.seqno)
 
     def _process_bad_server_salt(self, body):
-        # TODO: dont store messages and use future_salts method instead
-        if self._mtproto.get_server_salt != 0:
+        if self.mtproto.get_server_salt() != 0:
             #self._last_seqno = 0
             self._stable_seqno = False
-        self._mtproto.set_server_salt(body.new_server_salt)
+        self.mtproto.set_server_salt(body.new_server_salt)
         self.log('updating salt: %d' % body.new_server_salt)
-        if body.bad_msg_id in self._pending_requests:
-            bad_request = self._pending_requests[body.bad_msg_id]
-            self._loop.create_task(self._rpc_call(bad_request))
-        else:
+        if not self._resend(body.bad_msg_id):
             self.log("bad_msg_id not found")
 
+    # requests of a rejected message or container are sent again, returns False when the message is unknown
+    def _resend(self, bad_msg_id) -> bool:
+        found = False
+        for msg_id in self.mtproto.get_contained_message_ids(bad_msg_id):
+            if msg_id == self._future_salts_msg_id:
+                # asked again with the next request
+                self._future_salts_msg_id = None
+                found = True
+            elif msg_id in self._pending_requests:
+                bad_request = self._pending_requests.pop(msg_id)
+                self._loop.create_task(self.rpc_call(bad_request))
+                found = True
+        return found
+
+    def _process_future_salts(self, body):
+        self.mtproto.set_future_salts([(salt.valid_since, salt.valid_until, salt.salt) for salt in body.salts])
+        self._future_salts_msg_id = None
+        self.log('received %d future salts' % len(body.salts))
+
     def _process_bad_msg_notification_msg_seqno_too_low(self, body):
         self._seqno_increment = min(2**31 - 1, self._seqno_increment << 1)
         self._last_seqno += self._seqno_increment
         self.log('updating seqno by %d to %d' % (self._seqno_increment, self._last_seqno))
-        if body.bad_msg_id in self._pending_requests:
-            bad_request = self._pending_requests[body.bad_msg_id]
-            self._loop.create_task(self._rpc_call(bad_request))
-            del self._pending_requests[body.bad_msg_id]
+        self._resend(body.bad_msg_id)
+
+    def _process_bad_msg_notification_msg_id(self, body, msg_id):
+        self.mtproto.correct_time(msg_id)
+        self.log('updating server time offset to %.3f seconds' % self.mtproto.get_time_offset())
+        self._resend(body.bad_msg_id)
 
     def _process_rpc_error_flood_wait(self, body):
         seconds_to_wait = 2 * int(body.result.error_message[11:])
-        self._set_flood_wait(seconds_to_wait)
+        self._session._set_flood_wait(seconds_to_wait)
         if body.req_msg_id in self._pending_requests:
-            pending_request = self._pending_requests[body.req_msg_id]
-            self._loop.create_task(self._rpc_call(pending_request))
-            del self._pending_requests[body.bad_msg_id]
+            pending_request = self._pending_requests.pop(body.req_msg_id)
+            self._loop.create_task(self.rpc_call(pending_request))
 
     def _process_rpc_result(self, body):
         self._stable_seqno = True
@@ -280,15 +281,435 @@ class Session:
                 result = body.result.packed_data
             else:
                 result = body.result
-            pending_request.response.set_result(result.get_dict())
+            pending_request.response.set_result(result)
         else:
             self.log("req_msg_id not found")
 
+    # returns the requests without an answer, the session sends them over another connection or fails them
+    def stop(self):
+        self._stopped = True
+        self._mtproto_loop.cancel()
+        self._flush_msgids_to_ack()
+        self._loop.create_task(self.mtproto.stop())
+        pending_requests, self._pending_requests = list(self._pending_requests.values()), dict()
+        return pending_requests
+
+
+class Session:
+    def __init__(self, reader, writer, peername, loop, args):
+        self._peername = peername
+        self._mtproto = None
+        self._connections = []  # the first one is interactive and receives updates
+        self._json_in = reader
+        self._json_out = writer
+        self._loop = loop
+        self._print_objects = args.print_objects
+        self._print_tracebacks = args.print_tracebacks
+        self._send_tracebacks = args.send_tracebacks
+        self._gzip_threshold = args.gzip_threshold or None
+        self._gzip_max_size = args.gzip_max_size
+        self._allow_scheme_reload = args.allow_scheme_reload
+        self._write_high_water = args.write_high_water
+        self._write_low_water = args.write_low_water
+        self._transport = args.transport
+        self._batch_window = args.batch_window
+        self._batch_max_size = args.batch_max_size
+        self._connections_number = max(1, args.connections)
+        self._routing = args.routing
+        self._scheme = None  # the session stays on the layer of its first connection
+        self._future_flood_wait = None
+        self._host = TELEGRAM_HOST
+        self._port = TELEGRAM_PORT
+        self._rsa = TELEGRAM_RSA
+        self._dc_id = None  # the home DC, it's learnt from config
+        self._dc_options = dict()  # dc_id -> (host, port), from config
+        self._dc_auth_keys = dict()  # dc_id -> auth key of another DC with imported authorization, in base64
+        self._dc_connections = dict()  # dc_id -> task connecting to another DC, its result is the Connection
+        self._file_dcs = dict()  # JSON of a file location -> dc_id, requests for the file go there right away
+        self._init_connection = []  # the client's invokeWithLayer and initConnection, new DC connections start with them
+        self._migrate_lock = asyncio.Lock()
+        self._last_ordered_request = None  # a future done when the last request handled in order is answered
+
+    def log(self, message):
+        log(self._peername, message)
+
+    async def receive_line(self, line: bytes) -> bool:
+        if line in (b'\n', '\n'):
+            return True
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as exception:
+            self.write_json(id=-2, error='JSONDecodeError', msg=exception.msg, pos=exception.pos, doc=line.decode('utf-8'))
+            return False
+        if self._print_objects:
+            self.log('> %s' % line.decode('utf-8')[:-1])
+        try:
+            if self._is_concurrent(request):
+                await self.receive_json(request)
+            else:
+                await self._receive_json_in_order(request)
+        except Exception:
+            etype, evalue, tb = sys.exc_info()
+            traceback.print_exception(etype, evalue, tb if self._print_tracebacks else None, file=sys.stderr)
+            response = dict(id=request.get('id', -3), error=etype.__name__, msg=' '.join(getattr(evalue, 'args', ())))
+            if self._send_tracebacks:
+                response['traceback'] = traceback.format_tb(tb)
+            self.write_json(**response)
+            return False
+        return True
+
+    # with several connections lines are read ahead: uploads are handled concurrently, other requests in order,
+    # unless every request goes to the least loaded connection
+    def _is_concurrent(self, request) -> bool:
+        message = request.get('message')
+        if self._connections_number == 1 or not isinstance(message, dict):
+            return False
+        return self._routing == 'least-loaded' or _unwrap_query(message).get('_cons', '').startswith(MEDIA_METHOD_PREFIXES)
+
+    async def _receive_json_in_order(self, request):
+        previous, done = self._last_ordered_request, self._loop.create_future()
+        self._last_ordered_request = done
+        try:
+            if previous is not None:
+                await asyncio.wait((previous,))
+            await self.receive_json(request)
+        finally:
+            done.set_result(None)
+
+    def _connection_kind(self, number):
+        if self._routing == 'least-loaded':
+            return 'any'
+        return 'interactive' if number == 0 else 'media'
+
+    def _start_other_connections(self):
+        pending_requests = []
+        for connection in self._connections[1:]:
+            pending_requests += connection.stop()
+        del self._connections[1:]
+        for number in range(1, self._connections_number):
+            self._connections.append(Connection(self, self._mtproto.connect_another(), self._connection_kind(number)))
+        self._resend_pending_requests(pending_requests)
+
+    def start_mtproto_loop(self, pending_requests=()):
+        self._seq_no = -1
+        pending_requests = list(pending_requests)
+        if self._mtproto is not None:
+            for connection in self._connections:
+                pending_requests += connection.stop()
+            self._connections = []
+            self._mtproto = None
+        self.log("connecting to Telegram at %s:%d" % (self._host, self._port))
+        self._mtproto = self._new_mtproto(self._host, self._port)
+        self._scheme = self._mtproto.get_scheme()
+        self._connections = [Connection(self, self._mtproto, self._connection_kind(0))]
+        self._start_other_connections()
+        self._resend_pending_requests(pending_requests)
+
+    # requests of stopped connections go to the current ones, they fail when the session is disconnected
+    # a new connection may be in a DC that doesn't know the client yet, any of them may be the first request there
+    def _resend_pending_requests(self, pending_requests):
+        for pending_request in pending_requests:
+            if pending_request.response.done():
+                continue
+            if not self._connections:
+                pending_request.response.set_result(dict(_cons='rpc_timeout', error_message='disconnected from telegram'))
+                continue
+            pending_request.request = self._wrap_init_connection(pending_request.request)
+            self._loop.create_task(self._choose_connection(pending_request.request).rpc_call(pending_request))
+
+    def _new_mtproto(self, host, port):
+        return mtproto.MTProto(
+            self._loop,
+            host,
+            port,
+            self._rsa,
+            gzip_threshold=self._gzip_threshold,
+            gzip_max_size=self._gzip_max_size,
+            scheme=self._scheme,
+            write_high_water=self._write_high_water,
+            write_low_water=self._write_low_water,
+            transport=self._transport,
+            batch_window=self._batch_window,
+            batch_max_size=self._batch_max_size,
+            log=self.log
+        )
+
+    def _choose_connection(self, request):
+        if len(self._connections) == 1:
+            return self._connections[0]
+        if self._routing == 'least-loaded':
+            return min(self._connections, key=Connection.get_load)
+        # requests sent again are wrapped in initConnection, the client can wrap them too
+        if _unwrap_query(request)['_cons'].startswith(MEDIA_METHOD_PREFIXES):
+            return min(self._connections[1:], key=Connection.get_load)
+        return self._connections[0]
+
+    # several DCs, https://core.telegram.org/api/datacenter
+
+    def _remember_init_connection(self, message):
+        wrappers = []
+        while message.get('_cons') in ('invokeWithLayer', 'initConnection'):
+            wrappers.append({key: value for key, value in message.items() if key != '_wrapped'})
+            message = message['_wrapped']
+        if wrappers:
+            self._init_connection = wrappers
+
+    def _wrap_init_connection(self, request):
+        if request.get('_cons') in ('invokeWithLayer', 'initConnection'):
+            return request
+        for wrapper in reversed(self._init_connection):
+            request = dict(wrapper, _wrapped=request)
+        return request
+
+    # requests made by the proxy itself, they initialize the connection like the client does
+    async def _call(self, connection, request):
+        return await connection.rpc_call(PendingRequest(self._loop, self._wrap_init_connection(request)))
+
+    def _update_dc_options(self, config):
+        dc_options = dict()
+        for option in config.dc_options:
+            # the first plain IPv4 address of every DC
+            if any(getattr(option, flag, None) is not None for flag in ('ipv6', 'media_only', 'tcpo_only', 'cdn')):
+                continue
+            dc_options.setdefault(option.id, (option.ip_address.decode('ascii'), option.port))
+        self._dc_options.update(dc_options)
+        self._dc_id = config.this_dc
+
+    async def _get_dc_address(self, dc_id):
+        if dc_id not in self._dc_options:
+            config = await self._call(self._connections[0], dict(_cons='help.getConfig'))
+            if config != 'config':
+                raise RuntimeError('help.getConfig failed: %r' % config)
+            self._update_dc_options(config)
+        if dc_id not in self._dc_options:
+            raise RuntimeError('DC%d is not in config' % dc_id)
+        return self._dc_options[dc_id]
+
+    async def _get_dc_connection(self, dc_id):
+        if dc_id not in self._dc_connections:
+            self._dc_connections[dc_id] = self._loop.create_task(self._connect_dc(dc_id))
+        connecting = self._dc_connections[dc_id]
+        try:
+            # concurrent requests wait for the same connection
+            return await asyncio.shield(connecting)
+        except (OSError, RuntimeError):
+            # the next request tries again
+            if self._dc_connections.get(dc_id) is connecting:
+                del self._dc_connections[dc_id]
+            raise
+
+    # returns the requests without an answer
+    def _stop_dc_connections(self, *dc_ids):
+        pending_requests = []
+        for dc_id in dc_ids:
+            connecting = self._dc_connections.pop(dc_id, None)
+            if connecting is None:
+                continue
+            if connecting.done() and not connecting.cancelled() and connecting.exception() is None:
+                pending_requests += connecting.result().stop()
+            else:
+                connecting.cancel()
+        return pending_requests
+
+    # a connection to another DC with the auth key from the cache, or a new one the authorization is imported to
+    async def _connect_dc(self, dc_id):
+        host, port = await self._get_dc_address(dc_id)
+        self.log("connecting to DC%d at %s:%d" % (dc_id, host, port))
+        connection = Connection(self, self._new_mtproto(host, port), 'foreign')
+        try:
+            if dc_id in self._dc_auth_keys:
+                connection.mtproto.set_session(self._dc_auth_keys[dc_id], secrets.randbits(64))
+                return connection
+            # an rpc_error, or an rpc_timeout dict when there's no answer
+            exported = await self._call(self._connections[0], dict(_cons='auth.exportAuthorization', dc_id=dc_id))
+            if exported != 'auth.exportedAuthorization':
+                raise RuntimeError('auth.exportAuthorization failed: %r' % exported)
+            imported = await self._call(
+                connection, dict(_cons='auth.importAuthorization', id=exported.id, bytes=exported.bytes)
+            )
+            if imported != 'auth.authorization':
+                raise RuntimeError('auth.importAuthorization failed: %r' % imported)
+        except Exception:
+            connection.stop()
+            raise
+        self._dc_auth_keys[dc_id] = connection.mtproto.get_session()[0]
+        return connection
+
+    # the session moves to another DC, auth key of the new one is taken from the cache when there is one
+    async def _migrate_home(self, dc_id):
+        async with self._migrate_lock:
+            if dc_id == self._dc_id:
+                return
+            host, port = await self._get_dc_address(dc_id)
+            self.log("moving to DC%d" % dc_id)
+            # requests waiting on the foreign connection are sent over the home one
+            pending_requests = self._stop_dc_connections(dc_id)
+            self._host, self._port, self._dc_id = host, port, dc_id
+            self.start_mtproto_loop(pending_requests)
+            if dc_id in self._dc_auth_keys:
+                self._mtproto.set_session(self._dc_auth_keys.pop(dc_id), secrets.randbits(64))
+                self._start_other_connections()
+
+    @staticmethod
+    def _get_file_key(message):
+        location = _unwrap_query(message).get('location')
+        return json.dumps(location, sort_keys=True) if isinstance(location, dict) else None
+
+    def _remember_file_dc(self, message, dc_id):
+        file_key = self._get_file_key(message)
+        if file_key is not None:
+            self._file_dcs[file_key] = dc_id
+            if len(self._file_dcs) > FILE_DCS_KEPT:
+                del self._file_dcs[next(iter(self._file_dcs))]
+
+    async def _rpc_call_dc(self, dc_id, message):
+        if dc_id is None:
+            response = await self._choose_connection(message).rpc_call(PendingRequest(self._loop, message))
+            if response == 'config':
+                self._update_dc_options(response)
+            return response
+        return await (await self._get_dc_connection(dc_id)).rpc_call(PendingRequest(self._loop, message))
+
+    def _handle_json_server(self, rserver):
+        if 'host' in rserver:
+            self._host = rserver['host']
+            self._port = rserver['port']
+            self._rsa = rserver['rsa']
+        return dict(
+            host=self._host,
+            port=self._port,
+            rsa=self._rsa
+        )
+
+    def _handle_json_session(self, session):
+        if 'auth_key' in session:
+            # JSON keys are strings
+            self._dc_options.update((int(dc_id), tuple(address)) for dc_id, address in session.get('dc_options', {}).items())
+            self._dc_auth_keys.update((int(dc_id), key) for dc_id, key in session.get('dc_auth_keys', {}).items())
+            if session.get('dc_id') is not None:
+                self._dc_id = session['dc_id']
+            if self._dc_id in self._dc_options and self._dc_options[self._dc_id] != (self._host, self._port):
+                # the session was moved to another DC
+                self._host, self._port = self._dc_options[self._dc_id]
+                if self._mtproto is not None:
+                    self.start_mtproto_loop()
+        if self._mtproto is None:
+            self.start_mtproto_loop()
+        if 'auth_key' in session:
+            auth_key = session['auth_key']
+            session_id = session['session_id']
+            self._mtproto.set_session(auth_key, session_id)
+            if 'time_offset' in session:
+                self._mtproto.set_time_offset(session['time_offset'])
+            if 'server_salt' in session:
+                self._mtproto.set_server_salt(session['server_salt'])
+            if 'future_salts' in session:
+                self._mtproto.set_future_salts(
+                    (salt['valid_since'], salt['valid_until'], salt['salt']) for salt in session['future_salts']
+                )
+            # other connections take the new auth key
+            self._start_other_connections()
+            return dict(status="ok")
+        try:
+            auth_key, session_id = self._mtproto.get_session()
+        except TypeError:
+            return dict(error_message="no session found, please provide your session or send a message to create a new one")
+        return dict(
+            session_id=session_id,
+            auth_key=auth_key,
+            time_offset=self._mtproto.get_time_offset(),
+            server_salt=self._mtproto.get_server_salt(),
+            future_salts=[
+                dict(valid_since=valid_since, valid_until=valid_until, salt=salt)
+                for valid_since, valid_until, salt in self._mtproto.get_future_salts()
+            ],
+            dc_id=self._dc_id,
+            dc_options={str(dc_id): list(address) for dc_id, address in self._dc_options.items()},
+            dc_auth_keys={str(dc_id): key for dc_id, key in self._dc_auth_keys.items()}
+        )
+
+    async def _handle_json_scheme(self, scheme):
+        if scheme.get('reload'):
+            if not self._allow_scheme_reload:
+                raise RuntimeError('scheme reload is not allowed, start streamjson.py with --allow-scheme-reload')
+            new_scheme = await mtproto.reload_scheme(self._loop)
+            self.log('loaded scheme layer %r' % new_scheme.layer)
+        response = mtproto.get_layers()
+        response['session_layer'] = self._scheme.layer if self._scheme is not None else None
+        return response
+
+    def _handle_json_stats(self, stats):
+        response = dict(caches=byteutils.get_cache_stats())
+        if self._mtproto is not None:
+            response['gzip'] = self._mtproto.get_gzip_counters()
+            response['link'] = self._mtproto.get_link_counters()
+            response['connections'] = [connection.get_counters() for connection in self._connections]
+            response['dc_connections'] = {
+                str(dc_id): connecting.result().get_counters() for dc_id, connecting in self._dc_connections.items()
+                if connecting.done() and not connecting.cancelled() and connecting.exception() is None
+            }
+        return response
+
+    async def _handle_json_message(self, message):
+        if self._mtproto is None:
+            self.start_mtproto_loop()
+        if '_cons' not in message:
+            raise RuntimeError('`_cons` attribute is required in message object')
+        self._remember_init_connection(message)
+        dc_id = self._file_dcs.get(self._get_file_key(message))
+        response = await self._rpc_call_dc(dc_id, message)
+        migrate = _MIGRATE_ERROR.match(response.error_message) if response == 'rpc_error' else None
+        if migrate is None:
+            return response
+        # the request is sent once more to the right DC, the client gets the error when that fails
+        reason, dc_id = migrate.group(1), int(migrate.group(2))
+        try:
+            if reason in _HOME_MIGRATE_ERRORS:
+                await self._migrate_home(dc_id)
+                return await self._rpc_call_dc(None, self._wrap_init_connection(message))
+            self._remember_file_dc(message, dc_id)
+            return await self._rpc_call_dc(dc_id, message)
+        except (OSError, RuntimeError) as error:
+            self.log("could not send the request to DC%d: %s" % (dc_id, error))
+            return response
+
+    async def receive_json(self, request):
+        response = dict(id=request.get('id', 1))
+        if 'server' in request:
+            response['server'] = self._handle_json_server(request['server'])
+        if 'session' in request:
+            response['session'] = self._handle_json_session(request['session'])
+        if 'stats' in request:
+            response['stats'] = self._handle_json_stats(request['stats'])
+        if 'scheme' in request:
+            response['scheme'] = await self._handle_json_scheme(request['scheme'])
+        if 'message' in request:
+            response['message'] = await self._handle_json_message(request['message'])
+        self.write_json(**response)
+
+    async def read_loop(self):
+        self.log('connected')
+        while True:
+            try:
+                line = await self._json_in.readline()
+            except ConnectionResetError:
+                self.disconnect()
+                return
+            if line == b'':
+                self.disconnect()
+                return
+            if self._connections_number > 1:
+                # lines are read ahead, responses are matched by `id`
+                self._loop.create_task(self.receive_line(line))
+            else:
+                await self.receive_line(line)
+
     def write_json(self, **kwargs):
-        response = json.dumps(kwargs)
+        # messages from telegram are tl.Structure objects, they are encoded without building dicts
+        response = tl.json_dumps(kwargs)
         if self._print_objects:
-            self.log('< %s' % response)
-        self._json_out.write(response.encode('utf-8')+b'\n')
+            self.log('< %s' % response.decode('utf-8'))
+        self._json_out.write(response + b'\n')
 
     def _flood_wait(self):
         return self._future_flood_wait is not None and not self._future_flood_wait.done()
@@ -309,14 +730,17 @@ class Session:
 
     def disconnect(self):
         # TODO graceful stop here
-        #self._mtproto_read_future.cancel()
-        self._flush_msgids_to_ack()
-        self._loop.create_task(self._mtproto.stop())
+        pending_requests = []
+        for connection in self._connections:
+            pending_requests += connection.stop()
+        self._connections = []
+        pending_requests += self._stop_dc_connections(*list(self._dc_connections))
+        self._resend_pending_requests(pending_requests)
         self.log('disconnected')
-        del self._mtproto
+        self._mtproto = None
 
 
-def parse_command_line_args():
+def parse_command_line_args(args=None):
     parser = argparse.ArgumentParser(
         description=__description__,
         add_help=True,
@@ -327,12 +751,45 @@ def parse_command_line_args():
     parser.add_argument('--verbose', dest='print_objects', action='store_true', help='copy all objects to stdout')
     parser.add_argument('--print-tracebacks', dest='print_tracebacks', action='store_true', help='enable printing tracebacks to stderr')
     parser.add_argument('--send-tracebacks', dest='send_tracebacks', action='store_true', help='enable sending tracebacks to client')
-    return parser.parse_args()
+    parser.add_argument('--preload-scheme', dest='preload_scheme', action='store_true', help='load TL scheme before listening')
+    parser.add_argument('--gzip-threshold', dest='gzip_threshold', default=mtproto.GZIP_THRESHOLD, type=int,
+                        help='gzip outgoing messages of GZIP_THRESHOLD bytes and larger, 0 disables (default: %d)' % mtproto.GZIP_THRESHOLD)
+    parser.add_argument('--gzip-max-size', dest='gzip_max_size', default=tl.GZIP_MAX_SIZE, type=int,
+                        help='limit unpacked size of incoming gzip_packed data (default: %d)' % tl.GZIP_MAX_SIZE)
+    parser.add_argument('--crypto-processes', dest='crypto_processes', default=0, type=int,
+                        help='encrypt large messages and do DH math in CRYPTO_PROCESSES worker processes, 0 disables (default: 0)')
+    parser.add_argument('--auth-key-pool-size', dest='auth_key_pool_size', default=0, type=int,
+                        help='keep AUTH_KEY_POOL_SIZE auth keys per DC ready for new clients, 0 disables (default: 0)')
+    parser.add_argument('--auth-key-pool-refill', dest='auth_key_pool_refill', default=1.0, type=float,
+                        help='seconds between handshakes while refilling the pool, doubled after every failed one (default: 1.0)')
+    parser.add_argument('--auth-key-pool-lifetime', dest='auth_key_pool_lifetime', default=3600.0, type=float,
+                        help='seconds to keep an unused auth key in the pool (default: 3600)')
+    parser.add_argument('--write-high-water', dest='write_high_water', default=tcp.WRITE_HIGH_WATER, type=int,
+                        help='pause sending when WRITE_HIGH_WATER bytes are waiting for the socket (default: %d)' % tcp.WRITE_HIGH_WATER)
+    parser.add_argument('--write-low-water', dest='write_low_water', default=tcp.WRITE_LOW_WATER, type=int,
+                        help='resume sending when less than WRITE_LOW_WATER bytes are left (default: %d)' % tcp.WRITE_LOW_WATER)
+    parser.add_argument('--batch-window', dest='batch_window', default=mtproto.BATCH_WINDOW, type=float,
+                        help='send messages written within BATCH_WINDOW seconds in one container,\n'
+                             '0 batches messages of one event loop iteration (default: %g)' % mtproto.BATCH_WINDOW)
+    parser.add_argument('--batch-max-size', dest='batch_max_size', default=mtproto.BATCH_MAX_SIZE, type=int,
+                        help='send a container as soon as it has BATCH_MAX_SIZE bytes (default: %d)' % mtproto.BATCH_MAX_SIZE)
+    parser.add_argument('--connections', dest='connections', default=1, type=int,
+                        help='open CONNECTIONS connections per session, uploads are handled concurrently (default: 1)')
+    parser.add_argument('--routing', dest='routing', default='media', choices=('media', 'least-loaded'),
+                        help='send upload.* requests to extra connections or every request to the least loaded one\n'
+                             '(default: media)')
+    parser.add_argument('--transport', dest='transport', default='streams', choices=sorted(tcp.transports),
+                        help='connect to Telegram with asyncio streams or with a buffered protocol (default: streams)')
+    parser.add_argument('--uvloop', dest='uvloop', action='store_true', help='run on uvloop event loop, requires uvloop')
+    parser.add_argument('--no-caches', dest='no_caches', action='store_true', help='disable caching of hashes and encodings')
+    parser.add_argument('--allow-scheme-reload', dest='allow_scheme_reload', action='store_true',
+                        help='allow clients to reload scheme.tl with {"scheme": {"reload": true}}')
+    return parser.parse_args(args)
 
 
 def connection_factory(*args):
     async def connection(reader, writer):
-        peername = '%s:%d' % writer.transport._extra['peername'][:2]
+        peername = '%s:%d' % writer.get_extra_info('peername')[:2]
         session = Session(reader, writer, peername, *args)
         await session.read_loop()
         writer.close()
@@ -348,11 +805,44 @@ if __name__ == "__main__":
 
     sys.excepthook = global_exception_handler
 
-    main_loop = asyncio.get_event_loop()
+    if command_line_args.uvloop:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    main_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(main_loop)
+    if command_line_args.preload_scheme:
+        mtproto.preload_scheme(main_loop)
+    if command_line_args.auth_key_pool_size > 0:
+        mtproto.enable_auth_key_pools(
+            command_line_args.auth_key_pool_size,
+            command_line_args.auth_key_pool_refill,
+            command_line_args.auth_key_pool_lifetime,
+            log=functools.partial(log, 'auth key pool')
+        )
+        mtproto.get_auth_key_pool(main_loop, TELEGRAM_HOST, TELEGRAM_PORT, TELEGRAM_RSA)
+    if command_line_args.no_caches:
+        byteutils.set_caching(False)
+    if command_line_args.crypto_processes > 0:
+        mtproto.enable_process_pool(command_line_args.crypto_processes)
+
+    def reload_scheme_on_signal():
+        async def reload_scheme():
+            try:
+                scheme = await mtproto.reload_scheme(main_loop)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+                return
+            print('Loaded scheme layer', scheme.layer, file=sys.stdout)
+        main_loop.create_task(reload_scheme())
+
+    # SIGHUP reloads scheme.tl, there's no SIGHUP on Windows
+    if hasattr(signal, 'SIGHUP'):
+        main_loop.add_signal_handler(signal.SIGHUP, reload_scheme_on_signal)
     #main_loop.set_debug(True)
     #main_loop.slow_callback_duration = 0.015
     factory = connection_factory(main_loop, command_line_args)
-    server = asyncio.start_server(factory, command_line_args.host, command_line_args.port, loop=main_loop)
+    server = asyncio.start_server(factory, command_line_args.host, command_line_args.port)
     server_task = main_loop.run_until_complete(server)
 
     print('Started listening on', ', '.join('%s:%d' % s.getsockname()[:2] for s in server_task.sockets), file=sys.stdout)
@@ -3,6 +3,9 @@
 
 This module implements Abdidged TCP for Telegram MTProto
  https://core.telegram.org/mtproto#tcp-transport
+
+AbridgedTCP is built on asyncio streams, ProtocolAbridgedTCP is the same link built on asyncio.BufferedProtocol,
+it receives straight into its buffers and works with uvloop as well
  
 """
 
@@ -12,39 +15,87 @@ __license__ = "https://creativecommons.org/licenses/by-nc-nd/4.0/legalcode"
 __status__ = "Prototype"
 
 
-from asyncio import Lock, open_connection
+import asyncio
+import collections
+import time
+from asyncio import Event, Lock, open_connection
+
+
+# writers are paused when more than WRITE_HIGH_WATER bytes are waiting to be sent,
+# and resumed when less than WRITE_LOW_WATER bytes are left
+WRITE_HIGH_WATER = 1024 * 1024
+WRITE_LOW_WATER = 256 * 1024
 
 
 class AbridgedTCP:
-    def __init__(self, loop, host, port):
+    def __init__(self, loop, host, port, high_water: int = WRITE_HIGH_WATER, low_water: int = WRITE_LOW_WATER):
         self._loop = loop
         self._host = host
         self._port = port
+        self._high_water = high_water
+        self._low_water = low_water
         self._connect_lock = Lock()
+        # received data is read from _buffer at _buffer_offset, a buffer is never resized after it's read from,
+        # so memoryview slices given to callers stay valid
         self._buffer = b''
+        self._buffer_offset = 0
         self._reader = None
         self._writer = None
         self._write_lock = Lock()
+        self._writable = Event()
+        self._writable.set()
+        self._preamble = b''  # sent together with the first packet of a connection
+        self._counters = dict(connects=0, written_packets=0, written_bytes=0, pauses=0, paused_time=0.0)
 
     async def _reconnect_if_needed(self):
         async with self._connect_lock:
             if self._reader is None or self._writer is None:
                 # set limit to 16 mb
-                self._reader, self._writer = await open_connection(self._host, self._port, loop=self._loop, limit=2**24)
-                print("RECONNECT")
-                self._writer.write(b'\xef')
+                self._reader, self._writer = await open_connection(self._host, self._port, limit=2**24)
+                self._writer.transport.set_write_buffer_limits(high=self._high_water, low=self._low_water)
+                self._counters['connects'] += 1
+                self._preamble = b'\xef'
 
     async def _write_abridged_packet(self, data: bytes) -> None:
         await self._reconnect_if_needed()
         packet_data_length = len(data) >> 2
         if packet_data_length < 0x7f:
-            self._writer.write(packet_data_length.to_bytes(1, 'little'))
+            header = self._preamble + packet_data_length.to_bytes(1, 'little')
         elif packet_data_length <= 0x7fffff:
-            self._writer.write(b'\x7f')
-            self._writer.write(packet_data_length.to_bytes(3, 'little'))
+            header = self._preamble + b'\x7f' + packet_data_length.to_bytes(3, 'little')
         else:
             raise OverflowError('Packet data is too long')
-        self._writer.write(data)
+        self._preamble = b''
+        # header and data go to the socket in one call
+        self._writer.writelines((header, data))
+        self._counters['written_packets'] += 1
+        self._counters['written_bytes'] += len(header) + len(data)
+
+    # waits until the data buffered in the transport drops below the low watermark
+    async def _drain_if_needed(self) -> None:
+        if self.get_write_buffer_size() <= self._high_water:
+            return
+        self._writable.clear()
+        self._counters['pauses'] += 1
+        started = time.perf_counter()
+        try:
+            await self._writer.drain()
+        finally:
+            self._counters['paused_time'] += time.perf_counter() - started
+            self._writable.set()
+
+    # returns immediately unless a write is waiting for the buffered data to be sent
+    async def wait_writable(self) -> None:
+        await self._writable.wait()
+
+    def get_write_buffer_size(self) -> int:
+        if self._writer is None:
+            return 0
+        return self._writer.transport.get_write_buffer_size()
+
+    def get_counters(self) -> dict:
+        return dict(self._counters, buffered_bytes=self.get_write_buffer_size(),
+                    high_water=self._high_water, low_water=self._low_water)
 
     async def _read_abridged_packet(self) -> bytes:
         await self._reconnect_if_needed()
@@ -55,21 +106,239 @@ class AbridgedTCP:
             packet_data_length = int.from_bytes(await self._reader.readexactly(3), 'little', signed=False)
         return await self._reader.readexactly(packet_data_length * 4)
 
-    async def read(self, nbytes: int) -> bytes:
-        while len(self._buffer) < nbytes:
-            self._buffer += await self._read_abridged_packet()
-        result = self._buffer[:nbytes]
-        self._buffer = self._buffer[nbytes:]
-        return result
+    # returns a memoryview slice, consumers that keep the data must convert it to bytes
+    async def read(self, nbytes: int) -> memoryview:
+        if len(self._buffer) - self._buffer_offset < nbytes:
+            if len(self._buffer) == self._buffer_offset:
+                # nothing is left unread, a packet becomes the buffer without copying
+                self._buffer, self._buffer_offset = await self._read_abridged_packet(), 0
+            if len(self._buffer) - self._buffer_offset < nbytes:
+                # compaction: the unread tail and the following packets are copied into a new buffer once
+                buffer = bytearray(memoryview(self._buffer)[self._buffer_offset:])
+                while len(buffer) < nbytes:
+                    buffer += await self._read_abridged_packet()
+                self._buffer, self._buffer_offset = buffer, 0
+        offset = self._buffer_offset
+        self._buffer_offset += nbytes
+        return memoryview(self._buffer)[offset:offset + nbytes]
+
+    # a whole packet, that is a whole MTProto message as the server sends one message per packet,
+    # an unread remainder of the buffer is returned without copying
+    async def read_frame(self) -> memoryview:
+        if self._buffer_offset < len(self._buffer):
+            frame = memoryview(self._buffer)[self._buffer_offset:]
+        else:
+            frame = memoryview(await self._read_abridged_packet())
+        self._buffer, self._buffer_offset = b'', 0
+        return frame
 
     async def write(self, data: bytes) -> None:
+        data = memoryview(data)
         async with self._write_lock:
             while len(data) > 0:
                 chunk_len = min(len(data), 0x7fffff)
                 await self._write_abridged_packet(data[:chunk_len])
                 data = data[chunk_len:]
+            await self._drain_if_needed()
+
+    async def stop(self) -> None:
+        # drains output and closes the connection, a pending read gets IncompleteReadError
+        async with self._write_lock:
+            if self._writer is not None:
+                await self._writer.drain()
+                self._writer.close()
+            self._reader, self._writer = None, None
+
+
+# small packets are received into a shared buffer and copied out,
+# a larger packet gets a buffer of its own as soon as its header is parsed and is received without copying
+RECEIVE_BUFFER_SIZE = 64 * 1024
+# reading from the socket is paused when this many received bytes are waiting for read_frame
+RECEIVE_LIMIT = 2 ** 24
+
+
+# asyncio.BufferedProtocol is new in Python 3.7, the protocol transport isn't available before it
+class _AbridgedProtocol(getattr(asyncio, 'BufferedProtocol', asyncio.Protocol)):
+    def __init__(self, link):
+        self._link = link
+        self._buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        self._start = 0  # the header of the next packet
+        self._end = 0  # the end of received data
+        self._packet = None  # the buffer of a large packet being received
+        self._packet_received = 0
+
+    def connection_made(self, transport):
+        transport.set_write_buffer_limits(high=self._link._high_water, low=self._link._low_water)
+
+    def get_buffer(self, sizehint):
+        if self._packet is not None:
+            return memoryview(self._packet)[self._packet_received:]
+        if self._end == len(self._buffer):
+            # compaction, an incomplete small packet is moved to the beginning
+            self._buffer[:self._end - self._start] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, self._end - self._start
+        return memoryview(self._buffer)[self._end:]
+
+    def buffer_updated(self, nbytes):
+        if self._packet is not None:
+            self._packet_received += nbytes
+            if self._packet_received == len(self._packet):
+                packet, self._packet = self._packet, None
+                self._link._packet_received(packet)
+            return
+        self._end += nbytes
+        buffer = self._buffer
+        while self._end > self._start:
+            packet_data_length = buffer[self._start]
+            header_length = 1
+            if packet_data_length == 0x7f:
+                if self._end - self._start < 4:
+                    break
+                packet_data_length = int.from_bytes(buffer[self._start + 1:self._start + 4], 'little', signed=False)
+                header_length = 4
+            elif packet_data_length > 0x7f:
+                self._link._protocol_error(NotImplementedError("Wrong packet data length %d" % packet_data_length))
+                return
+            packet_start = self._start + header_length
+            packet_end = packet_start + packet_data_length * 4
+            if packet_end <= self._end:
+                self._start = packet_end
+                self._link._packet_received(bytes(buffer[packet_start:packet_end]))
+            elif packet_end - packet_start > len(buffer) // 2:
+                # the received part is copied once, the rest goes straight to the packet buffer
+                self._packet = bytearray(packet_end - packet_start)
+                self._packet_received = self._end - packet_start
+                self._packet[:self._packet_received] = buffer[packet_start:self._end]
+                self._start = self._end = 0
+                return
+            else:
+                break
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        self._link._connection_lost(self, exc)
+
+    def pause_writing(self):
+        self._link._writable.clear()
+
+    def resume_writing(self):
+        self._link._writable.set()
+
+
+class ProtocolAbridgedTCP(AbridgedTCP):
+    def __init__(self, loop, host, port, high_water: int = WRITE_HIGH_WATER, low_water: int = WRITE_LOW_WATER):
+        super().__init__(loop, host, port, high_water, low_water)
+        self._transport = None
+        self._protocol = None
+        self._packets = collections.deque()
+        self._packets_size = 0
+        self._packet_waiter = None
+        self._connection_error = None
+        self._reading_paused = False
+
+    async def _reconnect_if_needed(self):
+        async with self._connect_lock:
+            if self._transport is None:
+                self._connection_error = None
+                self._transport, self._protocol = await self._loop.create_connection(
+                    lambda: _AbridgedProtocol(self), self._host, self._port
+                )
+                self._counters['connects'] += 1
+                self._preamble = b'\xef'
+
+    # callbacks of the protocol
+
+    def _packet_received(self, packet) -> None:
+        self._packets.append(packet)
+        self._packets_size += len(packet)
+        if self._packets_size > RECEIVE_LIMIT and not self._reading_paused:
+            self._reading_paused = True
+            self._transport.pause_reading()
+        self._wake_up_reader()
+
+    def _protocol_error(self, error) -> None:
+        self._connection_error = error
+        self._transport.close()
+        self._wake_up_reader()
+
+    def _connection_lost(self, protocol, exc) -> None:
+        if protocol is not self._protocol:
+            return
+        if self._connection_error is None:
+            self._connection_error = exc if exc is not None else asyncio.IncompleteReadError(b'', 1)
+        self._transport, self._protocol = None, None
+        self._reading_paused = False
+        self._writable.set()
+        self._wake_up_reader()
+
+    def _wake_up_reader(self) -> None:
+        if self._packet_waiter is not None and not self._packet_waiter.done():
+            self._packet_waiter.set_result(None)
+
+    # the surface of AbridgedTCP
+
+    async def _read_abridged_packet(self) -> bytes:
+        await self._reconnect_if_needed()
+        while not self._packets:
+            if self._connection_error is not None:
+                raise self._connection_error
+            self._packet_waiter = self._loop.create_future()
+            try:
+                await self._packet_waiter
+            finally:
+                self._packet_waiter = None
+        packet = self._packets.popleft()
+        self._packets_size -= len(packet)
+        if self._reading_paused and self._packets_size < RECEIVE_LIMIT // 2 and self._transport is not None:
+            self._reading_paused = False
+            self._transport.resume_reading()
+        return packet
+
+    async def _write_abridged_packet(self, data: bytes) -> None:
+        await self._reconnect_if_needed()
+        packet_data_length = len(data) >> 2
+        if packet_data_length < 0x7f:
+            header = self._preamble + packet_data_length.to_bytes(1, 'little')
+        elif packet_data_length <= 0x7fffff:
+            header = self._preamble + b'\x7f' + packet_data_length.to_bytes(3, 'little')
+        else:
+            raise OverflowError('Packet data is too long')
+        self._preamble = b''
+        self._transport.writelines((header, data))
+        self._counters['written_packets'] += 1
+        self._counters['written_bytes'] += len(header) + len(data)
+
+    # the protocol is paused by the transport above the high watermark and resumed below the low one
+    async def _drain_if_needed(self) -> None:
+        if self._writable.is_set():
+            return
+        self._counters['pauses'] += 1
+        started = time.perf_counter()
+        try:
+            await self._writable.wait()
+        finally:
+            self._counters['paused_time'] += time.perf_counter() - started
+        if self._transport is None and self._connection_error is not None:
+            raise ConnectionResetError("Connection lost while sending") from self._connection_error
+
+    def get_write_buffer_size(self) -> int:
+        if self._transport is None:
+            return 0
+        return self._transport.get_write_buffer_size()
 
     async def stop(self) -> None:
-        # not implemented yet
-        # drain ouptut and cancel reading
-        pass
+        # drains output and closes the connection, a pending read gets IncompleteReadError
+        async with self._write_lock:
+            if self._transport is not None:
+                await self._writable.wait()
+                self._transport.close()
+                self._connection_lost(self._protocol, None)
+
+
+transports = dict(streams=AbridgedTCP)
+if hasattr(asyncio, 'BufferedProtocol'):
+    transports['protocol'] = ProtocolAbridgedTCP
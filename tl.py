@@ -1 +1,1842 @@
-#!/usr/bin/env python3"""This is a prototype moduleThis module partly implements TL binary serialization for Telegram MTProto https://core.telegram.org/mtproto/serializeReading and parsing of scheme.tl is supported.Vectors and flags are hardcoded.int128 and int256 are read and written as 16 bytes and 32 bytesservice.tl is used to extend scheme.tl to implement certain service constructors that are not present in scheme.tlspecial basic types are added to support service.tl:ulong - 64 bit little endian unsigned integeruint - 32 bit little endian unsigned integersha1 - read and written as 20 bytesrawobject - any boxed typeobject - any type prepended by length as uintencrypted - ONLY for writing, just writes bytes as they are passed to the serialize functiongzip - ONLY for reading, a string that is gzip.decompressed upon reading"""__author__ = "Nikita Miropolskiy"__email__ = "nikita@miropolskiy.com"__license__ = "https://creativecommons.org/licenses/by-nc-nd/4.0/legalcode"__status__ = "Prototype"import binasciiimport functoolsimport gzip  # TODO make gzip async/threadedimport reimport structfrom byteutils import long_hex, pack_binary_string, unpack_binary_string, unpack_long_binary_string, \    pack_long_binary_string, Bytedata, base64decode, base64encode@functools.lru_cache()def _compile_cons_number(definition: bytes) -> bytes:    n = binascii.crc32(definition)    return n.to_bytes(4, 'little', signed=False)def _pack_flags(flags: set) -> bytes:    n = 0    for flag in flags:        n |= 1 << int(flag)    return n.to_bytes(4, 'little', signed=False)@functools.lru_cache()def unpack_flags(n: int) -> list:    i = 0    flags = []    while n > 0:        if n % 2 == 1:            flags.append(i)        i += 1        n >>= 1    return flags_schemeRE = re.compile(    r'^(?P<empty>$)'    r'|(?P<comment>//.*)'    r'|(?P<typessection>---types---)'    r'|(?P<functionssection>---functions---)'    r'|(?P<vector>vector#1cb5c415 {t:Type} # \[ t ] = Vector t;)'    r'|(?P<cons>(?P<name>[a-zA-Z0-9._]+)(#(?P<number>[a-f0-9]{1,8}))?'    r'(?P<xtype> {X:Type})?'    r'(?P<flags> flags:#)?'    r'(?P<parameters>.*?)'    r'(?(xtype) query:!X = X| = (?P<type>[a-zA-Z0-9._<>]+));)'    r'$')_parameterRE = re.compile(    r'^(?P<name>[a-zA-Z0-9_]+):'    r'(flags.(?P<flag_number>\d+)\?)?'    r'(?P<type>'    r'(?P<vector>((?P<bare_vector>vector)|(?P<boxed_vector>Vector))<)?'    r'(?P<element_type>((?P<namespace>[a-zA-Z0-9._]*)\.)?((?P<bare>[a-z][a-zA-Z0-9._]*)|(?P<boxed>[A-Z][a-zA-Z0-9._]*)))'    r'(?(vector)>)?)$')# a collection of constructorsclass Scheme:    def __init__(self, in_thread, scheme_data):        self.constructors = dict()        self.types = dict()        self.cons_numbers = dict()        self._parse_file(scheme_data)        self._in_thread = in_thread    def __repr__(self):        return '\n'.join(repr(cons) for cons in self.constructors.values())    def _parse_file(self, scheme_data):        for scheme_line in scheme_data.split('\n'):            self._parse_line(scheme_line)    @staticmethod    def _parse_token(regex, s: str):        match = regex.match(s)        if not match:            return None        else:            return {k: v for k, v in match.groupdict().items() if v is not None}    def _parse_line(self, line):        cons_parsed = self._parse_token(_schemeRE, line)        if not cons_parsed:            raise SyntaxError('Error in scheme: `%s`' % line)        if 'cons' not in cons_parsed:            return        parameter_tokens = cons_parsed['parameters'].split(' ')[1:]        parameters = []        if 'number' in cons_parsed:            con_number_int = int(cons_parsed['number'], base=16)            cons_number = con_number_int.to_bytes(4, 'little', signed=False)        else:            cons_number = None        for parameter_token in parameter_tokens:            parameter_parsed = self._parse_token(_parameterRE, parameter_token)            if not parameter_parsed:                raise SyntaxError('Error in parameter `%s`' % parameter_token)            is_vector = 'vector' in parameter_parsed            element_parameter = Parameter(                    pname='<element of vector `%s`>' % parameter_parsed['name'],                    ptype=parameter_parsed['element_type'],                    is_boxed='boxed' in parameter_parsed                ) if is_vector else None            parameter = Parameter(                pname=parameter_parsed['name'],                ptype=parameter_parsed['type'],                flag_number=int(parameter_parsed['flag_number']) if 'flag_number' in parameter_parsed else None,                is_vector=is_vector,                is_boxed='boxed_vector' in parameter_parsed if is_vector else 'boxed' in parameter_parsed,                element_parameter=element_parameter            )            parameters.append(parameter)        if 'xtype' in cons_parsed:            parameters.append(Parameter(                pname='_wrapped', ptype='rawobject', flag_number=None,                is_vector=False, is_boxed=True, element_parameter=None            ))        cons = Constructor(            scheme=self,            ptype=None if 'xtype' in cons_parsed else cons_parsed['type'],            name=cons_parsed['name'],            number=cons_number,            has_flags='flags' in cons_parsed,            parameters=parameters        )        self.constructors[cons.name] = cons        self.cons_numbers[cons.number] = cons        if cons.type not in self.types:            self.types[cons.type] = set()        self.types[cons.type].add(cons)    def typecheck(self, parameter, argument):        if not isinstance(argument, Value):             return False, 'not an object for nonbasic type'        if parameter.is_boxed:            if parameter.type not in self.types:                return False, 'unknown type'            if argument.cons not in self.types[parameter.type]:                return False, 'type mismatch'            if not argument.boxed:                return False, 'expected boxed, found bare'        else:            if parameter.type not in self.constructors:                return False, 'unknown constructor'            if argument.cons != self.constructors[parameter.type]:                return False, 'wrong constructor'            if argument.boxed:                return False, 'expected bare, found boxed'        return True, 'Ok'    async def deserialize(self, bytereader, parameter=None):        if parameter.is_boxed:            if parameter.type is not None and parameter.type not in self.types:                raise ValueError("Unknown type `%s`" % parameter.type)            cons_number = await bytereader(4)            if cons_number not in self.cons_numbers:                raise ValueError("Unknown constructor %s" % hex(int.from_bytes(cons_number, 'little')))            cons = self.cons_numbers[cons_number]            if parameter.type is not None and cons not in self.types[parameter.type]:                raise ValueError("type mismatch, constructor `%s` not in type `%s`" % (cons.name, parameter.type))        else:            if parameter.type not in self.constructors:                raise ValueError("Unknown constructor in parameter `%r`" % parameter)            cons = self.constructors[parameter.type]        return await cons.deserialize_bare_data(bytereader)    def serialize(self, boxed: bool, **kwargs):        cons_name = kwargs['_cons']        if cons_name not in self.constructors:            raise NotImplementedError('Constructor `%s` not present in scheme.' % cons_name)        cons = self.constructors[cons_name]        return cons.serialize(boxed=boxed, **kwargs)    def bare(self, **kwargs):        return self.serialize(boxed=False, **kwargs)    def boxed(self, **kwargs):        return self.serialize(boxed=True, **kwargs)    async def read(self, bytereader, is_boxed=True, parameter_type=None):        parameter = Parameter('', parameter_type, is_boxed=is_boxed)        return await self.deserialize(bytereader, parameter)    async def read_from_string(self, string: bytes, *args, **kwargs):        bytedata = Bytedata(string)        return await self.read(bytedata.cororead, *args, **kwargs)# a serialized TL Value that will be sentclass Value:    def __init__(self, cons, boxed: bool=False):        self.cons = cons        self.boxed = boxed        if self.boxed and self.cons.number is None:            raise RuntimeError("Tried to create a boxed value for a numberless constructor `%r`" % cons)        self._flags = set()        self._data = []    def set_flag(self, flag_number: int):        if not self.cons.has_flags:            raise TypeError('Conditional data added to plain constructor `%r`' % self.cons)        if flag_number in self._flags:            raise ValueError('Data with flag `%d` is already present in constructor `%s`' % (flag_number, self.cons))        self._flags.add(flag_number)    def append(self, data: bytes):        self._data.append(data)    def __repr__(self):        return '%s(%r)\n%s' % ('boxed' if self.boxed else 'bare', self.cons, long_hex(self.get_flat_bytes()))    def get_flat_bytes(self):        prefix = b''        if self.boxed:            prefix += self.cons.number        if self.cons.has_flags:            prefix += _pack_flags(self._flags)        return prefix + b''.join(map(lambda k: k.get_flat_bytes() if isinstance(k, Value) else k, self._data))# a deserialized TL Value that was receivedclass Structure:    def __init__(self, constructor_name: str):        self._constructor_name = constructor_name        self._fields = dict()    def __eq__(self, other):        if isinstance(other, str):            return self._constructor_name == other    def __repr__(self):        return repr(self.get_dict())    def __getattr__(self, name):        if name not in self._fields:            raise AttributeError("Attribute `%s` not found in `%r`" % (name, self))        return self._fields[name]    def get_dict(self):        return Structure._get_dict(self)    @staticmethod    def _get_dict(anything):        if isinstance(anything, Structure):            ret = dict(_cons=anything._constructor_name)            ret.update({key: Structure._get_dict(value) for key, value in anything._fields.items()})            return ret        elif isinstance(anything, (list, tuple)):            return [Structure._get_dict(value) for value in anything]        elif isinstance(anything, bytes):            try:                return anything.decode('utf-8')            except UnicodeDecodeError:                return "could not decode bytes object :O"        else:            return anything# a parameter in TL Constructor or TL Functionclass Parameter:    def __init__(self, pname: str, ptype: str, is_boxed: bool,                 flag_number: int=None,                 is_vector: bool=False,                 element_parameter=None                 ):        self.name = pname        self.type = ptype        self.flag_number = flag_number        self.is_vector = is_vector        self.is_boxed = is_boxed        self.element_parameter = element_parameter    def __repr__(self):        if self.flag_number is not None:            return '%s:flags.%d?%s' % (self.name, self.flag_number, self.type)        else:            return '%s:%s' % (self.name, self.type)# a TL Constructor or TL Functionclass Constructor:    def __init__(self, scheme, ptype: str, name: str, number: bytes, has_flags: bool, parameters):        self.scheme = scheme        self.name = name        self.number = number        self.type = ptype        self.has_flags = has_flags        self._parameters = parameters    def __repr__(self):        return '%s %s= %s;' % (self.name, ''.join('%r ' % p for p in self._parameters), self.type)    def _serialize_argument(self, data, parameter, argument):        if isinstance(argument, str):            argument = argument.encode('utf-8')        if isinstance(argument, dict):            argument = self.scheme.serialize(boxed=parameter.is_boxed, **argument)        if parameter.type == 'int':            data.append(int(argument).to_bytes(4, 'little', signed=True))        elif parameter.type == 'uint':            data.append(int(argument).to_bytes(4, 'little', signed=False))        elif parameter.type == 'long':            data.append(int(argument).to_bytes(8, 'little', signed=True))        elif parameter.type == 'ulong':            data.append(int(argument).to_bytes(8, 'little', signed=False))        elif parameter.type == 'int128': # it's more convenient to handle long ints as bytes            if len(argument) != 16:                raise ValueError("Expected 16 bytes, got %d bytes" % len(argument))            data.append(argument)        elif parameter.type == 'sha1': # it's more convenient to handle long ints as bytes            if len(argument) != 20:                raise ValueError("Expected 20 bytes, got %d bytes" % len(argument))            data.append(argument)        elif parameter.type == 'int256': # it's more convenient to handle long ints as bytes            if len(argument) != 32:                raise ValueError("Expected 32 bytes, got %d bytes" % len(argument))            data.append(argument)        elif parameter.type == 'double':            data.append(struct.pack(b'<d', float(argument)))        elif parameter.type == 'string':            if isinstance(argument, str):                argument = argument.encode('utf-8')            if not isinstance(argument, bytes):                raise TypeError('Wrong argument `%r` for parameter `%r` in `%s`, expected bytes or string' % (argument, parameter, self.name))            data.append(pack_binary_string(argument))        elif parameter.type == 'bytes':            argument = base64decode(argument)            data.append(pack_binary_string(argument))        elif parameter.type == 'object':            data.append(pack_long_binary_string(argument.get_flat_bytes()))        elif parameter.type == 'rawobject':            argument.boxed = True            data.append(argument)        elif parameter.type == 'encrypted':            data.append(argument)        elif parameter.is_vector:            if parameter.is_boxed:                data.append(_compile_cons_number(b'vector t:Type # [ t ] = Vector t'))            data.append(len(argument).to_bytes(4, 'little', signed=False))            for element_argument in argument:                self._serialize_argument(data, parameter.element_parameter, element_argument)        else:            typecheck, type_error = self.scheme.typecheck(parameter, argument)            if not typecheck:                raise TypeError('Wrong argument `%r` for parameter `%r` in `%s`, %s' % (argument, parameter, self.name, type_error))            data.append(argument)        if parameter.flag_number is not None:            data.set_flag(parameter.flag_number)    def serialize(self, boxed: bool, **arguments):        data = Value(self, boxed=boxed)        for parameter in self._parameters:            if parameter.name not in arguments:                if parameter.flag_number is None:                    raise TypeError('required `%s` not found in `%s`' % (parameter, self.name))                else:                    pass            else:                argument = arguments[parameter.name]                self._serialize_argument(data, parameter, argument)        return data    async def _deserialize_argument(self, bytereader, parameter):        if parameter.type == 'int':            return int.from_bytes(await bytereader(4), 'little', signed=True)        elif parameter.type == 'uint':            return int.from_bytes(await bytereader(4), 'little', signed=False)        elif parameter.type == 'long':            return int.from_bytes(await bytereader(8), 'little', signed=True)        elif parameter.type == 'ulong':            return int.from_bytes(await bytereader(8), 'little', signed=False)        elif parameter.type == 'int128':            return await bytereader(16)        elif parameter.type == 'sha1':            return await bytereader(20)        elif parameter.type == 'int256':            return await bytereader(32)        elif parameter.type == 'double':            return struct.unpack(b'<d', await bytereader(8))        elif parameter.type == 'string':            return await unpack_binary_string(bytereader)        elif parameter.type == 'bytes':            return base64encode(await unpack_binary_string(bytereader))        elif parameter.type == 'gzip':            unpacked = self.scheme._in_thread(gzip.decompress, await unpack_binary_string(bytereader))            return await self.scheme.read_from_string(await unpacked)        elif parameter.type == 'rawobject':            return await self.scheme.read(bytereader)        elif parameter.type == 'object':            return await self.scheme.read_from_string(await unpack_long_binary_string(bytereader))        elif parameter.is_vector:                if parameter.is_boxed:                    vcons = await bytereader(4)                    if vcons != _compile_cons_number(b'vector t:Type # [ t ] = Vector t'):                        raise ValueError("Not vector `%s` in `%r` in `%r`" % (long_hex(vcons), parameter, self))                vlen = int.from_bytes(await bytereader(4), 'little', signed=False)                return [(await self._deserialize_argument(bytereader, parameter.element_parameter)) for _ in range(vlen)]        else:            return await self.scheme.deserialize(bytereader, parameter)    async def deserialize_bare_data(self, bytedata):        if self.has_flags:            flags = unpack_flags(int.from_bytes(await bytedata(4), 'little', signed=False))            parameters = [p for p in self._parameters if p.flag_number is None or p.flag_number in flags]        else:            parameters = self._parameters        result = Structure(self.name)        for parameter in parameters:            argument = await self._deserialize_argument(bytedata, parameter)            result._fields[parameter.name] = argument        return result
\ No newline at end of file
+#!/usr/bin/env python3
+"""This is a prototype module
+
+This module partly implements TL binary serialization for Telegram MTProto 
+https://core.telegram.org/mtproto/serialize
+
+Reading and parsing of scheme.tl is supported.
+Vectors and flags are hardcoded.
+
+int128 and int256 are read and written as 16 bytes and 32 bytes
+
+service.tl is used to extend scheme.tl to implement certain service constructors that are not present in scheme.tl
+special basic types are added to support service.tl:
+
+ulong - 64 bit little endian unsigned integer
+uint - 32 bit little endian unsigned integer
+sha1 - read and written as 20 bytes
+rawobject - any boxed type
+object - any type prepended by length as uint
+encrypted - ONLY for writing, just writes bytes as they are passed to the serialize function
+gzip - a string that is gzip-decompressed upon reading (up to Scheme.gzip_max_size bytes), a boxed
+       object is gzip-compressed upon writing
+
+Every constructor is compiled once into a reader and a writer closure, the compiled codecs are
+indexed by constructor id in Scheme.readers and by constructor name in Scheme.writers.
+Compiled readers create objects of a per-constructor Structure subclass with __slots__, names of
+constructors and fields are interned.
+Scheme(..., compiled=False) keeps the original interpreting codec, it's used as a reference and
+for benchmarking.
+
+Compiled readers come in two flavours: coroutines that read from an async bytereader and plain
+functions that unpack a complete buffer (bytes or memoryview) with struct.unpack_from,
+Scheme.unpack decodes a whole object without awaiting every field.
+
+Scheme.unpack(..., lazy=True) returns LazyStructure objects: fields are located in the buffer and
+decoded only upon first access, untouched fields are transcoded from the buffer directly to JSON.
+Scheme(..., lazy=True) unpacks object fields read from a stream lazily.
+
+"""
+
+__author__ = "Nikita Miropolskiy"
+__email__ = "nikita@miropolskiy.com"
+__license__ = "https://creativecommons.org/licenses/by-nc-nd/4.0/legalcode"
+__status__ = "Prototype"
+
+
+import binascii
+import functools
+import hashlib
+import json
+import marshal
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from byteutils import long_hex, pack_binary_string, unpack_binary_string, unpack_long_binary_string, \
+    pack_long_binary_string, Bytedata, base64decode, base64encode, binary_string_size, pack_binary_string_into
+
+
+@functools.lru_cache()
+def _compile_cons_number(definition: bytes) -> bytes:
+    n = binascii.crc32(definition)
+    return n.to_bytes(4, 'little', signed=False)
+
+
+def _pack_flags(flags: set) -> bytes:
+    n = 0
+    for flag in flags:
+        n |= 1 << int(flag)
+    return n.to_bytes(4, 'little', signed=False)
+
+
+@functools.lru_cache()
+def unpack_flags(n: int) -> list:
+    i = 0
+    flags = []
+    while n > 0:
+        if n % 2 == 1:
+            flags.append(i)
+        i += 1
+        n >>= 1
+    return flags
+
+
+_vector_number = _compile_cons_number(b'vector t:Type # [ t ] = Vector t')
+_vector_id = int.from_bytes(_vector_number, 'little', signed=False)
+
+
+# compiled readers of basic types
+async def _read_int(bytereader):
+    return int.from_bytes(await bytereader(4), 'little', signed=True)
+
+
+async def _read_uint(bytereader):
+    return int.from_bytes(await bytereader(4), 'little', signed=False)
+
+
+async def _read_long(bytereader):
+    return int.from_bytes(await bytereader(8), 'little', signed=True)
+
+
+async def _read_ulong(bytereader):
+    return int.from_bytes(await bytereader(8), 'little', signed=False)
+
+
+async def _read_int128(bytereader):
+    return bytes(await bytereader(16))
+
+
+async def _read_sha1(bytereader):
+    return bytes(await bytereader(20))
+
+
+async def _read_int256(bytereader):
+    return bytes(await bytereader(32))
+
+
+async def _read_double(bytereader):
+    return struct.unpack(b'<d', await bytereader(8))[0]
+
+
+async def _read_bytes(bytereader):
+    return base64encode(await unpack_binary_string(bytereader))
+
+
+_basic_readers = {
+    'int': _read_int,
+    'uint': _read_uint,
+    'long': _read_long,
+    'ulong': _read_ulong,
+    'int128': _read_int128,
+    'sha1': _read_sha1,
+    'int256': _read_int256,
+    'double': _read_double,
+    'string': unpack_binary_string,
+    'bytes': _read_bytes,
+}
+
+
+# compiled unpackers of basic types, an unpacker takes (data: memoryview, offset: int) and returns (value, offset)
+_unpack_int_from = struct.Struct('<i').unpack_from
+_unpack_uint_from = struct.Struct('<I').unpack_from
+_unpack_long_from = struct.Struct('<q').unpack_from
+_unpack_ulong_from = struct.Struct('<Q').unpack_from
+_unpack_double_from = struct.Struct('<d').unpack_from
+_pack_uint_into = struct.Struct('<I').pack_into
+
+
+def _unpack_int(data, offset):
+    return _unpack_int_from(data, offset)[0], offset + 4
+
+
+def _unpack_uint(data, offset):
+    return _unpack_uint_from(data, offset)[0], offset + 4
+
+
+def _unpack_long(data, offset):
+    return _unpack_long_from(data, offset)[0], offset + 8
+
+
+def _unpack_ulong(data, offset):
+    return _unpack_ulong_from(data, offset)[0], offset + 8
+
+
+def _unpack_double(data, offset):
+    return _unpack_double_from(data, offset)[0], offset + 8
+
+
+def _unpack_raw(data, offset, length):
+    end = offset + length
+    if end > len(data):
+        raise ValueError('Unexpected end of data while reading %d bytes at offset %d' % (length, offset))
+    return bytes(data[offset:end]), end
+
+
+def _fixed_length_unpacker(length: int):
+    def unpack_fixed_length(data, offset):
+        return _unpack_raw(data, offset, length)
+    return unpack_fixed_length
+
+
+def _unpack_string(data, offset):
+    strlen = data[offset]
+    if strlen > 0xfe:
+        raise RuntimeError("Length equal to 255 in string")
+    elif strlen == 0xfe:
+        strlen = int.from_bytes(data[offset + 1:offset + 4], 'little', signed=False)
+        s, offset = _unpack_raw(data, offset + 4, strlen)
+        return s, offset + (-strlen) % 4
+    else:
+        s, offset = _unpack_raw(data, offset + 1, strlen)
+        return s, offset + (3 - strlen) % 4
+
+
+def _unpack_bytes(data, offset):
+    s, offset = _unpack_string(data, offset)
+    return base64encode(s), offset
+
+
+_basic_unpackers = {
+    'int': _unpack_int,
+    'uint': _unpack_uint,
+    'long': _unpack_long,
+    'ulong': _unpack_ulong,
+    'int128': _fixed_length_unpacker(16),
+    'sha1': _fixed_length_unpacker(20),
+    'int256': _fixed_length_unpacker(32),
+    'double': _unpack_double,
+    'string': _unpack_string,
+    'bytes': _unpack_bytes,
+}
+
+
+# compiled skippers of basic types, a skipper takes (data: memoryview, offset: int) and returns offset after the value
+def _fixed_length_skipper(length: int):
+    def skip_fixed_length(data, offset):
+        offset += length
+        if offset > len(data):
+            raise ValueError('Unexpected end of data while skipping %d bytes' % length)
+        return offset
+    return skip_fixed_length
+
+
+def _skip_string(data, offset):
+    strlen = data[offset]
+    if strlen > 0xfe:
+        raise RuntimeError("Length equal to 255 in string")
+    elif strlen == 0xfe:
+        strlen = int.from_bytes(data[offset + 1:offset + 4], 'little', signed=False)
+        end = offset + 4 + strlen
+        padding = (-strlen) % 4
+    else:
+        end = offset + 1 + strlen
+        padding = (3 - strlen) % 4
+    if end > len(data):
+        raise ValueError('Unexpected end of data while skipping string of %d bytes' % strlen)
+    return end + padding
+
+
+def _skip_object(data, offset):
+    length = _unpack_uint_from(data, offset)[0]
+    end = offset + 4 + length
+    if end > len(data):
+        raise ValueError('Unexpected end of data while reading object of %d bytes' % length)
+    return end
+
+
+_basic_sizes = {
+    'int': 4,
+    'uint': 4,
+    'long': 8,
+    'ulong': 8,
+    'int128': 16,
+    'sha1': 20,
+    'int256': 32,
+    'double': 8,
+}
+
+
+# vectors of these types are packed and unpacked with a single struct call
+_bulk_vector_formats = {
+    'int': 'i',
+    'uint': 'I',
+    'long': 'q',
+    'ulong': 'Q',
+    'double': 'd',
+}
+
+
+_basic_skippers = {
+    'int': _fixed_length_skipper(4),
+    'uint': _fixed_length_skipper(4),
+    'long': _fixed_length_skipper(8),
+    'ulong': _fixed_length_skipper(8),
+    'int128': _fixed_length_skipper(16),
+    'sha1': _fixed_length_skipper(20),
+    'int256': _fixed_length_skipper(32),
+    'double': _fixed_length_skipper(8),
+    'string': _skip_string,
+    'bytes': _skip_string,
+}
+
+
+# compiled writers of basic types
+def _write_int(data, argument):
+    data.append(int(argument).to_bytes(4, 'little', signed=True))
+
+
+def _write_uint(data, argument):
+    data.append(int(argument).to_bytes(4, 'little', signed=False))
+
+
+def _write_long(data, argument):
+    data.append(int(argument).to_bytes(8, 'little', signed=True))
+
+
+def _write_ulong(data, argument):
+    data.append(int(argument).to_bytes(8, 'little', signed=False))
+
+
+def _fixed_length_writer(length: int):
+    # it's more convenient to handle long ints as bytes
+    def write_fixed_length(data, argument):
+        if isinstance(argument, str):
+            argument = argument.encode('utf-8')
+        if len(argument) != length:
+            raise ValueError("Expected %d bytes, got %d bytes" % (length, len(argument)))
+        data.append(argument)
+    return write_fixed_length
+
+
+def _write_double(data, argument):
+    data.append(struct.pack(b'<d', float(argument)))
+
+
+def _write_bytes(data, argument):
+    if isinstance(argument, str):
+        argument = argument.encode('utf-8')
+    data.append(_PackedString(base64decode(argument)))
+
+
+def _write_encrypted(data, argument):
+    if isinstance(argument, str):
+        argument = argument.encode('utf-8')
+    data.append(argument)
+
+
+_basic_writers = {
+    'int': _write_int,
+    'uint': _write_uint,
+    'long': _write_long,
+    'ulong': _write_ulong,
+    'int128': _fixed_length_writer(16),
+    'sha1': _fixed_length_writer(20),
+    'int256': _fixed_length_writer(32),
+    'double': _write_double,
+    'bytes': _write_bytes,
+    'encrypted': _write_encrypted,
+}
+
+
+_layerRE = re.compile(r'^// LAYER (?P<layer>\d+)\s*$', re.MULTILINE)
+
+_schemeRE = re.compile(
+    r'^(?P<empty>$)'
+    r'|(?P<comment>//.*)'
+    r'|(?P<typessection>---types---)'
+    r'|(?P<functionssection>---functions---)'
+    r'|(?P<vector>vector#1cb5c415 {t:Type} # \[ t ] = Vector t;)'
+    r'|(?P<cons>(?P<name>[a-zA-Z0-9._]+)(#(?P<number>[a-f0-9]{1,8}))?'
+    r'(?P<xtype> {X:Type})?'
+    r'(?P<flags> flags:#)?'
+    r'(?P<parameters>.*?)'
+    r'(?(xtype) query:!X = X| = (?P<type>[a-zA-Z0-9._<>]+));)'
+    r'$'
+)
+
+_parameterRE = re.compile(
+    r'^(?P<name>[a-zA-Z0-9_]+):'
+    r'(flags.(?P<flag_number>\d+)\?)?'
+    r'(?P<type>'
+    r'(?P<vector>((?P<bare_vector>vector)|(?P<boxed_vector>Vector))<)?'
+    r'(?P<element_type>((?P<namespace>[a-zA-Z0-9._]*)\.)?((?P<bare>[a-z][a-zA-Z0-9._]*)|(?P<boxed>[A-Z][a-zA-Z0-9._]*)))'
+    r'(?(vector)>)?)$'
+)
+
+
+# gzip_packed payloads are decompressed up to this size by default
+GZIP_MAX_SIZE = 64 * 2 ** 20
+
+# 16 + MAX_WBITS selects the gzip container for zlib
+_gzip_wbits = 16 + zlib.MAX_WBITS
+
+
+# compression counters, updated from executor threads
+class GzipCounters:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.packed = 0
+        self.packed_in = 0
+        self.packed_out = 0
+        self.pack_time = 0.0
+        self.unpacked = 0
+        self.unpacked_in = 0
+        self.unpacked_out = 0
+        self.unpack_time = 0.0
+
+    def add_packed(self, size_in: int, size_out: int, elapsed: float):
+        with self._lock:
+            self.packed += 1
+            self.packed_in += size_in
+            self.packed_out += size_out
+            self.pack_time += elapsed
+
+    def add_unpacked(self, size_in: int, size_out: int, elapsed: float):
+        with self._lock:
+            self.unpacked += 1
+            self.unpacked_in += size_in
+            self.unpacked_out += size_out
+            self.unpack_time += elapsed
+
+    def get_dict(self) -> dict:
+        with self._lock:
+            return dict(
+                packed=self.packed,
+                packed_in=self.packed_in,
+                packed_out=self.packed_out,
+                pack_ratio=self.packed_in / self.packed_out if self.packed_out else 0.0,
+                pack_time=self.pack_time,
+                unpacked=self.unpacked,
+                unpacked_in=self.unpacked_in,
+                unpacked_out=self.unpacked_out,
+                unpack_ratio=self.unpacked_out / self.unpacked_in if self.unpacked_in else 0.0,
+                unpack_time=self.unpack_time,
+            )
+
+
+# a collection of constructors
+class Scheme:
+    def __init__(self, in_thread, scheme_data, compiled=True, cache_filename=None, lazy=False,
+                 gzip_max_size=GZIP_MAX_SIZE):
+        self.constructors = dict()
+        self.types = dict()
+        self.cons_numbers = dict()
+        self.readers = dict()  # constructor id -> compiled reader of bare data
+        self.writers = dict()  # constructor name -> compiled writer
+        self.unpackers = dict()  # constructor id -> compiled unpacker of bare data
+        self.lazy_unpackers = dict()  # constructor id -> compiled unpacker returning LazyStructure
+        self.skippers = dict()  # constructor id -> compiled function returning offset after bare data
+        self.json_dumpers = dict()  # constructor id -> compiled transcoder of bare data to JSON
+        self.compiled = compiled
+        self.lazy = lazy
+        self.gzip_max_size = gzip_max_size
+        self.gzip_counters = GzipCounters()
+        self.layer = self._parse_layer(scheme_data)
+        self._boxed_readers = dict()
+        self._boxed_codecs = dict()
+        if cache_filename is None:
+            self._parse_file(scheme_data)
+        else:
+            self._load_cached(scheme_data, cache_filename)
+        self._in_thread = in_thread
+        if compiled:
+            self._compile()
+
+    def __repr__(self):
+        return '\n'.join(repr(cons) for cons in self.constructors.values())
+
+    # scheme.tl ends with a `// LAYER N` comment
+    @staticmethod
+    def _parse_layer(scheme_data):
+        layer = _layerRE.search(scheme_data)
+        return int(layer.group('layer')) if layer is not None else None
+
+    def _parse_file(self, scheme_data):
+        for definition in self._parse_definitions(scheme_data):
+            self._add_constructor(*definition)
+
+    def _load_cached(self, scheme_data, cache_filename):
+        # the cache contains parsed constructor definitions as plain tuples, it's keyed by the scheme contents
+        scheme_hash = hashlib.sha256(scheme_data.encode('utf-8')).digest()
+        try:
+            with open(cache_filename, 'rb') as cache_file:
+                cached_hash, definitions = marshal.load(cache_file)
+        except (OSError, EOFError, ValueError, TypeError):
+            cached_hash, definitions = None, None
+        if cached_hash != scheme_hash:
+            definitions = self._parse_definitions(scheme_data)
+            try:
+                with open(cache_filename + '.tmp', 'wb') as cache_file:
+                    marshal.dump((scheme_hash, definitions), cache_file)
+                os.replace(cache_filename + '.tmp', cache_filename)
+            except OSError:
+                pass  # read-only installation, no cache then
+        for definition in definitions:
+            self._add_constructor(*definition)
+
+    @staticmethod
+    def _parse_token(regex, s: str):
+        match = regex.match(s)
+        if not match:
+            return None
+        else:
+            return {k: v for k, v in match.groupdict().items() if v is not None}
+
+    @staticmethod
+    def _parse_definitions(scheme_data) -> list:
+        definitions = []
+        for scheme_line in scheme_data.split('\n'):
+            definition = Scheme._parse_line(scheme_line)
+            if definition is not None:
+                definitions.append(definition)
+        return definitions
+
+    # returns a definition of constructor as a tuple of basic types
+    @staticmethod
+    def _parse_line(line):
+        cons_parsed = Scheme._parse_token(_schemeRE, line)
+        if not cons_parsed:
+            raise SyntaxError('Error in scheme: `%s`' % line)
+        if 'cons' not in cons_parsed:
+            return None
+        parameter_tokens = cons_parsed['parameters'].split(' ')[1:]
+        parameters = []
+        if 'number' in cons_parsed:
+            con_number_int = int(cons_parsed['number'], base=16)
+            cons_number = con_number_int.to_bytes(4, 'little', signed=False)
+        else:
+            cons_number = None
+        for parameter_token in parameter_tokens:
+            parameter_parsed = Scheme._parse_token(_parameterRE, parameter_token)
+            if not parameter_parsed:
+                raise SyntaxError('Error in parameter `%s`' % parameter_token)
+            is_vector = 'vector' in parameter_parsed
+            element_parameter = (
+                '<element of vector `%s`>' % parameter_parsed['name'],
+                parameter_parsed['element_type'],
+                'boxed' in parameter_parsed,
+                None, False, None
+            ) if is_vector else None
+            parameters.append((
+                parameter_parsed['name'],
+                parameter_parsed['type'],
+                'boxed_vector' in parameter_parsed if is_vector else 'boxed' in parameter_parsed,
+                int(parameter_parsed['flag_number']) if 'flag_number' in parameter_parsed else None,
+                is_vector,
+                element_parameter
+            ))
+        if 'xtype' in cons_parsed:
+            parameters.append(('_wrapped', 'rawobject', True, None, False, None))
+        return (
+            None if 'xtype' in cons_parsed else cons_parsed['type'],
+            cons_parsed['name'],
+            cons_number,
+            'flags' in cons_parsed,
+            parameters
+        )
+
+    @staticmethod
+    def _make_parameter(pname, ptype, is_boxed, flag_number, is_vector, element_parameter):
+        return Parameter(
+            pname=pname,
+            ptype=ptype,
+            is_boxed=is_boxed,
+            flag_number=flag_number,
+            is_vector=is_vector,
+            element_parameter=Scheme._make_parameter(*element_parameter) if element_parameter else None
+        )
+
+    def _add_constructor(self, ptype, name, number, has_flags, parameters):
+        cons = Constructor(
+            scheme=self,
+            ptype=ptype,
+            name=name,
+            number=number,
+            has_flags=has_flags,
+            parameters=[self._make_parameter(*parameter) for parameter in parameters]
+        )
+        self.constructors[cons.name] = cons
+        self.cons_numbers[cons.number] = cons
+        if cons.type not in self.types:
+            self.types[cons.type] = set()
+        self.types[cons.type].add(cons)
+
+    def _compile(self):
+        # scheme.tl constructors may be shadowed by service.tl constructors with the same name
+        all_constructors = set(self.constructors.values()) | set(self.cons_numbers.values())
+        for cons in all_constructors:
+            cons.compile()
+            if cons.number is not None:
+                cons_id = int.from_bytes(cons.number, 'little', signed=False)
+                self.readers[cons_id] = cons.read_bare
+                self.unpackers[cons_id] = cons.unpack_bare
+                self.lazy_unpackers[cons_id] = cons.lazy_unpack_bare
+                self.skippers[cons_id] = cons.skip_bare
+                self.json_dumpers[cons_id] = cons.json_dump_bare
+        for cons in self.constructors.values():
+            self.writers[cons.name] = cons.write
+
+    def _unknown_constructor_error(self, cons_id: int, ptype: str):
+        if cons_id not in self.readers:
+            return ValueError("Unknown constructor %s" % hex(cons_id))
+        cons = self.cons_numbers[cons_id.to_bytes(4, 'little', signed=False)]
+        return ValueError("type mismatch, constructor `%s` not in type `%s`" % (cons.name, ptype))
+
+    def boxed_reader(self, ptype):
+        if ptype in self._boxed_readers:
+            return self._boxed_readers[ptype]
+        readers = self.readers
+        if ptype is None:
+            async def read_boxed(bytereader):
+                cons_id = int.from_bytes(await bytereader(4), 'little', signed=False)
+                if cons_id not in readers:
+                    raise self._unknown_constructor_error(cons_id, ptype)
+                return await readers[cons_id](bytereader)
+        elif ptype not in self.types:
+            async def read_boxed(bytereader):
+                raise ValueError("Unknown type `%s`" % ptype)
+        else:
+            type_cons_ids = frozenset(
+                int.from_bytes(cons.number, 'little', signed=False)
+                for cons in self.types[ptype] if cons.number is not None
+            )
+
+            async def read_boxed(bytereader):
+                cons_id = int.from_bytes(await bytereader(4), 'little', signed=False)
+                if cons_id not in type_cons_ids:
+                    raise self._unknown_constructor_error(cons_id, ptype)
+                return await readers[cons_id](bytereader)
+        self._boxed_readers[ptype] = read_boxed
+        return read_boxed
+
+    def bare_reader(self, ptype):
+        if ptype not in self.constructors:
+            async def read_unknown(bytereader):
+                raise ValueError("Unknown constructor in parameter `%s`" % ptype)
+            return read_unknown
+        cons = self.constructors[ptype]
+        cons.compile()
+        return cons.read_bare
+
+    # a codec is a compiled function taking (data: memoryview, offset: int, *args),
+    # kind is a name of constructor id table: unpackers, lazy_unpackers, skippers or json_dumpers
+    def boxed_codec(self, kind: str, ptype):
+        if (kind, ptype) in self._boxed_codecs:
+            return self._boxed_codecs[kind, ptype]
+        codecs = getattr(self, kind)
+        if ptype is not None and ptype not in self.types:
+            def codec_boxed(data, offset, *args):
+                raise ValueError("Unknown type `%s`" % ptype)
+            self._boxed_codecs[kind, ptype] = codec_boxed
+            return codec_boxed
+        if ptype is None:
+            type_cons_ids = codecs
+        else:
+            type_cons_ids = frozenset(
+                int.from_bytes(cons.number, 'little', signed=False)
+                for cons in self.types[ptype] if cons.number is not None
+            )
+        # no *args here, this is the hottest function of decoding
+        if kind == 'json_dumpers':
+            def codec_boxed(data, offset, out):
+                cons_id = _unpack_uint_from(data, offset)[0]
+                if cons_id not in type_cons_ids:
+                    raise self._unknown_constructor_error(cons_id, ptype)
+                return codecs[cons_id](data, offset + 4, out)
+        else:
+            def codec_boxed(data, offset):
+                cons_id = _unpack_uint_from(data, offset)[0]
+                if cons_id not in type_cons_ids:
+                    raise self._unknown_constructor_error(cons_id, ptype)
+                return codecs[cons_id](data, offset + 4)
+        self._boxed_codecs[kind, ptype] = codec_boxed
+        return codec_boxed
+
+    # attribute is a name of compiled Constructor codec: unpack_bare, lazy_unpack_bare, skip_bare or json_dump_bare
+    def bare_codec(self, attribute: str, ptype):
+        if ptype not in self.constructors:
+            def codec_unknown(data, offset, *args):
+                raise ValueError("Unknown constructor in parameter `%s`" % ptype)
+            return codec_unknown
+        cons = self.constructors[ptype]
+        cons.compile()
+        return getattr(cons, attribute)
+
+    def typecheck(self, parameter, argument):
+        if not isinstance(argument, Value):
+             return False, 'not an object for nonbasic type'
+        if parameter.is_boxed:
+            if parameter.type not in self.types:
+                return False, 'unknown type'
+            if argument.cons not in self.types[parameter.type]:
+                return False, 'type mismatch'
+            if not argument.boxed:
+                return False, 'expected boxed, found bare'
+        else:
+            if parameter.type not in self.constructors:
+                return False, 'unknown constructor'
+            if argument.cons != self.constructors[parameter.type]:
+                return False, 'wrong constructor'
+            if argument.boxed:
+                return False, 'expected bare, found boxed'
+        return True, 'Ok'
+
+    async def deserialize(self, bytereader, parameter=None):
+        if parameter.is_boxed:
+            if parameter.type is not None and parameter.type not in self.types:
+                raise ValueError("Unknown type `%s`" % parameter.type)
+            cons_number = bytes(await bytereader(4))
+            if cons_number not in self.cons_numbers:
+                raise ValueError("Unknown constructor %s" % hex(int.from_bytes(cons_number, 'little')))
+            cons = self.cons_numbers[cons_number]
+            if parameter.type is not None and cons not in self.types[parameter.type]:
+                raise ValueError("type mismatch, constructor `%s` not in type `%s`" % (cons.name, parameter.type))
+        else:
+            if parameter.type not in self.constructors:
+                raise ValueError("Unknown constructor in parameter `%r`" % parameter)
+            cons = self.constructors[parameter.type]
+        return await cons.deserialize_bare_data(bytereader)
+
+    def serialize(self, boxed: bool, **kwargs):
+        cons_name = kwargs['_cons']
+        if cons_name not in self.constructors:
+            raise NotImplementedError('Constructor `%s` not present in scheme.' % cons_name)
+        if self.compiled:
+            return self.writers[cons_name](boxed, kwargs)
+        cons = self.constructors[cons_name]
+        return cons.serialize(boxed=boxed, **kwargs)
+
+    def bare(self, **kwargs):
+        return self.serialize(boxed=False, **kwargs)
+
+    def boxed(self, **kwargs):
+        return self.serialize(boxed=True, **kwargs)
+
+    async def read(self, bytereader, is_boxed=True, parameter_type=None):
+        if self.compiled:
+            if is_boxed:
+                return await self.boxed_reader(parameter_type)(bytereader)
+            return await self.bare_reader(parameter_type)(bytereader)
+        parameter = Parameter('', parameter_type, is_boxed=is_boxed)
+        return await self.deserialize(bytereader, parameter)
+
+    async def read_from_string(self, string: bytes, *args, **kwargs):
+        if self.compiled:
+            return self.unpack(string, *args, **kwargs)
+        bytedata = Bytedata(string)
+        return await self.read(bytedata.cororead, *args, **kwargs)
+
+    # decodes a complete object from bytes or memoryview, only for compiled schemes
+    def unpack(self, data, is_boxed=True, parameter_type=None, lazy=False):
+        data = memoryview(data)
+        if lazy:
+            if is_boxed:
+                return self.boxed_codec('lazy_unpackers', parameter_type)(data, 0)
+            return self.bare_codec('lazy_unpack_bare', parameter_type)(data, 0)
+        if is_boxed:
+            return self.boxed_codec('unpackers', parameter_type)(data, 0)[0]
+        return self.bare_codec('unpack_bare', parameter_type)(data, 0)[0]
+
+    # decompresses gzip_packed data, the output is capped at gzip_max_size instead of trusting the server
+    def gunzip(self, data) -> bytes:
+        started = time.perf_counter()
+        decompressor = zlib.decompressobj(_gzip_wbits)
+        unpacked = decompressor.decompress(data, self.gzip_max_size)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Unpacked gzip data exceeds %d bytes" % self.gzip_max_size)
+        if not decompressor.eof:
+            raise EOFError("Compressed gzip data ended before the end-of-stream marker was reached")
+        self.gzip_counters.add_unpacked(len(data), len(unpacked), time.perf_counter() - started)
+        return unpacked
+
+    def gzip(self, data, level: int = 6) -> bytes:
+        started = time.perf_counter()
+        compressor = zlib.compressobj(level, zlib.DEFLATED, _gzip_wbits)
+        packed = compressor.compress(data) + compressor.flush()
+        self.gzip_counters.add_packed(len(data), len(packed), time.perf_counter() - started)
+        return packed
+
+    # wraps a boxed value into gzip_packed, the original value is returned if compression doesn't pay off
+    def gzip_packed(self, value):
+        packed = self.boxed(_cons='gzip_packed', packed_data=value)
+        return packed if packed.get_size() < value.get_size() else value
+
+# a serialized TL Value that will be sent
+class Value:
+    def __init__(self, cons, boxed: bool=False):
+        self.cons = cons
+        self.boxed = boxed
+        if self.boxed and self.cons.number is None:
+            raise RuntimeError("Tried to create a boxed value for a numberless constructor `%r`" % cons)
+        self._flags = set()
+        self._data = []
+        self._size = 0
+
+    def set_flag(self, flag_number: int):
+        if not self.cons.has_flags:
+            raise TypeError('Conditional data added to plain constructor `%r`' % self.cons)
+        if flag_number in self._flags:
+            raise ValueError('Data with flag `%d` is already present in constructor `%s`' % (flag_number, self.cons))
+        self._flags.add(flag_number)
+
+    # data is either a bytes-like object or anything with get_size and pack_into methods
+    def append(self, data):
+        self._data.append(data)
+        self._size += len(data) if isinstance(data, _raw_data_types) else data.get_size()
+
+    def __repr__(self):
+        return '%s(%r)\n%s' % ('boxed' if self.boxed else 'bare', self.cons, long_hex(self.get_flat_bytes()))
+
+    def get_size(self) -> int:
+        return self._size + (4 if self.boxed else 0) + (4 if self.cons.has_flags else 0)
+
+    def pack_into(self, buffer, offset: int) -> int:
+        if self.boxed:
+            buffer[offset:offset + 4] = self.cons.number
+            offset += 4
+        if self.cons.has_flags:
+            buffer[offset:offset + 4] = _pack_flags(self._flags)
+            offset += 4
+        for data in self._data:
+            if isinstance(data, _raw_data_types):
+                end = offset + len(data)
+                buffer[offset:end] = data
+                offset = end
+            else:
+                offset = data.pack_into(buffer, offset)
+        return offset
+
+    # the whole value is written into a single buffer, padded with zeroes to a multiple of block_size
+    def get_buffer(self, block_size: int = 1) -> bytearray:
+        size = self.get_size()
+        buffer = bytearray(size + (-size) % block_size)
+        self.pack_into(buffer, 0)
+        return buffer
+
+    def get_flat_bytes(self) -> bytes:
+        return bytes(self.get_buffer())
+
+
+_raw_data_types = (bytes, bytearray, memoryview)
+
+
+# a string argument of Value, written with its length and padding
+class _PackedString:
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        self._data = data
+
+    def get_size(self) -> int:
+        return binary_string_size(len(self._data))
+
+    def pack_into(self, buffer, offset: int) -> int:
+        return pack_binary_string_into(buffer, offset, self._data)
+
+
+# an object argument of Value, written with its length as uint
+class _PackedObject:
+    __slots__ = ('_value',)
+
+    def __init__(self, value):
+        self._value = value
+
+    def get_size(self) -> int:
+        return 4 + self._value.get_size()
+
+    def pack_into(self, buffer, offset: int) -> int:
+        _pack_uint_into(buffer, offset, self._value.get_size())
+        return self._value.pack_into(buffer, offset + 4)
+
+
+# a deserialized TL Value that was received
+# compiled codecs create instances of per-constructor subclasses with a slot for every field,
+# constructor and field names are interned, so comparisons with string literals are identity checks
+class Structure:
+    __slots__ = ()
+
+    def __eq__(self, other):
+        if isinstance(other, str):
+            return self._constructor_name is other or self._constructor_name == other
+
+    def __repr__(self):
+        return repr(self.get_dict())
+
+    # only called for fields that are absent because of flags
+    def __getattr__(self, name):
+        raise AttributeError("Attribute `%s` not found in `%r`" % (name, self))
+
+    def get_dict(self):
+        return Structure._get_dict(self)
+
+    # the same as json.dumps(self.get_dict()).encode() but without building the dict
+    def get_json(self) -> bytes:
+        out = bytearray()
+        _dump_json(self, out)
+        return bytes(out)
+
+    # slots are read with their descriptors, absent fields are told by flags
+    def _items(self):
+        flags = self._flags
+        return [
+            (name, get_field(self))
+            for name, flag_number, get_field in self._field_getters
+            if flag_number is None or flags >> flag_number & 1
+        ]
+
+    @staticmethod
+    def _get_dict(anything):
+        if isinstance(anything, Structure):
+            ret = dict(_cons=anything._constructor_name)
+            ret.update({key: Structure._get_dict(value) for key, value in anything._items()})
+            return ret
+        elif isinstance(anything, (list, tuple)):
+            return [Structure._get_dict(value) for value in anything]
+        elif isinstance(anything, bytes):
+            try:
+                return anything.decode('utf-8')
+            except UnicodeDecodeError:
+                return "could not decode bytes object :O"
+        else:
+            return anything
+
+
+def _make_structure_class(cons):
+    field_names = tuple(parameter.name for parameter in cons._parameters)
+    namespace = dict(
+        __slots__=field_names + ('_flags',), _constructor_name=cons.name, _json_dumper=_dump_compact_structure_json
+    )
+    if not cons.has_flags:
+        namespace.update(__slots__=field_names, _flags=0)
+    structure_class = type(cons.name, (Structure,), namespace)
+    structure_class._field_getters = tuple(
+        (parameter.name, parameter.flag_number, getattr(structure_class, parameter.name).__get__)
+        for parameter in cons._parameters
+    )
+    structure_class._json_fields = tuple(
+        (_json_key(name), flag_number, get_field) for name, flag_number, get_field in structure_class._field_getters
+    )
+    return structure_class
+
+
+# a Structure with fields in a dict, it's created by the interpreting codec
+class DictStructure(Structure):
+    __slots__ = ('_constructor_name', '_fields')
+
+    def __init__(self, constructor_name: str):
+        self._constructor_name = constructor_name
+        self._fields = dict()
+
+    def __getattr__(self, name):
+        if name not in self._fields:
+            raise AttributeError("Attribute `%s` not found in `%r`" % (name, self))
+        return self._fields[name]
+
+    def _items(self):
+        return self._fields.items()
+
+
+# a deserialized TL Value that was received, fields are decoded from the buffer upon first access
+class LazyStructure(DictStructure):
+    __slots__ = ('_cons', '_data', '_flags', '_start', '_offsets', '_next_field', '_next_offset')
+
+    def __init__(self, cons, data: memoryview, offset: int, flags: int):
+        super().__init__(cons.name)
+        self._cons = cons
+        self._data = data
+        self._flags = flags
+        self._start = offset  # offset of the first field
+        self._offsets = dict()  # field name -> offset in data, fields are located one by one upon access
+        self._next_field = 0
+        self._next_offset = offset
+
+    def _is_present(self, flag_number):
+        return flag_number is None or self._flags >> flag_number & 1
+
+    def _locate(self, name):
+        offsets = self._offsets
+        lazy_fields = self._cons.lazy_fields
+        while name not in offsets:
+            pname, flag_number, size, skip_argument = lazy_fields[self._next_field][:4]
+            self._next_field += 1
+            if self._is_present(flag_number):
+                offsets[pname] = self._next_offset
+                if size is None:
+                    self._next_offset = skip_argument(self._data, self._next_offset)
+                else:
+                    self._next_offset += size
+        return offsets[name]
+
+    def __getattr__(self, name):
+        if name in self._fields:
+            return self._fields[name]
+        if name not in self._cons.lazy_field_index:
+            raise AttributeError("Attribute `%s` not found in `%r`" % (name, self))
+        _, flag_number, _, _, lazy_unpack_argument = self._cons.lazy_fields[self._cons.lazy_field_index[name]][:5]
+        if not self._is_present(flag_number):
+            raise AttributeError("Attribute `%s` not found in `%r`" % (name, self))
+        value = self._fields[name] = lazy_unpack_argument(self._data, self._locate(name))
+        return value
+
+    def _items(self):
+        return (
+            (lazy_field[0], getattr(self, lazy_field[0]))
+            for lazy_field in self._cons.lazy_fields if self._is_present(lazy_field[1])
+        )
+
+
+# JSON encoder for Structures, the output is the same as json.dumps output with default separators
+_encode_json_string = json.encoder.encode_basestring_ascii
+_json_cons_prefixes = dict()  # constructor name -> b'{"_cons": "name"'
+_json_keys = dict()  # field name -> b', "name": '
+
+
+def _json_cons_prefix(name: str) -> bytes:
+    if name not in _json_cons_prefixes:
+        _json_cons_prefixes[name] = ('{"_cons": %s' % _encode_json_string(name)).encode('ascii')
+    return _json_cons_prefixes[name]
+
+
+def _json_key(name: str) -> bytes:
+    if name not in _json_keys:
+        _json_keys[name] = (', %s: ' % _encode_json_string(name)).encode('ascii')
+    return _json_keys[name]
+
+
+def _dump_structure_json(structure, out: bytearray):
+    name = structure._constructor_name
+    out += _json_cons_prefixes[name] if name in _json_cons_prefixes else _json_cons_prefix(name)
+    for key, value in structure._items():
+        out += _json_keys[key] if key in _json_keys else _json_key(key)
+        dumper = _json_dumpers.get(type(value))
+        if dumper is None:
+            _dump_json(value, out)
+        else:
+            dumper(value, out)
+    out += b'}'
+
+
+def _dump_compact_structure_json(structure, out: bytearray):
+    out += _json_cons_prefixes[structure._constructor_name]
+    flags = structure._flags
+    for json_key, flag_number, get_field in structure._json_fields:
+        if flag_number is None or flags >> flag_number & 1:
+            out += json_key
+            value = get_field(structure)
+            dumper = _json_dumpers.get(type(value))
+            if dumper is None:
+                _dump_json(value, out)
+            else:
+                dumper(value, out)
+    out += b'}'
+
+
+# fields that were never accessed are transcoded from the buffer
+def _dump_lazy_structure_json(structure, out: bytearray):
+    name = structure._constructor_name
+    out += _json_cons_prefixes[name] if name in _json_cons_prefixes else _json_cons_prefix(name)
+    fields = structure._fields
+    data = structure._data
+    flags = structure._flags
+    offset = structure._start
+    for pname, flag_number, size, skip_argument, _, json_key, json_dump_argument in structure._cons.lazy_fields:
+        if flag_number is None or flags >> flag_number & 1:
+            out += json_key
+            if pname in fields:
+                _dump_json(fields[pname], out)
+                offset = skip_argument(data, offset) if size is None else offset + size
+            else:
+                offset = json_dump_argument(data, offset, out)
+    out += b'}'
+
+
+def _dump_list_json(values, out: bytearray):
+    out += b'['
+    first = True
+    for value in values:
+        if not first:
+            out += b', '
+        first = False
+        _dump_json(value, out)
+    out += b']'
+
+
+def _dump_dict_json(values: dict, out: bytearray):
+    out += b'{'
+    first = True
+    for key, value in values.items():
+        if not first:
+            out += b', '
+        first = False
+        out += _encode_json_string(str(key)).encode('ascii')
+        out += b': '
+        _dump_json(value, out)
+    out += b'}'
+
+
+def _dump_bytes_json(value: bytes, out: bytearray):
+    try:
+        out += _encode_json_string(value.decode('utf-8')).encode('ascii')
+    except UnicodeDecodeError:
+        out += b'"could not decode bytes object :O"'
+
+
+def _dump_str_json(value: str, out: bytearray):
+    out += _encode_json_string(value).encode('ascii')
+
+
+def _dump_int_json(value: int, out: bytearray):
+    out += int.__repr__(value).encode('ascii')
+
+
+def _dump_other_json(value, out: bytearray):
+    out += json.dumps(value).encode('ascii')
+
+
+# compiled classes carry their dumpers, a table of them would keep every scheme that was ever loaded
+Structure._json_dumper = _dump_structure_json
+LazyStructure._json_dumper = _dump_lazy_structure_json
+
+_json_dumpers = {
+    int: _dump_int_json,
+    bytes: _dump_bytes_json,
+    str: _dump_str_json,
+    list: _dump_list_json,
+    tuple: _dump_list_json,
+    dict: _dump_dict_json,
+    DictStructure: _dump_structure_json,
+    LazyStructure: _dump_lazy_structure_json,
+}
+
+
+def _dump_json(value, out: bytearray):
+    dumper = _json_dumpers.get(type(value))
+    if dumper is None:
+        dumper = type(value)._json_dumper if isinstance(value, Structure) else _dump_other_json
+    dumper(value, out)
+
+
+# compiled transcoders of basic types to JSON, a transcoder takes (data: memoryview, offset: int, out: bytearray)
+def _json_dump_int(data, offset, out):
+    out += b'%d' % _unpack_int_from(data, offset)[0]
+    return offset + 4
+
+
+def _json_dump_uint(data, offset, out):
+    out += b'%d' % _unpack_uint_from(data, offset)[0]
+    return offset + 4
+
+
+def _json_dump_long(data, offset, out):
+    out += b'%d' % _unpack_long_from(data, offset)[0]
+    return offset + 8
+
+
+def _json_dump_ulong(data, offset, out):
+    out += b'%d' % _unpack_ulong_from(data, offset)[0]
+    return offset + 8
+
+
+def _json_transcoder(unpack, dump):
+    def json_dump(data, offset, out):
+        value, offset = unpack(data, offset)
+        dump(value, out)
+        return offset
+    return json_dump
+
+
+_basic_json_dumpers = {
+    'int': _json_dump_int,
+    'uint': _json_dump_uint,
+    'long': _json_dump_long,
+    'ulong': _json_dump_ulong,
+}
+_basic_json_dumpers.update(
+    (ptype, _json_transcoder(unpack, _json_dumpers.get(ptype_class, _dump_other_json)))
+    for ptype, unpack, ptype_class in (
+        ('int128', _basic_unpackers['int128'], bytes),
+        ('sha1', _basic_unpackers['sha1'], bytes),
+        ('int256', _basic_unpackers['int256'], bytes),
+        ('double', _unpack_double, float),
+        ('string', _unpack_string, bytes),
+        ('bytes', _unpack_bytes, str),
+    )
+)
+
+
+# encodes any JSON-compatible value that may contain Structures, returns UTF-8 encoded JSON
+def json_dumps(value) -> bytes:
+    out = bytearray()
+    _dump_json(value, out)
+    return bytes(out)
+
+
+# a parameter in TL Constructor or TL Function
+class Parameter:
+    def __init__(self, pname: str, ptype: str, is_boxed: bool,
+                 flag_number: int=None,
+                 is_vector: bool=False,
+                 element_parameter=None
+                 ):
+        self.name = sys.intern(pname)
+        self.type = ptype
+        self.flag_number = flag_number
+        self.is_vector = is_vector
+        self.is_boxed = is_boxed
+        self.element_parameter = element_parameter
+
+    def __repr__(self):
+        if self.flag_number is not None:
+            return '%s:flags.%d?%s' % (self.name, self.flag_number, self.type)
+        else:
+            return '%s:%s' % (self.name, self.type)
+
+# a TL Constructor or TL Function
+class Constructor:
+    def __init__(self, scheme, ptype: str, name: str, number: bytes, has_flags: bool, parameters):
+        self.scheme = scheme
+        self.name = sys.intern(name)
+        self.number = number
+        self.type = ptype
+        self.has_flags = has_flags
+        self._parameters = parameters
+        self.structure_class = None
+        self.read_bare = None
+        self.unpack_bare = None
+        self.lazy_unpack_bare = None
+        self.lazy_fields = None
+        self.lazy_field_index = None
+        self.skip_bare = None
+        self.json_dump_bare = None
+        self.write = None
+
+    def __repr__(self):
+        return '%s %s= %s;' % (self.name, ''.join('%r ' % p for p in self._parameters), self.type)
+
+    def _serialize_argument(self, data, parameter, argument):
+        if isinstance(argument, str):
+            argument = argument.encode('utf-8')
+        if isinstance(argument, dict):
+            argument = self.scheme.serialize(boxed=parameter.is_boxed, **argument)
+        if parameter.type == 'int':
+            data.append(int(argument).to_bytes(4, 'little', signed=True))
+        elif parameter.type == 'uint':
+            data.append(int(argument).to_bytes(4, 'little', signed=False))
+        elif parameter.type == 'long':
+            data.append(int(argument).to_bytes(8, 'little', signed=True))
+        elif parameter.type == 'ulong':
+            data.append(int(argument).to_bytes(8, 'little', signed=False))
+        elif parameter.type == 'int128': # it's more convenient to handle long ints as bytes
+            if len(argument) != 16:
+                raise ValueError("Expected 16 bytes, got %d bytes" % len(argument))
+            data.append(argument)
+        elif parameter.type == 'sha1': # it's more convenient to handle long ints as bytes
+            if len(argument) != 20:
+                raise ValueError("Expected 20 bytes, got %d bytes" % len(argument))
+            data.append(argument)
+        elif parameter.type == 'int256': # it's more convenient to handle long ints as bytes
+            if len(argument) != 32:
+                raise ValueError("Expected 32 bytes, got %d bytes" % len(argument))
+            data.append(argument)
+        elif parameter.type == 'double':
+            data.append(struct.pack(b'<d', float(argument)))
+        elif parameter.type == 'string':
+            if isinstance(argument, str):
+                argument = argument.encode('utf-8')
+            if not isinstance(argument, bytes):
+                raise TypeError('Wrong argument `%r` for parameter `%r` in `%s`, expected bytes or string' % (argument, parameter, self.name))
+            data.append(pack_binary_string(argument))
+        elif parameter.type == 'bytes':
+            argument = base64decode(argument)
+            data.append(pack_binary_string(argument))
+        elif parameter.type == 'object':
+            data.append(pack_long_binary_string(argument.get_flat_bytes()))
+        elif parameter.type == 'gzip':
+            argument.boxed = True
+            data.append(pack_binary_string(self.scheme.gzip(argument.get_flat_bytes())))
+        elif parameter.type == 'rawobject':
+            argument.boxed = True
+            data.append(argument)
+        elif parameter.type == 'encrypted':
+            data.append(argument)
+        elif parameter.is_vector:
+            if parameter.is_boxed:
+                data.append(_compile_cons_number(b'vector t:Type # [ t ] = Vector t'))
+            data.append(len(argument).to_bytes(4, 'little', signed=False))
+            for element_argument in argument:
+                self._serialize_argument(data, parameter.element_parameter, element_argument)
+        else:
+            typecheck, type_error = self.scheme.typecheck(parameter, argument)
+            if not typecheck:
+                raise TypeError('Wrong argument `%r` for parameter `%r` in `%s`, %s' % (argument, parameter, self.name, type_error))
+            data.append(argument)
+        if parameter.flag_number is not None:
+            data.set_flag(parameter.flag_number)
+
+    def serialize(self, boxed: bool, **arguments):
+        data = Value(self, boxed=boxed)
+        for parameter in self._parameters:
+            if parameter.name not in arguments:
+                if parameter.flag_number is None:
+                    raise TypeError('required `%s` not found in `%s`' % (parameter, self.name))
+                else:
+                    pass
+            else:
+                argument = arguments[parameter.name]
+                self._serialize_argument(data, parameter, argument)
+        return data
+
+    async def _deserialize_argument(self, bytereader, parameter):
+        if parameter.type == 'int':
+            return int.from_bytes(await bytereader(4), 'little', signed=True)
+        elif parameter.type == 'uint':
+            return int.from_bytes(await bytereader(4), 'little', signed=False)
+        elif parameter.type == 'long':
+            return int.from_bytes(await bytereader(8), 'little', signed=True)
+        elif parameter.type == 'ulong':
+            return int.from_bytes(await bytereader(8), 'little', signed=False)
+        elif parameter.type == 'int128':
+            return bytes(await bytereader(16))
+        elif parameter.type == 'sha1':
+            return bytes(await bytereader(20))
+        elif parameter.type == 'int256':
+            return bytes(await bytereader(32))
+        elif parameter.type == 'double':
+            return struct.unpack(b'<d', await bytereader(8))[0]
+        elif parameter.type == 'string':
+            return await unpack_binary_string(bytereader)
+        elif parameter.type == 'bytes':
+            return base64encode(await unpack_binary_string(bytereader))
+        elif parameter.type == 'gzip':
+            unpacked = self.scheme._in_thread(self.scheme.gunzip, await unpack_binary_string(bytereader))
+            return await self.scheme.read_from_string(await unpacked)
+        elif parameter.type == 'rawobject':
+            return await self.scheme.read(bytereader)
+        elif parameter.type == 'object':
+            return await self.scheme.read_from_string(await unpack_long_binary_string(bytereader))
+        elif parameter.is_vector:
+                if parameter.is_boxed:
+                    vcons = await bytereader(4)
+                    if vcons != _compile_cons_number(b'vector t:Type # [ t ] = Vector t'):
+                        raise ValueError("Not vector `%s` in `%r` in `%r`" % (long_hex(vcons), parameter, self))
+                vlen = int.from_bytes(await bytereader(4), 'little', signed=False)
+                return [(await self._deserialize_argument(bytereader, parameter.element_parameter)) for _ in range(vlen)]
+        else:
+            return await self.scheme.deserialize(bytereader, parameter)
+
+    async def deserialize_bare_data(self, bytedata):
+        if self.has_flags:
+            flags = unpack_flags(int.from_bytes(await bytedata(4), 'little', signed=False))
+            parameters = [p for p in self._parameters if p.flag_number is None or p.flag_number in flags]
+        else:
+            parameters = self._parameters
+        result = DictStructure(self.name)
+        for parameter in parameters:
+            argument = await self._deserialize_argument(bytedata, parameter)
+            result._fields[parameter.name] = argument
+        return result
+
+    # compiled codec, the same logic as in _serialize_argument and _deserialize_argument
+    # but all the type dispatching is done once per parameter
+
+    def compile(self):
+        if self.read_bare is not None:
+            return
+        read_fields = tuple(
+            (parameter.name, parameter.flag_number, self._compile_argument_reader(parameter))
+            for parameter in self._parameters
+        )
+        name = self.name
+        _json_cons_prefix(name)
+        for parameter in self._parameters:
+            _json_key(parameter.name)
+        structure_class = self.structure_class = _make_structure_class(self)
+        # fields are set with slot descriptors, it's as fast as a dict store
+        set_fields = tuple(getattr(structure_class, parameter.name).__set__ for parameter in self._parameters)
+
+        if self.has_flags:
+            async def read_bare(bytereader):
+                flags = int.from_bytes(await bytereader(4), 'little', signed=False)
+                result = structure_class()
+                result._flags = flags
+                for (_, flag_number, read_argument), set_field in zip(read_fields, set_fields):
+                    if flag_number is None or flags >> flag_number & 1:
+                        set_field(result, await read_argument(bytereader))
+                return result
+        else:
+            async def read_bare(bytereader):
+                result = structure_class()
+                for (_, _, read_argument), set_field in zip(read_fields, set_fields):
+                    set_field(result, await read_argument(bytereader))
+                return result
+
+        unpack_fields = tuple(
+            (parameter.flag_number, self._compile_argument_unpacker(parameter), set_field)
+            for parameter, set_field in zip(self._parameters, set_fields)
+        )
+
+        if self.has_flags:
+            def unpack_bare(data, offset):
+                flags = _unpack_uint_from(data, offset)[0]
+                offset += 4
+                result = structure_class()
+                result._flags = flags
+                for flag_number, unpack_argument, set_field in unpack_fields:
+                    if flag_number is None or flags >> flag_number & 1:
+                        value, offset = unpack_argument(data, offset)
+                        set_field(result, value)
+                return result, offset
+        else:
+            def unpack_bare(data, offset):
+                result = structure_class()
+                for _, unpack_argument, set_field in unpack_fields:
+                    value, offset = unpack_argument(data, offset)
+                    set_field(result, value)
+                return result, offset
+
+        write_fields = tuple(
+            (parameter, parameter.name, parameter.flag_number, self._compile_argument_writer(parameter))
+            for parameter in self._parameters
+        )
+
+        def write(boxed: bool, arguments: dict):
+            data = Value(self, boxed=boxed)
+            for parameter, pname, flag_number, write_argument in write_fields:
+                if pname in arguments:
+                    write_argument(data, arguments[pname])
+                    if flag_number is not None:
+                        data.set_flag(flag_number)
+                elif flag_number is None:
+                    raise TypeError('required `%s` not found in `%s`' % (parameter, name))
+            return data
+
+        # fixed size fields are skipped without a call, the bounds are checked once in the end
+        skip_fields = tuple(
+            (parameter.name, parameter.flag_number, _basic_sizes.get(parameter.type), self._compile_argument_skipper(parameter))
+            for parameter in self._parameters
+        )
+        has_flags = self.has_flags
+        self.lazy_fields = tuple(
+            (pname, flag_number, size, skip_argument,
+             self._compile_argument_lazy_unpacker(parameter), _json_key(pname), self._compile_argument_json_dumper(parameter))
+            for parameter, (pname, flag_number, size, skip_argument) in zip(self._parameters, skip_fields)
+        )
+        self.lazy_field_index = {lazy_field[0]: i for i, lazy_field in enumerate(self.lazy_fields)}
+
+        def lazy_unpack_bare(data, offset):
+            flags = 0
+            if has_flags:
+                flags = _unpack_uint_from(data, offset)[0]
+                offset += 4
+            return LazyStructure(self, data, offset, flags)
+
+        def skip_bare(data, offset):
+            flags = 0
+            if has_flags:
+                flags = _unpack_uint_from(data, offset)[0]
+                offset += 4
+            for _, flag_number, size, skip_argument in skip_fields:
+                if flag_number is None or flags >> flag_number & 1:
+                    if size is None:
+                        offset = skip_argument(data, offset)
+                    else:
+                        offset += size
+            if offset > len(data):
+                raise ValueError('Unexpected end of data in `%s`' % name)
+            return offset
+
+        json_prefix = _json_cons_prefix(name)
+        json_fields = tuple(
+            (json_key, flag_number, json_dump_argument)
+            for _, flag_number, _, _, _, json_key, json_dump_argument in self.lazy_fields
+        )
+
+        def json_dump_bare(data, offset, out):
+            flags = 0
+            if has_flags:
+                flags = _unpack_uint_from(data, offset)[0]
+                offset += 4
+            out += json_prefix
+            for json_key, flag_number, dump_argument in json_fields:
+                if flag_number is None or flags >> flag_number & 1:
+                    out += json_key
+                    offset = dump_argument(data, offset, out)
+            out += b'}'
+            return offset
+
+        self.read_bare = read_bare
+        self.unpack_bare = unpack_bare
+        self.lazy_unpack_bare = lazy_unpack_bare
+        self.skip_bare = skip_bare
+        self.json_dump_bare = json_dump_bare
+        self.write = write
+
+    def _compile_argument_reader(self, parameter):
+        scheme = self.scheme
+        if parameter.type in _basic_readers:
+            return _basic_readers[parameter.type]
+        elif parameter.type == 'gzip':
+            async def read_gzip(bytereader):
+                unpacked = scheme._in_thread(scheme.gunzip, await unpack_binary_string(bytereader))
+                return scheme.unpack(await unpacked, lazy=scheme.lazy)
+            return read_gzip
+        elif parameter.type == 'rawobject':
+            return scheme.boxed_reader(None)
+        elif parameter.type == 'object':
+            async def read_object(bytereader):
+                return scheme.unpack(await unpack_long_binary_string(bytereader), lazy=scheme.lazy)
+            return read_object
+        elif parameter.is_vector:
+            read_element = self._compile_argument_reader(parameter.element_parameter)
+            element_format = _bulk_vector_formats.get(parameter.element_parameter.type)
+            element_size = _basic_sizes.get(parameter.element_parameter.type)
+            is_boxed = parameter.is_boxed
+
+            async def read_vector(bytereader):
+                if is_boxed:
+                    vcons = await bytereader(4)
+                    if vcons != _vector_number:
+                        raise ValueError("Not vector `%s` in `%r` in `%r`" % (long_hex(vcons), parameter, self))
+                vlen = int.from_bytes(await bytereader(4), 'little', signed=False)
+                if element_format is not None:
+                    return list(struct.unpack('<%d%s' % (vlen, element_format), await bytereader(vlen * element_size)))
+                return [(await read_element(bytereader)) for _ in range(vlen)]
+            return read_vector
+        elif parameter.is_boxed:
+            return scheme.boxed_reader(parameter.type)
+        else:
+            return scheme.bare_reader(parameter.type)
+
+    def _compile_argument_unpacker(self, parameter):
+        scheme = self.scheme
+        if parameter.type in _basic_unpackers:
+            return _basic_unpackers[parameter.type]
+        elif parameter.type == 'gzip':
+            def unpack_gzip(data, offset):
+                packed_data, offset = _unpack_string(data, offset)
+                return scheme.unpack(scheme.gunzip(packed_data)), offset
+            return unpack_gzip
+        elif parameter.type == 'rawobject':
+            return scheme.boxed_codec('unpackers', None)
+        elif parameter.type == 'object':
+            unpack_boxed = scheme.boxed_codec('unpackers', None)
+
+            def unpack_object(data, offset):
+                end = _skip_object(data, offset)
+                return unpack_boxed(data[:end], offset + 4)[0], end
+            return unpack_object
+        elif parameter.is_vector:
+            unpack_element = self._compile_argument_unpacker(parameter.element_parameter)
+            return self._compile_vector_codec(parameter, unpack_element)
+        elif parameter.is_boxed:
+            return scheme.boxed_codec('unpackers', parameter.type)
+        else:
+            return scheme.bare_codec('unpack_bare', parameter.type)
+
+    # a lazy unpacker takes (data: memoryview, offset: int) and returns only the value
+    def _compile_argument_lazy_unpacker(self, parameter):
+        scheme = self.scheme
+        if parameter.type in _basic_unpackers:
+            unpack_basic = _basic_unpackers[parameter.type]
+
+            def lazy_unpack_basic(data, offset):
+                return unpack_basic(data, offset)[0]
+            return lazy_unpack_basic
+        elif parameter.type == 'gzip':
+            def lazy_unpack_gzip(data, offset):
+                return scheme.unpack(scheme.gunzip(_unpack_string(data, offset)[0]), lazy=True)
+            return lazy_unpack_gzip
+        elif parameter.type == 'rawobject':
+            return scheme.boxed_codec('lazy_unpackers', None)
+        elif parameter.type == 'object':
+            lazy_unpack_boxed = scheme.boxed_codec('lazy_unpackers', None)
+
+            def lazy_unpack_object(data, offset):
+                return lazy_unpack_boxed(data[:_skip_object(data, offset)], offset + 4)
+            return lazy_unpack_object
+        elif parameter.is_vector and parameter.element_parameter.type in _bulk_vector_formats:
+            unpack_bulk_vector = self._compile_bulk_vector_unpacker(parameter)
+
+            def lazy_unpack_bulk_vector(data, offset):
+                return unpack_bulk_vector(data, offset)[0]
+            return lazy_unpack_bulk_vector
+        elif parameter.is_vector:
+            lazy_unpack_element = self._compile_argument_lazy_unpacker(parameter.element_parameter)
+            skip_element = self._compile_argument_skipper(parameter.element_parameter)
+            is_boxed = parameter.is_boxed
+
+            def lazy_unpack_vector(data, offset):
+                if is_boxed:
+                    self._check_vector_number(data, offset, parameter)
+                    offset += 4
+                vlen = _unpack_uint_from(data, offset)[0]
+                offset += 4
+                result = []
+                for _ in range(vlen):
+                    result.append(lazy_unpack_element(data, offset))
+                    offset = skip_element(data, offset)
+                return result
+            return lazy_unpack_vector
+        elif parameter.is_boxed:
+            return scheme.boxed_codec('lazy_unpackers', parameter.type)
+        else:
+            return scheme.bare_codec('lazy_unpack_bare', parameter.type)
+
+    def _compile_argument_skipper(self, parameter):
+        scheme = self.scheme
+        if parameter.type in _basic_skippers:
+            return _basic_skippers[parameter.type]
+        elif parameter.type == 'gzip':
+            return _skip_string
+        elif parameter.type == 'rawobject':
+            return scheme.boxed_codec('skippers', None)
+        elif parameter.type == 'object':
+            return _skip_object
+        elif parameter.is_vector:
+            skip_element = self._compile_argument_skipper(parameter.element_parameter)
+            element_size = _basic_sizes.get(parameter.element_parameter.type)
+            is_boxed = parameter.is_boxed
+
+            def skip_vector(data, offset):
+                if is_boxed:
+                    self._check_vector_number(data, offset, parameter)
+                    offset += 4
+                vlen = _unpack_uint_from(data, offset)[0]
+                offset += 4
+                if element_size is not None:
+                    return offset + vlen * element_size
+                for _ in range(vlen):
+                    offset = skip_element(data, offset)
+                return offset
+            return skip_vector
+        elif parameter.is_boxed:
+            return scheme.boxed_codec('skippers', parameter.type)
+        else:
+            return scheme.bare_codec('skip_bare', parameter.type)
+
+    def _compile_argument_json_dumper(self, parameter):
+        scheme = self.scheme
+        if parameter.type in _basic_json_dumpers:
+            return _basic_json_dumpers[parameter.type]
+        elif parameter.type == 'gzip':
+            json_dump_boxed = scheme.boxed_codec('json_dumpers', None)
+
+            def json_dump_gzip(data, offset, out):
+                packed_data, offset = _unpack_string(data, offset)
+                json_dump_boxed(memoryview(scheme.gunzip(packed_data)), 0, out)
+                return offset
+            return json_dump_gzip
+        elif parameter.type == 'rawobject':
+            return scheme.boxed_codec('json_dumpers', None)
+        elif parameter.type == 'object':
+            json_dump_boxed = scheme.boxed_codec('json_dumpers', None)
+
+            def json_dump_object(data, offset, out):
+                end = _skip_object(data, offset)
+                json_dump_boxed(data[:end], offset + 4, out)
+                return end
+            return json_dump_object
+        elif parameter.is_vector and parameter.element_parameter.type in _bulk_vector_formats:
+            unpack_bulk_vector = self._compile_bulk_vector_unpacker(parameter)
+
+            def json_dump_bulk_vector(data, offset, out):
+                values, offset = unpack_bulk_vector(data, offset)
+                out += json.dumps(values).encode('ascii')
+                return offset
+            return json_dump_bulk_vector
+        elif parameter.is_vector:
+            json_dump_element = self._compile_argument_json_dumper(parameter.element_parameter)
+            is_boxed = parameter.is_boxed
+
+            def json_dump_vector(data, offset, out):
+                if is_boxed:
+                    self._check_vector_number(data, offset, parameter)
+                    offset += 4
+                vlen = _unpack_uint_from(data, offset)[0]
+                offset += 4
+                out += b'['
+                for i in range(vlen):
+                    if i:
+                        out += b', '
+                    offset = json_dump_element(data, offset, out)
+                out += b']'
+                return offset
+            return json_dump_vector
+        elif parameter.is_boxed:
+            return scheme.boxed_codec('json_dumpers', parameter.type)
+        else:
+            return scheme.bare_codec('json_dump_bare', parameter.type)
+
+    def _check_vector_number(self, data, offset, parameter):
+        if _unpack_uint_from(data, offset)[0] != _vector_id:
+            raise ValueError("Not vector `%s` in `%r` in `%r`" % (long_hex(bytes(data[offset:offset + 4])), parameter, self))
+
+    def _compile_bulk_vector_unpacker(self, parameter):
+        element_format = _bulk_vector_formats[parameter.element_parameter.type]
+        element_size = _basic_sizes[parameter.element_parameter.type]
+        is_boxed = parameter.is_boxed
+
+        def unpack_bulk_vector(data, offset):
+            if is_boxed:
+                self._check_vector_number(data, offset, parameter)
+                offset += 4
+            vlen = _unpack_uint_from(data, offset)[0]
+            offset += 4
+            return list(struct.unpack_from('<%d%s' % (vlen, element_format), data, offset)), offset + vlen * element_size
+        return unpack_bulk_vector
+
+    def _compile_vector_codec(self, parameter, unpack_element):
+        if parameter.element_parameter.type in _bulk_vector_formats:
+            return self._compile_bulk_vector_unpacker(parameter)
+        is_boxed = parameter.is_boxed
+
+        def unpack_vector(data, offset):
+            if is_boxed:
+                self._check_vector_number(data, offset, parameter)
+                offset += 4
+            vlen = _unpack_uint_from(data, offset)[0]
+            offset += 4
+            result = []
+            for _ in range(vlen):
+                element, offset = unpack_element(data, offset)
+                result.append(element)
+            return result, offset
+        return unpack_vector
+
+    def _compile_argument_writer(self, parameter):
+        scheme = self.scheme
+        if parameter.type in _basic_writers:
+            return _basic_writers[parameter.type]
+        elif parameter.type == 'string':
+            def write_string(data, argument):
+                if isinstance(argument, str):
+                    argument = argument.encode('utf-8')
+                if not isinstance(argument, bytes):
+                    raise TypeError('Wrong argument `%r` for parameter `%r` in `%s`, expected bytes or string' % (argument, parameter, self.name))
+                data.append(_PackedString(argument))
+            return write_string
+        elif parameter.type == 'object':
+            def write_object(data, argument):
+                if isinstance(argument, dict):
+                    argument = scheme.serialize(boxed=parameter.is_boxed, **argument)
+                data.append(_PackedObject(argument))
+            return write_object
+        elif parameter.type == 'gzip':
+            def write_gzip(data, argument):
+                if isinstance(argument, dict):
+                    argument = scheme.serialize(boxed=True, **argument)
+                argument.boxed = True
+                data.append(_PackedString(scheme.gzip(argument.get_buffer())))
+            return write_gzip
+        elif parameter.type == 'rawobject':
+            def write_rawobject(data, argument):
+                if isinstance(argument, dict):
+                    argument = scheme.serialize(boxed=True, **argument)
+                argument.boxed = True
+                data.append(argument)
+            return write_rawobject
+        elif parameter.is_vector and parameter.element_parameter.type in _bulk_vector_formats:
+            element_format = _bulk_vector_formats[parameter.element_parameter.type]
+            convert = float if element_format == 'd' else int
+            is_boxed = parameter.is_boxed
+
+            def write_bulk_vector(data, argument):
+                if is_boxed:
+                    data.append(_vector_number)
+                data.append(struct.pack('<I%d%s' % (len(argument), element_format), len(argument), *map(convert, argument)))
+            return write_bulk_vector
+        elif parameter.is_vector:
+            write_element = self._compile_argument_writer(parameter.element_parameter)
+            is_boxed = parameter.is_boxed
+
+            def write_vector(data, argument):
+                if is_boxed:
+                    data.append(_vector_number)
+                data.append(len(argument).to_bytes(4, 'little', signed=False))
+                for element_argument in argument:
+                    write_element(data, element_argument)
+            return write_vector
+        else:
+            def write_value(data, argument):
+                if isinstance(argument, dict):
+                    argument = scheme.serialize(boxed=parameter.is_boxed, **argument)
+                typecheck, type_error = scheme.typecheck(parameter, argument)
+                if not typecheck:
+                    raise TypeError('Wrong argument `%r` for parameter `%r` in `%s`, %s' % (argument, parameter, self.name, type_error))
+                data.append(argument)
+            return write_value
+
+
+# tests
+if __name__ == '__main__':
+    import asyncio
+    import sys
+    import timeit
+
+    # benchmark of compiled and interpreting codecs
+    # usage: tl.py [recorded_payload.bin ...], a payload is a boxed TL object as it was received from the server
+    scheme_data = open('scheme.tl', 'r').read() + "\n" + open('service.tl', 'r').read()
+    compiled_scheme = Scheme(None, scheme_data)
+    interpreted_scheme = Scheme(None, scheme_data, compiled=False)
+
+    def synthetic_payloads(scheme):
+        def cons(number):
+            return scheme.cons_numbers[number.to_bytes(4, 'little', signed=False)]
+        users = [
+            dict(_cons='user', id=100000 + i, access_hash=-1111111111111 * i, first_name='name %d' % i,
+                 username='username%d' % i, status=dict(_cons='userStatusRecently'))
+            for i in range(20)
+        ]
+        messages = [
+            cons(0x44f9b43d).serialize(
+                boxed=True, id=i, from_id=100000 + i % 20, to_id=dict(_cons='peerUser', user_id=100000),
+                date=1494517469 + i, message='message text %d ' % i * 8,
+                entities=[dict(_cons='messageEntityBold', offset=0, length=4)]
+            )
+            for i in range(100)
+        ]
+        history = scheme.boxed(_cons='messages.messages', messages=messages, chats=[], users=users)
+        updates = scheme.boxed(
+            _cons='updates',
+            updates=[dict(_cons='updateNewMessage', message=m, pts=i, pts_count=1) for i, m in enumerate(messages)],
+            users=users, chats=[], date=1494517468, seq=0
+        )
+        return dict(history=history.get_flat_bytes(), updates=updates.get_flat_bytes())
+
+    payloads = synthetic_payloads(compiled_scheme)
+    if payloads != synthetic_payloads(interpreted_scheme):
+        raise RuntimeError("compiled and interpreted writers produce different data")
+    for filename in sys.argv[1:]:
+        payloads[filename] = open(filename, 'rb').read()
+
+    loop = asyncio.new_event_loop()
+    for payload_name, payload in payloads.items():
+        decoders = dict(
+            interpreted=lambda: loop.run_until_complete(interpreted_scheme.read_from_string(payload)),
+            compiled=lambda: loop.run_until_complete(compiled_scheme.read(Bytedata(payload).cororead)),
+            unpack=lambda: compiled_scheme.unpack(payload),
+            lazy=lambda: compiled_scheme.unpack(payload, lazy=True),
+        )
+        reference = decoders['interpreted']().get_dict()
+        for decoder_name, decode in decoders.items():
+            if decode().get_dict() != reference:
+                raise RuntimeError("%s reader produces different objects" % decoder_name)
+            seconds = min(timeit.repeat(decode, number=10, repeat=3)) / 10
+            print('%-12s %-12s %8d bytes %8.3f ms' % (payload_name, decoder_name, len(payload), seconds * 1000))
+        structure = decoders['unpack']()
+        encoders = dict(
+            json_dumps=lambda: json.dumps(structure.get_dict()).encode('utf-8'),
+            get_json=structure.get_json,
+            lazy_json=lambda: compiled_scheme.unpack(payload, lazy=True).get_json(),
+        )
+        for encoder_name, encode in encoders.items():
+            if encode() != encoders['json_dumps']():
+                raise RuntimeError("%s produces different JSON" % encoder_name)
+            seconds = min(timeit.repeat(encode, number=10, repeat=3)) / 10
+            print('%-12s %-12s %8d bytes %8.3f ms' % (payload_name, encoder_name, len(payload), seconds * 1000))
+    loop.close()